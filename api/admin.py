@@ -18,6 +18,7 @@ from .models import Formation
 from .models import Key
 from .models import Layer
 from .models import Node
+from .models import Operation
 from .models import Provider
 from .models import Release
 
@@ -112,6 +113,16 @@ class NodeAdmin(admin.ModelAdmin):
 admin.site.register(Node, NodeAdmin)
 
 
+class OperationAdmin(admin.ModelAdmin):
+    """Set presentation options for :class:`~api.models.Operation` models
+    in the Django admin.
+    """
+    date_hierarchy = 'created'
+    list_display = ('action', 'target', 'owner', 'state', 'created')
+    list_filter = ('owner', 'action', 'state')
+admin.site.register(Operation, OperationAdmin)
+
+
 class ProviderAdmin(admin.ModelAdmin):
     """Set presentation options for :class:`~api.models.Provider` models
     in the Django admin.
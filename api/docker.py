@@ -1,12 +1,20 @@
+import copy
 import cStringIO
 import hashlib
 import json
+import os
+import re
 import requests
 import tarfile
+import threading
 import urlparse
 import uuid
 
-from deis import settings
+from django.conf import settings
+
+
+# layers are uploaded in chunks of this many bytes
+LAYER_CHUNK_SIZE = 64 * 1024
 
 
 def publish_release(repository_path, config, tag):
@@ -20,100 +28,178 @@ def publish_release(repository_path, config, tag):
     results in a new Docker image at: <registry_url>/gabrtv/myapp:v23
     which contains the new configuration as ENV entries.
     """
+    client = _get_client()
     try:
-        image_id = _get_tag(repository_path, 'latest')
+        parent = client.get_latest_image(repository_path)
     except RuntimeError:
         # no image exists yet, so let's build one!
-        _put_first_image(repository_path)
-        image_id = _get_tag(repository_path, 'latest')
-    image = _get_image(image_id)
+        parent = _first_image()
+        client.commit(repository_path, parent, _empty_tar_archive(), ['v0'])
     # construct the new image
-    image['parent'] = image['id']
+    image = copy.deepcopy(parent)
+    image['parent'] = parent['id']
     image['id'] = _new_id()
     image['config']['Env'] = _construct_env(image['config']['Env'], config)
     # update and tag the new image
-    _commit(repository_path, image, _empty_tar_archive(), tag)
+    client.commit(repository_path, image, _empty_tar_archive(), [tag])
+    # releases published concurrently can finish out of order, so latest
+    # only moves to an image newer than every other release
+    if _is_newest(tag, client.get_tags(repository_path)):
+        client.tag_latest(repository_path, image)
 
 
 # registry access
 
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
 
-def _commit(repository_path, image, layer, tag):
-    _put_image(image)
-    cookies = _put_layer(image['id'], layer)
-    _put_checksum(image, cookies)
-    _put_tag(image['id'], repository_path, tag)
-    # point latest to the new tag
-    _put_tag(image['id'], repository_path, 'latest')
 
+def _get_client():
+    """
+    Return the process-wide registry client
+
+    A forked process gets a client of its own rather than sharing its
+    parent's sockets.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid() or \
+                _client.url != settings.REGISTRY_URL:
+            _client = RegistryClient(settings.REGISTRY_URL)
+            _client_pid = os.getpid()
+        return _client
 
-def _put_first_image(repository_path):
-    image = {
-        'id': _new_id(),
-        'parent': '',
-        'config': {
-            'Env': []
-        }
-    }
-    # tag as v0 in the registry
-    _commit(repository_path, image, _empty_tar_archive(), 'v0')
-
-
-def _get_tag(repository, tag):
-    path = "/v1/repositories/{repository}/tags/{tag}".format(**locals())
-    url = urlparse.urljoin(settings.REGISTRY_URL, path)
-    r = requests.get(url)
-    if not r.status_code == 200:
-        raise RuntimeError("GET Image Error ({}: {})".format(r.status_code, r.text))
-    print r.text
-    return r.json()
-
-
-def _get_image(image_id):
-    path = "/v1/images/{image_id}/json".format(**locals())
-    url = urlparse.urljoin(settings.REGISTRY_URL, path)
-    r = requests.get(url)
-    if not r.status_code == 200:
-        raise RuntimeError("GET Image Error ({}: {})".format(r.status_code, r.text))
-    return r.json()
-
-
-def _put_image(image):
-    path = "/v1/images/{id}/json".format(**image)
-    url = urlparse.urljoin(settings.REGISTRY_URL, path)
-    r = requests.put(url, data=json.dumps(image))
-    if not r.status_code == 200:
-        raise RuntimeError("PUT Image Error ({}: {})".format(r.status_code, r.text))
-    return r.json()
-
-
-def _put_layer(image_id, layer_fileobj):
-    path = "/v1/images/{image_id}/layer".format(**locals())
-    url = urlparse.urljoin(settings.REGISTRY_URL, path)
-    r = requests.put(url, data=layer_fileobj.read())
-    if not r.status_code == 200:
-        raise RuntimeError("PUT Layer Error ({}: {})".format(r.status_code, r.text))
-    return r.cookies
-
-
-def _put_checksum(image, cookies):
-    path = "/v1/images/{id}/checksum".format(**image)
-    url = urlparse.urljoin(settings.REGISTRY_URL, path)
-    tarsum = TarSum(json.dumps(image)).compute()
-    headers = {'X-Docker-Checksum': tarsum}
-    r = requests.put(url, headers=headers, cookies=cookies)
-    if not r.status_code == 200:
-        raise RuntimeError("PUT Checksum Error ({}: {})".format(r.status_code, r.text))
-    print r.json()
-
-
-def _put_tag(image_id, repository_path, tag):
-    path = "/v1/repositories/{repository_path}/tags/{tag}".format(**locals())
-    url = urlparse.urljoin(settings.REGISTRY_URL, path)
-    r = requests.put(url, data=json.dumps(image_id))
-    if not r.status_code == 200:
-        raise RuntimeError("PUT Tag Error ({}: {})".format(r.status_code, r.text))
-    print r.json()
+
+class RegistryClient(object):
+    """
+    Client for the Docker registry API
+
+    Requests share a :class:`requests.Session`, so connections to the
+    registry are kept alive and reused. The JSON of each repository's
+    latest image is cached, and tags are written concurrently.
+    """
+
+    def __init__(self, url, pool_size=4):
+        self.url = url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, path, error, **kwargs):
+        url = urlparse.urljoin(self.url, path)
+        r = self.session.request(method, url, **kwargs)
+        if not r.status_code == 200:
+            raise RuntimeError("{} Error ({}: {})".format(error, r.status_code, r.text))
+        return r
+
+    def get_latest_image(self, repository):
+        """
+        Return the JSON of a repository's latest image.
+
+        The latest tag is looked up on every call, but the image JSON is
+        only fetched when the tag has moved since it was cached.
+        """
+        image_id = self.get_tag(repository, 'latest')
+        with self._lock:
+            image = self._latest.get(repository)
+        if image is None or image['id'] != image_id:
+            image = self.get_image(image_id)
+            self._cache(repository, image)
+        return copy.deepcopy(image)
+
+    def commit(self, repository, image, layer, tags):
+        """
+        Upload an image with its layer, then write its tags concurrently.
+
+        :param layer: the tar archive, as a file or an iterable of chunks
+        """
+        self.put_image(image)
+        tarsum = TarSum(json.dumps(image))
+        cookies = self.put_layer(image['id'], layer, tarsum)
+        self.put_checksum(image, cookies, tarsum.compute())
+        errors = []
+
+        def put_tag(tag):
+            try:
+                self.put_tag(image['id'], repository, tag)
+            except Exception as err:
+                errors.append(err)
+        threads = [threading.Thread(target=put_tag, args=(tag,)) for tag in tags[1:]]
+        for t in threads:
+            t.start()
+        put_tag(tags[0])
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        if 'latest' in tags:
+            self._cache(repository, copy.deepcopy(image))
+
+    def tag_latest(self, repository, image):
+        """Point a repository's latest tag at an image."""
+        self.put_tag(image['id'], repository, 'latest')
+        self._cache(repository, copy.deepcopy(image))
+
+    def _cache(self, repository, image):
+        with self._lock:
+            self._latest[repository] = image
+
+    def get_tags(self, repository):
+        path = "/v1/repositories/{repository}/tags".format(**locals())
+        return self.request('GET', path, 'GET Tags').json()
+
+    def get_tag(self, repository, tag):
+        path = "/v1/repositories/{repository}/tags/{tag}".format(**locals())
+        return self.request('GET', path, 'GET Image').json()
+
+    def get_image(self, image_id):
+        path = "/v1/images/{image_id}/json".format(**locals())
+        return self.request('GET', path, 'GET Image').json()
+
+    def put_image(self, image):
+        path = "/v1/images/{id}/json".format(**image)
+        return self.request('PUT', path, 'PUT Image', data=json.dumps(image)).json()
+
+    def put_layer(self, image_id, layer, tarsum=None):
+        """
+        Stream a layer to the registry, hashing it as it is sent.
+
+        A seekable file is sent with its length; anything else, such as a
+        generator writing the archive on the fly, is sent in chunks.
+
+        :param layer: the tar archive, as a file or an iterable of chunks
+        :param tarsum: a :class:`TarSum` to feed the archive to
+        """
+        path = "/v1/images/{image_id}/layer".format(**locals())
+        size = _remaining_size(layer)
+        if size is not None:
+            data = _LayerReader(layer, size, tarsum)
+        else:
+            data = self._stream(layer, tarsum)
+        return self.request('PUT', path, 'PUT Layer', data=data).cookies
+
+    @staticmethod
+    def _stream(layer, tarsum):
+        for chunk in _iter_chunks(layer):
+            # an empty chunk would end a chunked request early
+            if not chunk:
+                continue
+            if tarsum:
+                tarsum.update(chunk)
+            yield chunk
+
+    def put_checksum(self, image, cookies, tarsum):
+        path = "/v1/images/{id}/checksum".format(**image)
+        headers = {'X-Docker-Checksum': tarsum}
+        return self.request('PUT', path, 'PUT Checksum', headers=headers, cookies=cookies).json()
+
+    def put_tag(self, image_id, repository, tag):
+        path = "/v1/repositories/{repository}/tags/{tag}".format(**locals())
+        return self.request('PUT', path, 'PUT Tag', data=json.dumps(image_id)).json()
 
 
 # utility functions
@@ -135,6 +221,74 @@ def _construct_env(env, config):
     return new_env
 
 
+def _release_version(tag):
+    "Return the release number of a tag such as 'v23', or None"
+    match = re.match(r'^v(\d+)$', tag)
+    return int(match.group(1)) if match else None
+
+
+def _is_newest(tag, tags):
+    "Return whether a release tag is at least as new as every release in tags"
+    version = _release_version(tag)
+    if version is None:
+        return True
+    return all(v is None or v <= version for v in map(_release_version, tags))
+
+
+def _iter_chunks(layer, chunk_size=LAYER_CHUNK_SIZE):
+    "Yield a layer in chunks, reading a file-like layer as it goes"
+    if not hasattr(layer, 'read'):
+        for chunk in layer:
+            yield chunk
+        return
+    while True:
+        chunk = layer.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _remaining_size(layer):
+    "Return the bytes left in a seekable file, or None"
+    try:
+        pos = layer.tell()
+        layer.seek(0, os.SEEK_END)
+        size = layer.tell() - pos
+        layer.seek(pos)
+        return size
+    except (AttributeError, IOError):
+        return None
+
+
+class _LayerReader(object):
+    "A sized file wrapper that feeds a layer to a TarSum as it is read"
+
+    def __init__(self, fileobj, size, tarsum=None):
+        self.fileobj = fileobj
+        self.size = size
+        self.tarsum = tarsum
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        chunk = self.fileobj.read(size)
+        if self.tarsum:
+            self.tarsum.update(chunk)
+        return chunk
+
+
+def _first_image():
+    "Return the empty base image of a new repository"
+    return {
+        'id': _new_id(),
+        'parent': '',
+        'config': {
+            'Env': []
+        }
+    }
+
+
 def _new_id():
     "Return 64-char UUID for use as Image ID"
     return ''.join(uuid.uuid4().hex * 2)
@@ -170,15 +324,38 @@ def sha256_string(s):
 
 
 class TarSum(object):
+    """
+    Compute the tarsum checksum of an image layer.
+
+    Members are either appended from an open :class:`tarfile.TarFile`, or
+    the raw archive is fed to :meth:`update` in chunks of any size while it
+    is being written or uploaded. The streaming parser only holds one tar
+    header and the running hash of the current member, so memory use does
+    not depend on the size of the archive.
+    """
+
+    header_fields = ('name', 'mode', 'uid', 'gid', 'size', 'mtime',
+                     'type', 'linkname', 'uname', 'gname', 'devmajor',
+                     'devminor')
+
+    # headers whose data describes the member that follows them
+    extended_types = (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK,
+                      tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.SOLARIS_XHDTYPE)
 
     def __init__(self, json_data):
         self.json_data = json_data
         self.hashes = []
-        self.header_fields = ('name', 'mode', 'uid', 'gid', 'size', 'mtime',
-                              'type', 'linkname', 'uname', 'gname', 'devmajor',
-                              'devminor')
-
-    def append(self, member, tarobj):
+        # streaming parser state
+        self._block = ''
+        self._remaining = 0
+        self._padding = 0
+        self._hash = None
+        self._extended = None
+        self._pending = {}
+        self._global_pax = {}
+        self._done = False
+
+    def _header(self, member):
         header = ''
         for field in self.header_fields:
             value = getattr(member, field)
@@ -188,6 +365,10 @@ class TarSum(object):
                 if member.isdir() and not value.endswith('/'):
                     value += '/'
             header += '{0}{1}'.format(field, value)
+        return header
+
+    def append(self, member, tarobj):
+        header = self._header(member)
         h = None
         try:
             if member.size > 0:
@@ -199,8 +380,104 @@ class TarSum(object):
             h = sha256_string(header)
         self.hashes.append(h)
 
+    def update(self, data):
+        """Hash the next chunk of a raw tar archive."""
+        pos, end = 0, len(data)
+        while pos < end and not self._done:
+            if self._remaining:
+                n = min(self._remaining, end - pos)
+                chunk = data[pos:pos + n]
+                if self._extended is not None:
+                    self._extended[1].append(chunk)
+                else:
+                    self._hash.update(chunk)
+                self._remaining -= n
+                pos += n
+                if not self._remaining:
+                    self._end_member()
+            elif self._padding:
+                n = min(self._padding, end - pos)
+                self._padding -= n
+                pos += n
+            else:
+                n = min(tarfile.BLOCKSIZE - len(self._block), end - pos)
+                self._block += data[pos:pos + n]
+                pos += n
+                if len(self._block) == tarfile.BLOCKSIZE:
+                    block, self._block = self._block, ''
+                    self._start_member(block)
+
+    def _start_member(self, block):
+        if block == tarfile.NUL * tarfile.BLOCKSIZE:
+            # end of archive
+            self._done = True
+            return
+        member = tarfile.TarInfo.frombuf(block)
+        if member.type in self.extended_types:
+            self._extended = (member.type, [])
+            size = member.size
+        else:
+            self._apply_pending(member)
+            self._hash = hashlib.sha256(self._header(member))
+            size = member.size if member.isreg() or \
+                member.type not in tarfile.SUPPORTED_TYPES else 0
+        self._remaining = size
+        self._padding = -size % tarfile.BLOCKSIZE
+        if not size:
+            self._end_member()
+
+    def _end_member(self):
+        if self._extended is None:
+            self.hashes.append(self._hash.hexdigest())
+            self._hash = None
+            return
+        kind, parts = self._extended
+        self._extended = None
+        buf = ''.join(parts)
+        if kind == tarfile.GNUTYPE_LONGNAME:
+            self._pending['name'] = tarfile.nts(buf)
+        elif kind == tarfile.GNUTYPE_LONGLINK:
+            self._pending['linkname'] = tarfile.nts(buf)
+        elif kind == tarfile.XGLTYPE:
+            self._global_pax.update(_parse_pax(buf))
+        else:
+            self._pending['pax'] = _parse_pax(buf)
+
+    def _apply_pending(self, member):
+        """Apply GNU long names and pax headers, as :mod:`tarfile` does."""
+        pending, self._pending = self._pending, {}
+        if 'name' in pending:
+            member.name = pending['name']
+        if 'linkname' in pending:
+            member.linkname = pending['linkname']
+        pax = dict(self._global_pax, **pending.get('pax', {}))
+        for keyword, value in pax.items():
+            if keyword not in tarfile.PAX_FIELDS:
+                continue
+            if keyword == 'path':
+                value = value.rstrip('/')
+            if keyword in tarfile.PAX_NUMBER_FIELDS:
+                try:
+                    value = tarfile.PAX_NUMBER_FIELDS[keyword](value)
+                except ValueError:
+                    value = 0
+            setattr(member, keyword, value)
+
     def compute(self):
         self.hashes.sort()
         data = self.json_data + ''.join(self.hashes)
         tarsum = 'tarsum+sha256:{0}'.format(sha256_string(data))
         return tarsum
+
+
+def _parse_pax(buf):
+    "Return the keyword/value records of a pax extended header"
+    records = {}
+    pos = 0
+    while pos < len(buf) and buf[pos] != tarfile.NUL:
+        space = buf.index(' ', pos)
+        length = int(buf[pos:space])
+        keyword, value = buf[space + 1:pos + length - 1].split('=', 1)
+        records[keyword] = value
+        pos += length
+    return records
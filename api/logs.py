@@ -0,0 +1,388 @@
+"""
+An indexed store for the aggregated logs of an :class:`~api.models.App`.
+
+The log server appends an app's log lines to ``<app>.log`` in
+``DEIS_LOG_DIR``, and log rotation leaves older segments beside it as
+``<app>.log.1``, ``<app>.log.2`` and so on. A :class:`LogStore` keeps a
+sparse index of every segment: the offset of each block of about
+``LOG_INDEX_BLOCK`` bytes, with the first and last timestamp and the
+process types of the lines in it. Reads seek straight to the blocks they
+need, so the tail of a large log, or the lines of one process type since a
+given time, costs a few block reads rather than a scan of the file. The
+log can also be followed as lines are written to it.
+
+Each read extends the index over lines appended since the last one. The
+index is saved under ``LOG_INDEX_DIR``, keyed by inode so that it
+survives rotation.
+"""
+
+from __future__ import unicode_literals
+from collections import OrderedDict
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# the sortable timestamp that starts a log line
+TIMESTAMP = re.compile(br'^(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})', re.M)
+# the process type in the syslog tag of a line, such as "myapp[web.1]:"
+PROCESS = re.compile(br'^[^\n\[]*\[([a-z][-\w]*)\.\d+\]', re.M)
+SINCE = re.compile(
+    r'^(\d{4}-\d{2}-\d{2})(?:[T ](\d{2}:\d{2})(:\d{2})?(?:\.\d+)?(?:Z|[-+]\d{2}:?\d{2})?)?$')
+
+# indexes loaded by this process, by path, least recently used first
+_indexes = OrderedDict()
+
+
+class LogPage(namedtuple('LogPage', ['data', 'previous', 'next'])):
+    """
+    A page of log lines, oldest first.
+
+    ``previous`` is the cursor for the page of older lines, or None when
+    there are none, and ``next`` is the cursor to :meth:`LogStore.follow`
+    the lines written after it from.
+    """
+
+    __slots__ = ()
+
+
+def parse_since(value):
+    """
+    Return the sortable timestamp for a date or time.
+
+    :param value: a date such as "2014-02-20", or a time such as
+                  "2014-02-20T12:30:00"; fractions and time zones are ignored
+    :raises ValueError: if the value is not a date or time
+    """
+    match = SINCE.match(value.strip())
+    if not match:
+        raise ValueError('Invalid time: {}'.format(value))
+    date, clock, seconds = match.groups()
+    return '{}T{}{}'.format(date, clock or '00:00', seconds or ':00')
+
+
+def _timestamp(match):
+    return (match.group(1) + b'T' + match.group(2)).decode('ascii')
+
+
+def _process_pattern(types):
+    """Return a pattern for whole lines of some process types, or None for all lines."""
+    if not types:
+        return None
+    return re.compile(br'^[^\n\[]*\[(?:{})\.\d+\][^\n]*\n'.format(
+        b'|'.join(re.escape(t.encode('ascii')) for t in types)), re.M)
+
+
+class LogStore(object):
+    """
+    The log segments of one application and their index.
+
+    :param app_id: the id of the application whose logs are read
+    """
+
+    def __init__(self, app_id):
+        self.app_id = app_id
+        self.pattern = re.compile(r'^{}\.log(?:\.(\d+))?$'.format(re.escape(app_id)))
+
+    @property
+    def path(self):
+        return os.path.join(settings.DEIS_LOG_DIR, self.app_id + '.log')
+
+    @property
+    def index_path(self):
+        return os.path.join(settings.LOG_INDEX_DIR, self.app_id + '.json')
+
+    def segments(self):
+        """
+        Return the indexed segments of this application's log, oldest first.
+
+        Each segment is a dict with the ``path`` and ``inode`` of its file,
+        the ``size`` indexed so far and its ``blocks``. A block is a list of
+        its offset, first and last timestamp and process types.
+        """
+        found = []
+        if os.path.isdir(settings.DEIS_LOG_DIR):
+            for name in os.listdir(settings.DEIS_LOG_DIR):
+                match = self.pattern.match(name)
+                if match:
+                    found.append((-int(match.group(1) or 0), name))
+        index = self._load()
+        segments, changed = [], False
+        for _, name in sorted(found):
+            path = os.path.join(settings.DEIS_LOG_DIR, name)
+            with open(path, 'rb') as f:
+                inode = str(os.fstat(f.fileno()).st_ino)
+                segment = index.get(inode)
+                if not self._valid(segment, f):
+                    segment = index[inode] = {'size': 0, 'head': None, 'blocks': []}
+                changed |= self._extend(segment, f)
+            segment.update(path=path, inode=inode)
+            segments.append(segment)
+        # forget segments that rotated away
+        for inode in set(index) - set(s['inode'] for s in segments):
+            del index[inode]
+            changed = True
+        if changed:
+            self._save(index)
+        return segments
+
+    def read(self, since=None, types=None, lines=None, cursor=None):
+        """
+        Return the most recent log lines that match a query.
+
+        :param since: the sortable timestamp of the oldest line to return
+        :param types: the process types of lines to return, or all lines
+        :param lines: the most lines to return, by default ``LOG_LINES``
+        :param cursor: return lines before this cursor, from a previous page
+        :returns: a :class:`LogPage`
+        :raises EnvironmentError: if the application has no logs
+        :raises ValueError: if the cursor is invalid or has expired
+        """
+        segments = self.segments()
+        if not segments:
+            raise EnvironmentError('Could not locate logs')
+        lines = lines or settings.LOG_LINES
+        position, end = self._locate(segments, cursor)
+        found, previous = [], None
+        while position >= 0 and previous is None:
+            segment = segments[position]
+            for offset, text in self._lines(segment, end, since, types):
+                found.append(text)
+                if len(found) == lines:
+                    previous = '{}:{}'.format(segment['inode'], offset)
+                    break
+            position, end = position - 1, None
+        data = b''.join(reversed(found)).decode('utf-8', 'replace')
+        if cursor is None:
+            cursor = '{}:{}'.format(segments[-1]['inode'], segments[-1]['size'])
+        return LogPage(data, previous, cursor)
+
+    def follow(self, cursor, types=None, timeout=None):
+        """
+        Return an iterator of the log lines written after a cursor, as they are written.
+
+        The live log is watched for a new size or inode every
+        ``LOG_FOLLOW_INTERVAL`` seconds. When it rotates, the rest of the
+        rotated segment is read before the new one. Lines are yielded in
+        batches of at most about ``LOG_FOLLOW_CHUNK`` bytes, each with the
+        cursor that follows it, so a slow reader never makes the store hold
+        more than a batch. While the log is quiet an empty batch is yielded
+        every ``LOG_FOLLOW_HEARTBEAT`` seconds.
+
+        :param cursor: the cursor to follow the log from
+        :param types: the process types of lines to yield, or all lines
+        :param timeout: stop after this many seconds, by default
+                        ``LOG_FOLLOW_TIMEOUT``
+        :raises EnvironmentError: if the application has no logs
+        :raises ValueError: if the cursor is invalid or has expired
+        """
+        timeout = settings.LOG_FOLLOW_TIMEOUT if timeout is None else timeout
+        segments = self.segments()
+        position, offset = self._locate(segments, cursor)
+        return self._follow(segments, position, offset, _process_pattern(types), timeout)
+
+    def _follow(self, segments, position, offset, process, timeout):
+        inode = segments[position]['inode']
+        now = time.time()
+        deadline, beat = now + timeout, now + settings.LOG_FOLLOW_HEARTBEAT
+        watched = None
+        while True:
+            for data, offset in self._batches(segments[position], offset, process):
+                beat = time.time() + settings.LOG_FOLLOW_HEARTBEAT
+                yield data, '{}:{}'.format(inode, offset)
+            if position + 1 < len(segments):
+                position, offset = position + 1, 0
+                inode = segments[position]['inode']
+                continue
+            while True:
+                now = time.time()
+                if now >= deadline:
+                    return
+                if now >= beat:
+                    beat = now + settings.LOG_FOLLOW_HEARTBEAT
+                    yield '', '{}:{}'.format(inode, offset)
+                time.sleep(settings.LOG_FOLLOW_INTERVAL)
+                try:
+                    stat = os.stat(self.path)
+                except OSError:
+                    continue
+                if (str(stat.st_ino), stat.st_size) != watched:
+                    watched = str(stat.st_ino), stat.st_size
+                    break
+            segments = self.segments()
+            inodes = [s['inode'] for s in segments]
+            if inode not in inodes:
+                # the segment being followed was removed
+                return
+            position = inodes.index(inode)
+
+    @staticmethod
+    def _batches(segment, offset, process):
+        """Yield batches of the matching lines of a segment after an offset."""
+        with open(segment['path'], 'rb') as f:
+            f.seek(offset)
+            while offset < segment['size']:
+                chunk = f.read(min(settings.LOG_FOLLOW_CHUNK, segment['size'] - offset))
+                # finish the last line of a full batch
+                if not chunk.endswith(b'\n'):
+                    chunk += f.readline()
+                offset += len(chunk)
+                if process:
+                    chunk = b''.join(m.group() for m in process.finditer(chunk))
+                if chunk:
+                    yield chunk.decode('utf-8', 'replace'), offset
+
+    def _lines(self, segment, end, since, types):
+        """Yield the offset and text of matching lines before an offset, newest first."""
+        end = segment['size'] if end is None else end
+        blocks = segment['blocks']
+        process = _process_pattern(types)
+        with open(segment['path'], 'rb') as f:
+            for i in range(len(blocks) - 1, -1, -1):
+                offset, first, last, block_types = blocks[i]
+                if offset >= end:
+                    continue
+                if since and (last is None or last < since):
+                    return
+                if types and not set(types) & set(block_types):
+                    continue
+                f.seek(offset)
+                chunk = f.read(min(end, self._block_end(segment, i)) - offset)
+                if since and (first is None or first < since):
+                    matched = self._since(chunk, offset, first, since, process)
+                elif process:
+                    matched = [(offset + m.start(), m.group()) for m in process.finditer(chunk)]
+                else:
+                    matched = self._split(chunk, offset)
+                for line in reversed(matched):
+                    yield line
+
+    @staticmethod
+    def _split(chunk, offset):
+        matched = []
+        # blocks end on a line, so the last piece is empty
+        for text in chunk.split(b'\n')[:-1]:
+            matched.append((offset, text + b'\n'))
+            offset += len(text) + 1
+        return matched
+
+    def _since(self, chunk, offset, stamp, since, process):
+        """Return the lines of a block written since a time, checking each line."""
+        matched = []
+        for offset, text in self._split(chunk, offset):
+            match = TIMESTAMP.match(text)
+            if match:
+                stamp = _timestamp(match)
+            if stamp is not None and stamp >= since and (not process or process.match(text)):
+                matched.append((offset, text))
+        return matched
+
+    @staticmethod
+    def _block_end(segment, i):
+        blocks = segment['blocks']
+        return blocks[i + 1][0] if i + 1 < len(blocks) else segment['size']
+
+    @staticmethod
+    def _locate(segments, cursor):
+        """Return the position of the segment and the offset a cursor points to."""
+        if cursor is None:
+            return len(segments) - 1, None
+        try:
+            inode, offset = cursor.split(':')
+            offset = int(offset)
+        except ValueError:
+            raise ValueError('Invalid log cursor: {}'.format(cursor))
+        for i, segment in enumerate(segments):
+            if segment['inode'] == inode and 0 <= offset <= segment['size']:
+                return i, offset
+        raise ValueError('Log cursor has expired: {}'.format(cursor))
+
+    @staticmethod
+    def _valid(segment, f):
+        """Check that an indexed segment is still the file it was, and not a new one."""
+        if segment is None:
+            return False
+        if os.fstat(f.fileno()).st_size < segment['size']:
+            return False
+        if segment['head'] is None:
+            return segment['size'] == 0
+        size, digest = segment['head']
+        return hashlib.sha1(f.read(size)).hexdigest() == digest
+
+    @staticmethod
+    def _extend(segment, f):
+        """
+        Index the complete lines appended to a segment.
+
+        The last block is indexed again, since it may have been partial.
+        Returns True if blocks were added.
+        """
+        blocks = segment['blocks']
+        count = len(blocks)
+        offset, stamp = 0, None
+        if blocks:
+            offset = blocks.pop()[0]
+            stamp = blocks[-1][2] if blocks else None
+        f.seek(offset)
+        data = b''
+        while True:
+            read = f.read(settings.LOG_INDEX_BLOCK)
+            if not read:
+                # leave a line still being written for the next read
+                break
+            data += read
+            end = data.rfind(b'\n') + 1
+            if not end:
+                continue
+            chunk, data = data[:end], data[end:]
+            match = TIMESTAMP.match(chunk)
+            first = _timestamp(match) if match else stamp
+            stamps = TIMESTAMP.findall(chunk)
+            if stamps:
+                stamp = (stamps[-1][0] + b'T' + stamps[-1][1]).decode('ascii')
+            types = sorted(set(t.decode('ascii') for t in PROCESS.findall(chunk)))
+            blocks.append([offset, first, stamp, types])
+            offset += end
+            if segment['head'] is None:
+                head = chunk[:chunk.find(b'\n') + 1]
+                segment['head'] = [len(head), hashlib.sha1(head).hexdigest()]
+        segment['size'] = offset
+        return len(blocks) > count
+
+    def _load(self):
+        """Return this log's index, keeping at most ``LOG_INDEX_CACHE`` indexes in memory."""
+        path = self.index_path
+        index = _indexes.pop(path, None)
+        if index is None:
+            try:
+                with open(path) as f:
+                    index = json.load(f)
+            except (IOError, ValueError):
+                index = {}
+        _indexes[path] = index
+        while len(_indexes) > settings.LOG_INDEX_CACHE:
+            _indexes.popitem(last=False)
+        return index
+
+    def _save(self, index):
+        """Save an index, leaving it in memory only if the index directory is not writable."""
+        saved = dict((inode, dict((k, v) for k, v in segment.items()
+                                  if k not in ('path', 'inode')))
+                     for inode, segment in index.items())
+        path = self.index_path
+        try:
+            if not os.path.isdir(settings.LOG_INDEX_DIR):
+                os.makedirs(settings.LOG_INDEX_DIR)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(saved, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            logger.warning('Could not save the log index for {}: {}'.format(self.app_id, e))
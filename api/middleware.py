@@ -0,0 +1,28 @@
+"""
+Django middleware for the Deis API.
+"""
+
+from __future__ import unicode_literals
+
+from api.models import publish_queue
+
+
+class PublishMiddleware(object):
+    """
+    Publish app and formation databags at most once per request.
+
+    Apps and formations saved while handling a request are collected by
+    :data:`api.models.publish_queue` and published when the response is
+    returned, instead of once per save. Nothing is published for a request
+    that raised, since its changes may have been rolled back.
+    """
+
+    def process_request(self, request):
+        publish_queue.start()
+
+    def process_exception(self, request, exception):
+        publish_queue.abort()
+
+    def process_response(self, request, response):
+        publish_queue.stop()
+        return response
@@ -5,28 +5,41 @@ Data models for the Deis API.
 """
 
 from __future__ import unicode_literals
+from collections import Counter
+from collections import OrderedDict
+from collections import defaultdict
+from collections import deque
+import bisect
 import etcd
+import hashlib
+import heapq
 import importlib
+import json
 import logging
-import os
-import subprocess
+import random
+import threading
+import time
 
+from celery.canvas import chord
 from celery.canvas import group
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
 from django.db import models
+from django.db import transaction
+from django.db.models import Count
 from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.dispatch.dispatcher import Signal
 from django.utils.encoding import python_2_unicode_compatible
-from guardian.shortcuts import get_users_with_perms
+from guardian.models import GroupObjectPermission, UserObjectPermission
 from json_field.fields import JSONField  # @UnusedImport
 
-from api import fields, tasks
-from docker import publish_release
+from api import fields, logs, placement, tasks
 from provider import import_provider_module
-from utils import dict_diff, fingerprint
+from utils import config_hash, dict_diff, fingerprint
 
 
 logger = logging.getLogger(__name__)
@@ -34,6 +47,15 @@ logger = logging.getLogger(__name__)
 # import user-defined configuration management module
 CM = importlib.import_module(settings.CM_MODULE)
 
+# state that every controller process must agree on
+shared_cache = get_cache('shared')
+
+PLACEMENT_CHOICES = [(name, name) for name in sorted(placement.STRATEGIES)]
+
+# containers publish their port on the runtime node from this range
+CONTAINER_PORT_MIN = 10001
+CONTAINER_PORT_MAX = 65535
+
 
 # define custom signals
 release_signal = Signal(providing_args=['user', 'app'])
@@ -168,6 +190,8 @@ class Formation(UuidAuditedModel):
     id = models.SlugField(max_length=64, unique=True)
     domain = models.CharField(max_length=128, blank=True, null=True)
     nodes = JSONField(default='{}', blank=True)
+    placement = models.CharField(max_length=32, default='spread',
+                                 choices=PLACEMENT_CHOICES)
 
     class Meta:
         unique_together = (('owner', 'id'),)
@@ -190,24 +214,46 @@ class Formation(UuidAuditedModel):
         layer_tasks = [tasks.destroy_layer.si(l) for l in self.layer_set.all()]
         group(node_tasks).apply_async().join()
         group(layer_tasks).apply_async().join()
-        CM.purge_formation(self.flat())
+        _purge_databag(CM.purge_formation, self)
         self.delete()
 
     def publish(self):
         data = self.calculate()
-        CM.publish_formation(self.flat(), data)
+        _publish_databag(CM.publish_formation, self, data)
         return data
 
+    def scale(self, structure):
+        return Node.objects.scale(self, structure)
+
     def converge(self, **kwargs):
-        databag = self.publish()
-        nodes = self.node_set.all()
-        subtasks = []
-        for n in nodes:
-            subtask = tasks.converge_node.si(n)
-            subtasks.append(subtask)
-        group(*subtasks).apply_async().join()
+        databag = self.prepare_converge()
+        for _ in self.converge_nodes():
+            pass
         return databag
 
+    def prepare_converge(self):
+        """Publish the databags the nodes must see before they converge."""
+        # nodes must see any databags still waiting to be published
+        publish_queue.flush()
+        return self.publish()
+
+    def converge_nodes(self):
+        """
+        Converge every node in parallel, yielding each node as it finishes.
+
+        Nodes pull release images from the registry, so any images still
+        waiting to be published are chained ahead of the converge in Celery
+        rather than waited on here.
+        """
+        nodes = list(self.node_set.all())
+        images, job = publish_queue.publish_images(
+            then=group(*[tasks.converge_node.si(n) for n in nodes]))
+        by_result = dict(zip([r.id for r in job.results], nodes))
+        for result in _as_completed(job.results, waiting_on=images):
+            # raise the first failure, as joining the group would
+            result.get()
+            yield by_result[result.id]
+
     def calculate(self):
         """Return a representation of this formation for config management"""
         d = {}
@@ -215,24 +261,27 @@ class Formation(UuidAuditedModel):
         d['domain'] = self.domain
         d['nodes'] = {}
         proxies = []
-        for n in self.node_set.all():
+        for n in self.node_set.select_related('layer'):
             d['nodes'][n.id] = {'fqdn': n.fqdn,
                                 'runtime': n.layer.runtime,
                                 'proxy': n.layer.proxy}
             if n.layer.proxy is True:
                 proxies.append(n.fqdn)
-        d['apps'] = {}
-        for a in self.app_set.all():
-            d['apps'][a.id] = a.calculate()
+        apps = self.app_set.all()
+        d['apps'] = App.objects.calculate(apps)
+        containers = {}
+        for c in Container.objects.filter(app__in=apps).select_related('node').order_by('created'):
+            containers.setdefault(c.app_id, []).append(c)
+        for a in apps:
             d['apps'][a.id]['proxy'] = {}
             d['apps'][a.id]['proxy']['nodes'] = proxies
             d['apps'][a.id]['proxy']['algorithm'] = 'round_robin'
             d['apps'][a.id]['proxy']['port'] = 80
             d['apps'][a.id]['proxy']['backends'] = []
-            d['apps'][a.id]['containers'] = containers = {}
-            for c in a.container_set.all().order_by('created'):
-                containers.setdefault(c.type, {})
-                containers[c.type].update(
+            d['apps'][a.id]['containers'] = app_containers = {}
+            for c in containers.get(a.pk, []):
+                app_containers.setdefault(c.type, {})
+                app_containers[c.type].update(
                     {c.num: "{0}:{1}".format(c.node.id, c.port)})
                 if c.type == 'web':
                     d['apps'][a.id]['proxy']['backends'].append(
@@ -297,6 +346,26 @@ class Layer(UuidAuditedModel):
         return tasks.destroy_layer.delay(self).wait()
 
 
+def _as_completed(results, interval=0.5, waiting_on=()):
+    """
+    Yield Celery results in the order they finish.
+
+    :param waiting_on: results the tasks were chained behind; the first of
+                       them to fail is raised, as the tasks will never run
+    """
+    pending = list(results)
+    while pending:
+        finished = [r for r in pending if r.ready()]
+        for result in finished:
+            pending.remove(result)
+            yield result
+        if pending and not finished:
+            for result in waiting_on:
+                if result.failed():
+                    result.get()
+            time.sleep(interval)
+
+
 class NodeManager(models.Manager):
 
     def new(self, formation, layer, fqdn=None):
@@ -310,12 +379,16 @@ class NodeManager(models.Manager):
                            layer=layer,
                            num=next_num,
                            id="{0}-{1}-{2}".format(formation.id, layer.id, next_num),
-                           fqdn=fqdn)
+                           fqdn=fqdn,
+                           status={'phase': 'pending', 'started': time.time(), 'timings': {}})
         return node
 
     def scale(self, formation, structure, **kwargs):
         """Scale layers up or down to match requested structure."""
+        started = time.time()
         funcs = []
+        built = []
+        destroyed = []
         changed = False
         for layer_id, requested in structure.items():
             layer = formation.layer_set.get(id=layer_id)
@@ -325,59 +398,55 @@ class NodeManager(models.Manager):
                 continue
             while diff < 0:
                 node = nodes.pop(0)
+                destroyed.append(node)
                 funcs.append(tasks.destroy_node.si(node))
+                built.append(None)
                 diff = requested - len(nodes)
                 changed = True
             while diff > 0:
                 node = self.new(formation, layer)
                 nodes.append(node)
                 funcs.append(tasks.build_node.si(node))
+                built.append(node)
                 diff = requested - len(nodes)
                 changed = True
         # launch/terminate nodes in parallel
         if funcs:
-            group(*funcs).apply_async().join()
-        # always scale and balance every application
+            for node in destroyed:
+                node.set_phase('destroy')
+            job = group(*funcs).apply_async()
+            building = {result.id: node for result, node in zip(job.results, built)}
+            # schedule containers onto each new runtime node as soon as it is
+            # ready, rather than waiting for the slowest node in the group
+            for result in _as_completed(job.results):
+                result.get()
+                node = building.get(result.id)
+                if node and node.layer.runtime:
+                    self._schedule(formation)
+        # scale apps that lost containers, then balance once over every node
         if nodes:
-            for app in formation.app_set.all():
-                Container.objects.scale(app, app.containers)
-                Container.objects.balance(formation)
+            self._schedule(formation)
+            Container.objects.balance(formation)
         # save new structure now that scaling was successful
         formation.nodes.update(structure)
         formation.save()
         # force-converge nodes if there were new nodes or container rebalancing
         if changed:
+            log_event(formation, 'Nodes scaled ' + ' '.join(
+                "{}={}".format(k, v) for k, v in structure.items()),
+                type='scale', duration=time.time() - started, nodes=structure)
             return formation.converge()
         return formation.calculate()
 
-    def next_runtime_node(self, formation, container_type, reverse=False):
-        count = []
-        layers = formation.layer_set.filter(runtime=True)
-        runtime_nodes = []
-        for l in layers:
-            runtime_nodes.extend(Node.objects.filter(
-                formation=formation, layer=l).order_by('created'))
-        container_map = {n: [] for n in runtime_nodes}
-        containers = list(Container.objects.filter(
-            formation=formation, type=container_type).order_by('created'))
-        for c in containers:
-            container_map[c.node].append(c)
-        for n in container_map.keys():
-            # (2, node3), (2, node2), (3, node1)
-            count.append((len(container_map[n]), n))
-        if not count:
-            raise EnvironmentError('No nodes available for containers')
-        count.sort()
-        # reverse means order by greatest # of containers, otherwise fewest
-        if reverse:
-            count.reverse()
-        return count[0][1]
-
-    def next_runtime_port(self, formation):
-        containers = Container.objects.filter(formation=formation).order_by('-port')
-        if not containers:
-            return 10001
-        return containers[0].port + 1
+    def _schedule(self, formation):
+        """Scale the formation's apps whose containers don't match their structure."""
+        counts = defaultdict(Counter)
+        for app_id, container_type, count in Container.objects.filter(
+                formation=formation).order_by().values_list('app', 'type').annotate(Count('uuid')):
+            counts[app_id][container_type] = count
+        for app in formation.app_set.all():
+            if any(counts[app.pk][t] != n for t, n in app.containers.items()):
+                Container.objects.scale(app, app.containers)
 
 
 @python_2_unicode_compatible
@@ -409,6 +478,30 @@ class Node(UuidAuditedModel):
     def __str__(self):
         return self.id
 
+    @property
+    def ready(self):
+        """Whether containers can be scheduled on this node."""
+        return not self.status or self.status.get('phase') == 'ready'
+
+    def set_phase(self, phase, error=None):
+        """
+        Record the node's provisioning phase on its status.
+
+        A node moves through the pending, provision, wait-for-ssh, bootstrap
+        and ready phases, or to error. The seconds spent in the previous
+        phase are added to the status timings.
+        """
+        now = time.time()
+        status = dict(self.status or {})
+        timings = dict(status.get('timings', {}))
+        if 'phase' in status and 'started' in status:
+            timings[status['phase']] = round(now - float(status['started']), 3)
+        status.update(phase=phase, started=now, timings=timings)
+        if error is not None:
+            status['error'] = error
+        self.status = status
+        self.save(update_fields=['status'])
+
     def flat(self):
         return {'id': self.id,
                 'provider_type': self.layer.flavor.provider.type,
@@ -439,9 +532,158 @@ class Node(UuidAuditedModel):
         return tasks.run_node.delay(self, command).wait()
 
 
-def log_event(app, msg, level=logging.INFO):
-    msg = "{}: {}".format(app.id, msg)
-    logger.log(level, msg)
+def log_event(target, msg, level=logging.INFO, type='', user=None, release=None,
+              duration=None, **data):
+    """
+    Log an event to syslog and record it in the event log.
+
+    :param target: the :class:`App` or :class:`Formation` the event happened to
+    :param type: the kind of event, such as "scale" or "release"
+    :param user: the user who caused the event, if any
+    :param release: the release version the event concerns, if any
+    :param duration: how long the event took, in seconds
+    :param data: any other fields of the event
+    """
+    logger.log(level, "{}: {}".format(target.id, msg))
+    if isinstance(target, App):
+        formation_id, app_id = target.formation_id, target.pk
+    else:
+        formation_id, app_id = target.pk, None
+    Event.objects.record(formation_id, app_id, type, msg, user=user, release=release,
+                         duration=duration, data=data)
+
+
+class AppManager(models.Manager):
+
+    def for_user(self, user):
+        """
+        Return the apps a user owns or that are shared with them.
+
+        Superusers see every app. The pks of shared apps are read from the
+        user's object permissions up front rather than joined into the app
+        query, which keeps listing apps to one plain, indexable query.
+        """
+        if user.is_superuser:
+            return self.all()
+        ctype = ContentType.objects.get_for_model(self.model)
+        shared = UserObjectPermission.objects.filter(
+            content_type=ctype, user=user).values_list('object_pk', flat=True)
+        group_shared = GroupObjectPermission.objects.filter(
+            content_type=ctype, group__user=user).values_list('object_pk', flat=True)
+        return self.filter(models.Q(owner=user) |
+                           models.Q(pk__in=set(shared) | set(group_shared)))
+
+    def summarized(self, apps=None):
+        """
+        Return apps ready to be listed.
+
+        Owners and formations are joined in, and each app is annotated in
+        SQL with its ``container_count`` and the ``release_version`` of its
+        latest release, so listing apps doesn't query per app.
+
+        :param apps: a queryset of :class:`App`\s, or None for all of them
+        """
+        if apps is None:
+            apps = self.all()
+        app = self.model._meta.db_table
+        return apps.select_related('owner', 'formation').extra(select={
+            'container_count': 'SELECT COUNT(*) FROM {0} WHERE {0}.app_id = {1}.uuid'.format(
+                Container._meta.db_table, app),
+            'release_version': 'SELECT MAX(version) FROM {0} WHERE {0}.app_id = {1}.uuid'.format(
+                Release._meta.db_table, app),
+        })
+
+    def calculate(self, apps):
+        """
+        Return representations of many apps for configuration management.
+
+        Releases, configs, builds, containers, proxy nodes and sharing
+        permissions are fetched in bulk, so the number of queries stays
+        constant no matter how many apps are calculated.
+
+        :param apps: a queryset of :class:`App`\s to calculate
+        :returns: a dict of app representations keyed by app id
+        """
+        queryset, apps = apps, list(apps.select_related('owner', 'formation'))
+        releases = self._latest_releases(queryset)
+        containers = {}
+        for c in Container.objects.filter(app__in=queryset):
+            containers.setdefault(c.app_id, []).append(c)
+        # formations without a domain are addressed through their proxy nodes
+        proxies = {}
+        formations = set(a.formation_id for a in apps if not a.formation.domain)
+        if formations:
+            for n in Node.objects.filter(formation__in=formations, layer__proxy=True):
+                proxies.setdefault(n.formation_id, []).append(n)
+        users = self.shared_users([a.pk for a in apps])
+        data = {}
+        for a in apps:
+            d = {}
+            d['id'] = a.id
+            d['release'] = {}
+            release = releases.get(a.pk)
+            if release:
+                d['release']['version'] = release.version
+                d['release']['config'] = release.config.values
+                d['release']['build'] = {
+                    'image': release.build.image + ":v{}".format(release.version)}
+                if release.build.url:
+                    d['release']['build']['url'] = release.build.url
+                    d['release']['build']['procfile'] = release.build.procfile
+            d['containers'] = {}
+            for c in containers.get(a.pk, []):
+                d['containers'].setdefault(c.type, {})[str(c.num)] = c.status
+            d['domains'] = []
+            if a.formation.domain:
+                d['domains'].append('{}.{}'.format(a.id, a.formation.domain))
+            else:
+                for n in proxies.get(a.formation_id, []):
+                    d['domains'].append(n.fqdn)
+            # add proper sharing and access controls
+            d['users'] = {a.owner.username: 'owner'}
+            for username in users.get(a.pk, []):
+                d['users'][username] = 'user'
+            data[a.id] = d
+        return data
+
+    def _latest_releases(self, apps):
+        """Return the latest :class:`Release` of each app keyed by app pk."""
+        latest = dict(Release.objects.filter(app__in=apps).order_by().values('app').annotate(
+            latest=models.Max('version')).values_list('app', 'latest'))
+        releases = {}
+        for r in Release.objects.filter(app__in=apps, version__in=set(latest.values())) \
+                .select_related('config__blob', 'build'):
+            if latest[r.app_id] == r.version:
+                releases[r.app_id] = r
+        return releases
+
+    def shared_users(self, pks):
+        """Return the usernames each app is shared with, keyed by app pk."""
+        ctype = ContentType.objects.get_for_model(self.model)
+        perms = UserObjectPermission.objects.filter(
+            content_type=ctype, object_pk__in=pks).values_list('object_pk', 'user__username')
+        group_perms = GroupObjectPermission.objects.filter(
+            content_type=ctype, object_pk__in=pks).values_list(
+            'object_pk', 'group__user__username')
+        users = dict((pk, set()) for pk in pks)
+        for pk, username in list(perms) + list(group_perms):
+            if username is not None:
+                users[pk].add(username)
+        return users
+
+    def is_shared(self, pk, user):
+        """
+        Return True if an app is shared with a user.
+
+        Sharing is read from guardian's tables on every check, keyed on the
+        user's pk, so a permission revoked by any process applies at once.
+        Group permissions are only looked up for users not granted directly.
+        """
+        ctype = ContentType.objects.get_for_model(self.model)
+        return (UserObjectPermission.objects.filter(
+                user_id=user.pk, content_type=ctype, object_pk=pk).exists() or
+                GroupObjectPermission.objects.filter(
+                group__user=user.pk, content_type=ctype, object_pk=pk).exists())
 
 
 @python_2_unicode_compatible
@@ -450,10 +692,16 @@ class App(UuidAuditedModel):
     Application used to service requests on behalf of end-users
     """
 
+    objects = AppManager()
+
     owner = models.ForeignKey(settings.AUTH_USER_MODEL)
     id = models.SlugField(max_length=64, unique=True)
     formation = models.ForeignKey('Formation')
     containers = JSONField(default='{}', blank=True)
+    # placement strategy, blank to use the formation's
+    placement = models.CharField(max_length=32, blank=True, choices=PLACEMENT_CHOICES)
+    # memory in MB per container type, for packing placement
+    memory = JSONField(default='{}', blank=True)
 
     class Meta:
         permissions = (('use_app', 'Can use app'),)
@@ -466,6 +714,14 @@ class App(UuidAuditedModel):
                 'formation': self.formation.id,
                 'containers': dict(self.containers)}
 
+    def shared_users(self):
+        """Return the usernames this app is shared with."""
+        return App.objects.shared_users([self.pk])[self.pk]
+
+    def has_user(self, user):
+        """Return True if a user owns this app or it is shared with them."""
+        return user.pk == self.owner_id or App.objects.is_shared(self.pk, user)
+
     def build(self):
         config = Config.objects.create(
             version=1, owner=self.owner, app=self, values={})
@@ -475,14 +731,14 @@ class App(UuidAuditedModel):
         self.formation.publish()
 
     def destroy(self):
-        CM.purge_app(self.flat())
+        _purge_databag(CM.purge_app, self)
         self.delete()
         self.formation.publish()
 
     def publish(self):
         """Publish the application to configuration management"""
         data = self.calculate()
-        CM.publish_app(self.flat(), data)
+        _publish_databag(CM.publish_app, self, data)
         return data
 
     def converge(self):
@@ -492,42 +748,23 @@ class App(UuidAuditedModel):
 
     def calculate(self):
         """Return a representation for configuration management"""
-        d = {}
-        d['id'] = self.id
-        d['release'] = {}
-        releases = self.release_set.all().order_by('-created')
-        if releases:
-            release = releases[0]
-            d['release']['version'] = release.version
-            d['release']['config'] = release.config.values
-            d['release']['build'] = {'image': release.build.image + ":v{}".format(release.version)}
-            if release.build.url:
-                d['release']['build']['url'] = release.build.url
-                d['release']['build']['procfile'] = release.build.procfile
-        d['containers'] = {}
-        containers = self.container_set.all()
-        if containers:
-            for c in containers:
-                d['containers'].setdefault(c.type, {})[str(c.num)] = c.status
-        d['domains'] = []
-        if self.formation.domain:
-            d['domains'].append('{}.{}'.format(self.id, self.formation.domain))
-        else:
-            for n in self.formation.node_set.filter(layer__proxy=True):
-                d['domains'].append(n.fqdn)
-        # add proper sharing and access controls
-        d['users'] = {self.owner.username: 'owner'}
-        for u in (get_users_with_perms(self)):
-            d['users'][u.username] = 'user'
-        return d
+        return App.objects.calculate(App.objects.filter(pk=self.pk))[self.id]
 
-    def logs(self):
-        """Return aggregated log data for this application."""
-        path = os.path.join(settings.DEIS_LOG_DIR, self.id + '.log')
-        if not os.path.exists(path):
-            raise EnvironmentError('Could not locate logs')
-        data = subprocess.check_output(['tail', '-n', str(settings.LOG_LINES), path])
-        return data
+    def logs(self, since=None, types=None, lines=None, cursor=None):
+        """
+        Return a page of aggregated log data for this application.
+
+        See :meth:`LogStore.read() <api.logs.LogStore.read>` for the query.
+        """
+        return logs.LogStore(self.id).read(since, types, lines, cursor)
+
+    def follow_logs(self, cursor, types=None):
+        """
+        Return an iterator of the log lines written after a cursor.
+
+        See :meth:`LogStore.follow() <api.logs.LogStore.follow>`.
+        """
+        return logs.LogStore(self.id).follow(cursor, types)
 
     def run(self, command):
         """Run a one-off command in an ephemeral app container."""
@@ -543,107 +780,318 @@ class App(UuidAuditedModel):
         docker_args = ' '.join(['-a', 'stdout', '-a', 'stderr', '-rm', image])
         env_args = ' '.join(["-e '{k}={v}'".format(**locals())
                              for k, v in release.config.values.items()])
-        log_event(self, "deis run '{}'".format(command))
+        log_event(self, "deis run '{}'".format(command), type='run', command=command)
         command = "sudo docker run {env_args} {docker_args} {command}".format(**locals())
         return node.run(command)
 
 
-class ContainerManager(models.Manager):
+class PortAllocator(object):
+    """
+    Hand out a formation's free container ports, lowest first.
 
-    def scale(self, app, structure, **kwargs):
-        """Scale containers up or down to match requested."""
-        requested_containers = structure.copy()
-        formation = app.formation
-        # increment new container nums off the most recent container
-        all_containers = app.container_set.all().order_by('-created')
-        container_num = 1 if not all_containers else all_containers[0].num + 1
-        msg = 'Containers scaled ' + ' '.join(
-            "{}={}".format(k, v) for k, v in requested_containers.items())
-        # iterate and scale by container type (web, worker, etc)
+    Free ports are kept as a sorted list of inclusive [start, end] ranges,
+    so ports released by deleted containers are reused before the range
+    grows, and allocating n ports walks the ranges once.
+    """
+
+    def __init__(self, used=(), first=CONTAINER_PORT_MIN, last=CONTAINER_PORT_MAX):
+        self.free = []
+        start = first
+        for port in sorted(set(used)):
+            if port < first or port > last:
+                continue
+            if port > start:
+                self.free.append([start, port - 1])
+            start = port + 1
+        if start <= last:
+            self.free.append([start, last])
+
+    def allocate(self, count=1):
+        """
+        Return the lowest count free ports and mark them used.
+
+        :raises EnvironmentError: if fewer than count ports are free
+        """
+        if count > sum(end - start + 1 for start, end in self.free):
+            raise EnvironmentError('No ports available for containers')
+        ports = []
+        while len(ports) < count:
+            r = self.free[0]
+            take = min(count - len(ports), r[1] - r[0] + 1)
+            ports.extend(range(r[0], r[0] + take))
+            r[0] += take
+            if r[0] > r[1]:
+                self.free.pop(0)
+        return ports
+
+    def release(self, port):
+        """Return a port to the free ranges, merging it with its neighbours."""
+        i = bisect.bisect(self.free, [port, port])
+        if i and self.free[i - 1][1] >= port:
+            return
+        if i < len(self.free) and self.free[i][0] <= port:
+            return
+        if i and self.free[i - 1][1] == port - 1:
+            self.free[i - 1][1] = port
+            if i < len(self.free) and self.free[i][0] == port + 1:
+                self.free[i - 1][1] = self.free.pop(i)[1]
+        elif i < len(self.free) and self.free[i][0] == port + 1:
+            self.free[i][0] = port
+        else:
+            self.free.insert(i, [port, port])
+
+
+class ContainerScheduler(object):
+    """
+    Place containers on a formation's ready runtime nodes.
+
+    Construct it inside a transaction: the formation row is locked so that
+    concurrent schedulers cannot hand out the same ports.
+
+    Node occupancy, memory use and the ports in use are loaded once.
+    Placement is then decided in memory by each app's strategy from
+    :mod:`api.placement`. Strategies that rank nodes by container count
+    keep a heap per container type, so scaling by n containers costs
+    O(n log m) for m nodes instead of a round of queries per container. The
+    resulting deletes, moves and creates are written in bulk by
+    :meth:`commit`.
+    """
+
+    def __init__(self, formation):
+        self.formation = formation
+        # serialize scheduling per formation to honour the unique ports
+        list(Formation.objects.select_for_update().filter(pk=formation.pk).values_list('pk'))
+        self.nodes = [n for n in formation.node_set.filter(
+            layer__runtime=True).select_related('layer__flavor').order_by('created')
+            if n.ready]
+        self.rank = {n.pk: i for i, n in enumerate(self.nodes)}
+        self.layers = OrderedDict()
+        for n in self.nodes:
+            self.layers.setdefault(n.layer_id, []).append(n)
+        self.layer_rank = {l: i for i, l in enumerate(self.layers)}
+        self.layer_of = {n.pk: n.layer_id for n in self.nodes}
+        self.strategies = {}
+        self.memory = {}
+        for app in App.objects.filter(formation=formation).only('uuid', 'placement', 'memory'):
+            self.strategies[app.pk] = app.placement or formation.placement
+            self.memory[app.pk] = dict(app.memory)
+        self.counts = defaultdict(Counter)
+        self.layer_counts = defaultdict(Counter)
+        self.app_counts = defaultdict(Counter)
+        self.totals = Counter()
+        self.used = Counter()
+        ports = []
+        for app_id, container_type, node_id, port in Container.objects.filter(
+                formation=formation).values_list('app_id', 'type', 'node_id', 'port'):
+            self.record(app_id, container_type, node_id, 1)
+            ports.append(port)
+        self.ports = PortAllocator(ports)
+        self.creates = []
+        self.deletes = []
+        self.moves = []
+        self._heaps = {}
+
+    def record(self, app_id, container_type, node_id, delta):
+        """Account for delta containers of an app's type on a node."""
+        self.counts[container_type][node_id] += delta
+        self.app_counts[app_id, container_type][node_id] += delta
+        self.totals[node_id] += delta
+        self.used[node_id] += delta * self.weight(app_id, container_type)
+        if node_id in self.layer_of:
+            self.layer_counts[container_type][self.layer_of[node_id]] += delta
+
+    def weight(self, app_id, container_type):
+        """Return the memory in MB of one of an app's containers."""
+        return placement.container_memory(self.memory.get(app_id, {}), container_type)
+
+    def capacity(self, node):
+        """Return the memory in MB of a node."""
+        return placement.node_memory(node.layer.flavor.params)
+
+    def best(self, key, nodes, rank):
+        """
+        Return the node with the lowest rank from a cached heap.
+
+        Ranks may only grow while the heap is cached, so a stale entry at
+        the top is refreshed and pushed back until the top is current.
+        Removing containers drops every cached heap.
+        """
+        heap = self._heaps.get(key)
+        if heap is None:
+            heap = self._heaps[key] = [(rank(n), self.rank[n.pk], n) for n in nodes]
+            heapq.heapify(heap)
+        while True:
+            current, order, node = heap[0]
+            fresh = rank(node)
+            if fresh == current:
+                return node
+            heapq.heapreplace(heap, (fresh, order, node))
+
+    def scale(self, app, structure):
+        """
+        Schedule the creates and deletes that scale an app to structure.
+
+        :returns: True if any container type changed
+        """
+        containers = defaultdict(list)
+        next_num = 1
+        for pk, container_type, node_id, num, port in app.container_set.order_by(
+                'created').values_list('uuid', 'type', 'node_id', 'num', 'port'):
+            containers[container_type].append((pk, node_id, port))
+            next_num = max(next_num, num + 1)
         changed = False
-        for container_type in requested_containers.keys():
-            containers = list(app.container_set.filter(type=container_type).order_by('created'))
-            requested = requested_containers.pop(container_type)
-            diff = requested - len(containers)
+        for container_type, requested in structure.items():
+            diff = requested - len(containers[container_type])
             if diff == 0:
                 continue
             changed = True
-            while diff < 0:
-                # get the next node with the most containers
-                node = Node.objects.next_runtime_node(
-                    formation, container_type, reverse=True)
-                # delete a container attached to that node
-                for c in containers:
-                    if node == c.node:
-                        containers.remove(c)
-                        c.delete()
-                        diff += 1
-                        break
-            while diff > 0:
-                # get the next node with the fewest containers
-                node = Node.objects.next_runtime_node(formation, container_type)
-                port = Node.objects.next_runtime_port(formation)
-                c = Container.objects.create(owner=app.owner,
-                                             formation=formation,
-                                             node=node,
-                                             app=app,
-                                             type=container_type,
-                                             num=container_num,
-                                             port=port)
-                containers.append(c)
-                container_num += 1
-                diff -= 1
-        log_event(app, msg)
+            if diff < 0:
+                self.remove(app, container_type, containers[container_type], -diff)
+                continue
+            for port in self.ports.allocate(diff):
+                node = self.place(app, container_type)
+                self.record(app.pk, container_type, node.pk, 1)
+                self.creates.append(Container(owner=app.owner,
+                                              formation=self.formation,
+                                              node=node,
+                                              app=app,
+                                              type=container_type,
+                                              num=next_num,
+                                              port=port))
+                next_num += 1
         return changed
 
-    def balance(self, formation, **kwargs):
-        runtime_nodes = formation.node_set.filter(layer__runtime=True).order_by('created')
-        all_containers = self.filter(formation=formation).order_by('-created')
-        # get the next container number (e.g. web.19)
-        container_num = 1 if not all_containers else all_containers[0].num + 1
-        changed = False
-        app = None
-        # iterate by unique container type
-        for container_type in set([c.type for c in all_containers]):
-            # map node container counts => { 2: [b3, b4], 3: [ b1, b2 ] }
-            n_map = {}
-            for node in runtime_nodes:
-                ct = len(node.container_set.filter(type=container_type))
-                n_map.setdefault(ct, []).append(node)
-            # loop until diff between min and max is 1 or 0
-            while max(n_map.keys()) - min(n_map.keys()) > 1:
-                # get the most over-utilized node
-                n_max = max(n_map.keys())
-                n_over = n_map[n_max].pop(0)
-                if len(n_map[n_max]) == 0:
-                    del n_map[n_max]
-                # get the most under-utilized node
-                n_min = min(n_map.keys())
-                n_under = n_map[n_min].pop(0)
-                if len(n_map[n_min]) == 0:
-                    del n_map[n_min]
-                # delete the oldest container from the most over-utilized node
-                c = n_over.container_set.filter(type=container_type).order_by('created')[0]
-                app = c.app  # pull ref to app for recreating the container
-                c.delete()
-                # create a container on the most under-utilized node
-                self.create(owner=formation.owner,
-                            formation=formation,
-                            app=app,
-                            type=container_type,
-                            num=container_num,
-                            node=n_under,
-                            port=Node.objects.next_runtime_port(formation))
-                container_num += 1
-                # update the n_map accordingly
-                for n in (n_over, n_under):
-                    ct = len(n.container_set.filter(type=container_type))
-                    n_map.setdefault(ct, []).append(n)
-                changed = True
-        if app:
-            log_event(app, 'Containers balanced')
+    def place(self, app, container_type):
+        """Return the runtime node the app's strategy picks for a container."""
+        if not self.nodes:
+            raise EnvironmentError('No nodes available for containers')
+        strategy = placement.STRATEGIES[app.placement or self.formation.placement]
+        return strategy(self, app, container_type)
+
+    def remove(self, app, container_type, containers, count):
+        """
+        Schedule deletes for count of an app's containers.
+
+        Containers are taken from the nodes with the most containers of the
+        type, oldest container first.
+
+        :param containers: the app's (uuid, node id, port) of the type, oldest first
+        """
+        by_node = defaultdict(deque)
+        for pk, node_id, port in containers:
+            by_node[node_id].append((pk, port))
+        counts = self.counts[container_type]
+        # prefer later nodes, and nodes that are no longer ready, on ties
+        heap = [(-counts[node_id], -self.rank.get(node_id, len(self.nodes)), node_id)
+                for node_id in by_node]
+        heapq.heapify(heap)
+        for _ in range(count):
+            _, rank, node_id = heapq.heappop(heap)
+            pk, port = by_node[node_id].popleft()
+            self.deletes.append(pk)
+            self.ports.release(port)
+            self.record(app.pk, container_type, node_id, -1)
+            if by_node[node_id]:
+                heapq.heappush(heap, (-counts[node_id], rank, node_id))
+        # cached placement heaps are now out of date
+        self._heaps.clear()
+
+    def balance(self):
+        """
+        Plan the moves that spread each container type evenly over the nodes.
+
+        The target count for every node is computed in one pass, and the
+        nodes already holding the most containers of a type keep the
+        remainder, so the plan moves as few containers as possible. Each
+        move keeps the container's number and port.
+
+        Containers of apps that pack their nodes are left where they are.
+
+        :returns: a list of moves, one dict per container
+        """
+        if not self.nodes:
+            return []
+        by_type = defaultdict(lambda: defaultdict(deque))
+        for c in Container.objects.filter(
+                formation=self.formation, node__in=self.nodes).order_by('created').values(
+                'uuid', 'app', 'app__id', 'type', 'node', 'num'):
+            if self.strategies[c['app']] not in placement.PACKED:
+                by_type[c['type']][c['node']].append(c)
+        plan = []
+        for container_type, by_node in sorted(by_type.items()):
+            total = sum(len(containers) for containers in by_node.values())
+            base, extra = divmod(total, len(self.nodes))
+            nodes = sorted(self.nodes, key=lambda n: (-len(by_node[n.pk]), self.rank[n.pk]))
+            surplus, deficit = [], []
+            for i, node in enumerate(nodes):
+                target = base + 1 if i < extra else base
+                held = by_node[node.pk]
+                # move the oldest containers off over-utilized nodes
+                while len(held) > target:
+                    surplus.append((held.popleft(), node))
+                deficit.extend([node] * (target - len(held)))
+            for (c, source), node in zip(surplus, deficit):
+                self.moves.append((c['uuid'], node))
+                self.record(c['app'], container_type, source.pk, -1)
+                self.record(c['app'], container_type, node.pk, 1)
+                plan.append({'app': c['app__id'],
+                             'container': '{}.{}'.format(container_type, c['num']),
+                             'from': source.id,
+                             'to': node.id})
+        self._heaps.clear()
+        return plan
+
+    def commit(self):
+        """Write the scheduled deletes, moves and creates in one transaction."""
+        with transaction.atomic():
+            for i in range(0, len(self.deletes), 500):
+                Container.objects.filter(uuid__in=self.deletes[i:i + 500]).delete()
+            moves = defaultdict(list)
+            for pk, node in self.moves:
+                moves[node].append(pk)
+            for node, pks in moves.items():
+                for i in range(0, len(pks), 500):
+                    Container.objects.filter(uuid__in=pks[i:i + 500]).update(node=node)
+            Container.objects.bulk_create(self.creates)
+        self.creates, self.deletes, self.moves = [], [], []
+
+
+class ContainerManager(models.Manager):
+
+    def scale(self, app, structure, **kwargs):
+        """Scale containers up or down to match requested."""
+        msg = 'Containers scaled ' + ' '.join(
+            "{}={}".format(k, v) for k, v in structure.items())
+        started = time.time()
+        with transaction.atomic():
+            scheduler = ContainerScheduler(app.formation)
+            changed = scheduler.scale(app, structure)
+            scheduler.commit()
+        log_event(app, msg, type='scale', duration=time.time() - started,
+                  containers=structure)
         return changed
 
+    def balance(self, formation, dry_run=False, **kwargs):
+        """
+        Spread containers evenly across a formation's ready runtime nodes.
+
+        :param dry_run: return the move plan without applying it
+        :returns: the list of container moves
+        """
+        started = time.time()
+        with transaction.atomic():
+            scheduler = ContainerScheduler(formation)
+            plan = scheduler.balance()
+            if plan and not dry_run:
+                scheduler.commit()
+        if plan and not dry_run:
+            duration = time.time() - started
+            moves = Counter(m['app'] for m in plan)
+            for app in App.objects.filter(id__in=moves):
+                log_event(app, 'Containers balanced', type='balance', duration=duration,
+                          moves=moves[app.id])
+        return plan
+
 
 @python_2_unicode_compatible
 class Container(UuidAuditedModel):
@@ -676,6 +1124,36 @@ class Container(UuidAuditedModel):
         ordering = ['created']
         unique_together = (('app', 'type', 'num'),
                            ('formation', 'port'))
+        # an app's history is listed a page at a time by (created, uuid)
+        index_together = (('app', 'created', 'uuid'),)
+
+
+class ConfigBlobManager(models.Manager):
+
+    def store(self, values):
+        """
+        Return the blob holding a set of config values.
+
+        A blob is only created for values no config has held before, so
+        configs with the same values share one copy of them.
+        """
+        blob, _ = self.get_or_create(hash=config_hash(values), defaults={'values': values})
+        return blob
+
+
+@python_2_unicode_compatible
+class ConfigBlob(AuditedModel):
+    """
+    Set of config values stored once, under the hash of its content.
+    """
+
+    objects = ConfigBlobManager()
+
+    hash = models.CharField(max_length=40, primary_key=True)
+    values = JSONField(default='{}', blank=True)
+
+    def __str__(self):
+        return self.hash
 
 
 @python_2_unicode_compatible
@@ -689,16 +1167,53 @@ class Config(UuidAuditedModel):
     app = models.ForeignKey('App')
     version = models.PositiveIntegerField()
 
-    values = JSONField(default='{}', blank=True)
+    # values are stored once per distinct set, in the hash column
+    blob = models.ForeignKey('ConfigBlob', db_column='hash')
+
+    _values = None
 
     class Meta:
         get_latest_by = 'created'
         ordering = ['-created']
         unique_together = (('app', 'version'),)
+        index_together = (('app', 'created', 'uuid'),)
 
     def __str__(self):
         return "{0}-v{1}".format(self.app.id, self.version)
 
+    @property
+    def hash(self):
+        """The hash of the config values, equal only for equal values."""
+        return self.blob_id
+
+    @property
+    def values(self):
+        """
+        The config values.
+
+        They're read from the blob, so load it with ``select_related`` when
+        listing configs. Changes to the values, even in place, are stored in
+        a new blob when the config is saved.
+        """
+        if self._values is None and self.blob_id:
+            # a copy, so changing the values never changes the shared blob
+            self._values = dict(self.blob.values)
+        return self._values if self._values is not None else {}
+
+    @values.setter
+    def values(self, values):
+        self._values = ConfigBlob._meta.get_field('values').to_python(values)
+        # the values are stored in a blob when the config is saved
+        self.blob_id = None
+        self.__dict__.pop(Config.blob.cache_name, None)
+
+    def save(self, *args, **kwargs):
+        # loaded values may have been changed in place since they were read
+        if not self.blob_id or (self._values is not None and
+                                config_hash(self._values) != self.blob_id):
+            self.blob = ConfigBlob.objects.store(self.values)
+        super(Config, self).save(*args, **kwargs)
+
 
 @python_2_unicode_compatible
 class Push(UuidAuditedModel):
@@ -750,10 +1265,51 @@ class Build(UuidAuditedModel):
         get_latest_by = 'created'
         ordering = ['-created']
         unique_together = (('app', 'uuid'),)
+        index_together = (('app', 'created', 'uuid'),)
 
     def __str__(self):
         return "{0}-{1}".format(self.app.id, self.sha[:7])
 
+    def deploy(self, operation=None):
+        """
+        Release, publish and converge a new build.
+
+        :param operation: the :class:`Operation` running the deploy, which
+                          records a progress event as each stage starts and ends
+        :returns: the application databag
+        """
+        app = self.app
+
+        def progress(stage, state, **event):
+            if operation is not None:
+                operation.record_progress(dict(event, stage=stage, state=state))
+        started = deployed = time.time()
+        progress('release', 'started')
+        # create a new release
+        release_signal.send(sender=self, build=self, app=app, user=self.owner)
+        # see if we need to scale an initial web container
+        if len(app.formation.node_set.filter(layer__runtime=True)) > 0 and \
+           len(app.container_set.filter(type='web')) < 1:
+            # scale an initial web containers
+            Container.objects.scale(app, {'web': 1})
+        version = app.release_set.latest().version
+        progress('release', 'finished', elapsed=time.time() - started, version=version)
+        # publish the application databag and image
+        started = time.time()
+        progress('publish', 'started')
+        app.publish()
+        app.formation.prepare_converge()
+        progress('publish', 'finished', elapsed=time.time() - started)
+        # converge the formation's nodes
+        started = time.time()
+        progress('converge', 'started')
+        for node in app.formation.converge_nodes():
+            progress('converge', 'progress', node=node.id, elapsed=time.time() - started)
+        progress('converge', 'finished', elapsed=time.time() - started)
+        log_event(app, "Build {} deployed".format(self), type='deploy',
+                  user=self.owner, release=version, duration=time.time() - deployed)
+        return app.calculate()
+
 
 @python_2_unicode_compatible
 class Release(UuidAuditedModel):
@@ -774,6 +1330,7 @@ class Release(UuidAuditedModel):
     class Meta:
         get_latest_by = 'created'
         ordering = ['-created']
+        # the unique index on (app, version) also serves listing releases
         unique_together = (('app', 'version'),)
 
     def __str__(self):
@@ -785,7 +1342,7 @@ class Release(UuidAuditedModel):
 
         :return: the previous :class:`Release`, or None
         """
-        releases = self.app.release_set
+        releases = self.app.release_set.select_related('config__blob', 'build')
         if self.pk:
             releases = releases.exclude(pk=self.pk)
         try:
@@ -796,18 +1353,38 @@ class Release(UuidAuditedModel):
         return prev_release
 
     def save(self, *args, **kwargs):
+        """
+        Save the release, summarizing how it differs from the previous one.
+
+        :param previous: the previous :class:`Release`, with its build and
+            config loaded, to save looking it up again
+        """
+        prev_release = kwargs.pop('previous', None)
         if not self.summary:
-            self.summary = ''
-            prev_release = self.previous()
-            # compare this build to the previous build
-            old_build = prev_release.build if prev_release else None
-            # if the build changed, log it and who pushed it
-            if self.build != old_build and self.build.sha:
-                self.summary += "{} deployed {}".format(self.build.owner, self.build.sha[:7])
-            # compare this config to the previous config
+            self.summary = self.summarize(prev_release or self.previous())
+        super(Release, self).save(*args, **kwargs)
+
+    def summarize(self, prev_release):
+        """
+        Return a text summary of what changed since a previous release.
+
+        Builds and configs are compared by key and configs then by hash, so
+        their values are only loaded and diffed when they really changed.
+
+        :param prev_release: the previous :class:`Release`, or None
+        """
+        summary = ''
+        # if the build changed, log it and who pushed it
+        old_build_id = prev_release.build_id if prev_release else None
+        if self.build_id != old_build_id and self.build.sha:
+            summary += "{} deployed {}".format(self.build.owner, self.build.sha[:7])
+        # if the config data changed, log the dict diff
+        old_config_id = prev_release.config_id if prev_release else None
+        if self.config_id != old_config_id:
             old_config = prev_release.config if prev_release else None
-            # if the config data changed, log the dict diff
-            if self.config != old_config:
+            changes = ''
+            # configs with the same hash hold the same values
+            if not (old_config and old_config.hash and old_config.hash == self.config.hash):
                 dict1 = self.config.values
                 dict2 = old_config.values if old_config else {}
                 diff = dict_diff(dict1, dict2)
@@ -819,16 +1396,16 @@ class Release(UuidAuditedModel):
                 deleted = ', '.join(k for k in diff.get('deleted', {}))
                 deleted = 'deleted ' + deleted if deleted else ''
                 changes = ', '.join(i for i in (added, changed, deleted) if i)
-                if changes:
-                    if self.summary:
-                        self.summary += ' and '
-                    self.summary += "{} {}".format(self.config.owner, changes)
-                if not self.summary:
-                    if self.version == 1:
-                        self.summary = "{} created the initial release".format(self.owner)
-                    else:
-                        self.summary = "{} changed nothing".format(self.owner)
-        super(Release, self).save(*args, **kwargs)
+            if changes:
+                if summary:
+                    summary += ' and '
+                summary += "{} {}".format(self.config.owner, changes)
+            if not summary:
+                if self.version == 1:
+                    summary = "{} created the initial release".format(self.owner)
+                else:
+                    summary = "{} changed nothing".format(self.owner)
+        return summary
 
 
 @receiver(release_signal)
@@ -840,7 +1417,7 @@ def new_release(sender, **kwargs):
     Releases start at v1 and auto-increment.
     """
     user, app, = kwargs['user'], kwargs['app']
-    last_release = app.release_set.latest()
+    last_release = app.release_set.select_related('config__blob', 'build').latest()
     config = kwargs.get('config', last_release.config)
     build = kwargs.get('build', last_release.build)
     # overwrite config with build.config if the keys don't exist
@@ -857,39 +1434,315 @@ def new_release(sender, **kwargs):
                 app=app, values=new_values)
     # create new release and auto-increment version
     new_version = last_release.version + 1
-    release = Release.objects.create(
-        owner=user, app=app, config=config,
-        build=build, version=new_version)
+    release = Release(owner=user, app=app, config=config,
+                      build=build, version=new_version)
+    release.save(force_insert=True, previous=last_release)
     # publish release to registry as new docker image
     if settings.REGISTRY_URL:
         repository_path = "{}/{}".format(user.username, app.id)
         tag = 'v{}'.format(new_version)
-        publish_release(repository_path, config.values, tag)
+        publish_image(repository_path, config.values, tag)
     return release
 
 
+def publish_image(repository_path, config, tag):
+    """
+    Publish a release image in a Celery worker.
+
+    The API call returns without waiting on the registry; the next
+    formation converge publishes the image before nodes pull it. Outside
+    a request, the image is published at once.
+    """
+    signature = tasks.publish_release.si(repository_path, config, tag)
+    if not publish_queue.add_image(signature):
+        signature.apply_async()
+
+
+class OperationManager(models.Manager):
+
+    def start(self, owner, obj, method, *args, **kwargs):
+        """
+        Run a model method in a Celery worker on behalf of an API client.
+
+        :param obj: the model instance whose method is run
+        :param method: the name of the method to run
+        :param track: pass the operation to the method as ``operation``, so
+                      it can record its progress
+        :returns: the new :class:`Operation`, which the client polls
+        """
+        track = kwargs.pop('track', False)
+        operation = self.create(
+            owner=owner, action='{}.{}'.format(obj._meta.model_name, method),
+            target=str(obj))
+        if track:
+            kwargs['operation'] = operation
+        tasks.run_operation.apply_async(
+            args=[operation, obj, method, args, kwargs], task_id=str(operation.uuid))
+        return operation
+
+
+@python_2_unicode_compatible
+class Operation(UuidAuditedModel):
+    """
+    A long-running API action, such as a scale or converge.
+
+    The operation's uuid doubles as its Celery task id, so a running
+    operation's state comes from the Celery result backend. Its outcome
+    is recorded here once it finishes.
+    """
+
+    objects = OperationManager()
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL)
+    action = models.CharField(max_length=64)
+    target = models.CharField(max_length=128)
+    state = models.CharField(max_length=16, default='PENDING')
+    result = JSONField(blank=True, null=True)
+    # events recorded by methods that report their progress
+    progress = JSONField(default='[]', blank=True)
+
+    class Meta:
+        get_latest_by = 'created'
+        ordering = ['-created']
+
+    def __str__(self):
+        return "{}-{}".format(self.action, self.uuid)
+
+    @property
+    def ready(self):
+        return self.state in ('SUCCESS', 'FAILURE')
+
+    def refresh(self):
+        """
+        Reconcile an unfinished operation with its Celery result.
+
+        A task that died without recording its outcome, for instance because
+        its worker was killed, is marked as failed.
+        """
+        if not self.ready:
+            result = tasks.run_operation.AsyncResult(str(self.uuid))
+            if result.state in ('FAILURE', 'REVOKED'):
+                self.record('FAILURE', str(result.result))
+        return self
+
+    def record(self, state, result=None):
+        self.state = state
+        self.result = result
+        self.save(update_fields=['state', 'result', 'updated'])
+
+    def record_progress(self, event):
+        self.progress = list(self.progress) + [event]
+        self.save(update_fields=['progress', 'updated'])
+
+
+class EventManager(models.Manager):
+
+    def record(self, formation_id, app_id, type, message, **kwargs):
+        """
+        Record an event, now and then dropping the oldest beyond ``EVENT_LOG_SIZE``.
+
+        The event log is a ring buffer: each app keeps its latest events,
+        and so does each formation for the events of no app. Trimming takes
+        its own queries, so it runs on about one in ``EVENT_LOG_TRIM_INTERVAL``
+        inserts and a log may hold that many events over its size.
+        """
+        event = self.create(formation_id=formation_id, app_id=app_id, type=type,
+                            message=message, **kwargs)
+        if random.randrange(settings.EVENT_LOG_TRIM_INTERVAL) == 0:
+            self.trim(formation_id, app_id)
+        return event
+
+    def trim(self, formation_id, app_id):
+        """Drop the events of an app or formation beyond ``EVENT_LOG_SIZE``."""
+        events = self.filter(formation=formation_id, app=app_id)
+        oldest = events.order_by('-created').values_list('created', flat=True)[
+            settings.EVENT_LOG_SIZE:settings.EVENT_LOG_SIZE + 1]
+        if oldest:
+            events.filter(created__lte=oldest[0]).delete()
+
+
+@python_2_unicode_compatible
+class Event(UuidAuditedModel):
+    """
+    A structured record of something that happened to an app or formation,
+    such as a scale, a build or a release.
+    """
+
+    objects = EventManager()
+
+    formation = models.ForeignKey('Formation')
+    app = models.ForeignKey('App', blank=True, null=True)
+    type = models.CharField(max_length=32, blank=True)
+    message = models.TextField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True)
+    release = models.PositiveIntegerField(blank=True, null=True)
+    duration = models.FloatField(blank=True, null=True)
+    data = JSONField(default='{}', blank=True)
+
+    class Meta:
+        get_latest_by = 'created'
+        ordering = ['-created']
+        index_together = (('formation', 'app', 'created'),)
+
+    def __str__(self):
+        return "{}-{}".format(self.type, self.uuid)
+
+
 # define update/delete callbacks for synchronizing
 # models with the configuration management backend
 
+def _publish_databag(publish_func, instance, data):
+    """
+    Publish an app or formation databag unless it is unchanged.
+
+    A digest of each published databag is kept in the shared cache, which
+    every controller process reads, so re-publishing identical content
+    skips the upload entirely.
+    """
+    publish_queue.discard(instance)
+    key = _databag_cache_key(instance)
+    digest = hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+    if shared_cache.get(key) == digest:
+        return
+    publish_func(instance.flat(), data)
+    shared_cache.set(key, digest, None)
+
+
+def _purge_databag(purge_func, instance):
+    """Purge an app or formation databag and forget its digest."""
+    publish_queue.discard(instance)
+    purge_func(instance.flat())
+    shared_cache.delete(_databag_cache_key(instance))
+
+
+def _databag_cache_key(instance):
+    return 'deis:databag:{}:{}'.format(instance._meta.model_name, instance.id)
+
+
+class PublishQueue(threading.local):
+    """
+    Per-thread set of apps and formations waiting to be published.
+
+    Between :meth:`start` and :meth:`stop`, saved apps and formations are
+    marked dirty instead of being published immediately. Each dirty databag
+    is then published once when the queue is flushed, typically at the end
+    of a request by :class:`~api.middleware.PublishMiddleware`.
+
+    Release images are queued too, so that a converge can chain its nodes
+    behind their publishing in Celery. Images no converge picked up are
+    published when the queue is stopped.
+    """
+
+    def __init__(self):
+        self.items = None
+        self.images = []
+
+    def start(self):
+        """Start deferring databag publishing for this thread."""
+        self.items = OrderedDict()
+        self.images = []
+
+    def stop(self):
+        """Publish any dirty databags and queued images, and stop deferring."""
+        try:
+            self.flush()
+            self.publish_images()
+        finally:
+            self.items = None
+
+    def abort(self):
+        """Stop deferring without publishing, as the changes may not have been saved."""
+        self.items = None
+        self.images = []
+
+    def add(self, instance):
+        """
+        Mark an app or formation as dirty.
+
+        :returns: False if publishing isn't deferred and the caller should publish now
+        """
+        if self.items is None:
+            return False
+        self.items[(instance._meta.model_name, instance.pk)] = instance
+        return True
+
+    def discard(self, instance):
+        """Forget an app or formation that has been published or purged."""
+        if self.items:
+            self.items.pop((instance._meta.model_name, instance.pk), None)
+
+    def add_image(self, signature):
+        """
+        Queue the Celery signature of a release image to publish.
+
+        :returns: False if publishing isn't deferred and the caller should publish now
+        """
+        if self.items is None:
+            return False
+        self.images.append(signature)
+        return True
+
+    def publish_images(self, then=None):
+        """
+        Start publishing every queued release image in Celery.
+
+        :param then: a group of tasks to run once the images are published
+        :returns: the results of the image tasks, and the result of then
+        """
+        if not self.images:
+            return [], then.apply_async() if then is not None else None
+        images, self.images = group(*self.images), []
+        results = images.freeze().results
+        if then is None or not then.tasks:
+            images.apply_async()
+            return results, then.apply_async() if then is not None else None
+        return results, chord(images, then).apply_async()
+
+    def flush(self):
+        """Publish every dirty databag, calculating dirty apps in bulk."""
+        if not self.items:
+            return
+        items, self.items = self.items.values(), OrderedDict()
+        apps = [i for i in items if isinstance(i, App)]
+        if apps:
+            data = App.objects.calculate(App.objects.filter(pk__in=[a.pk for a in apps]))
+            for app in apps:
+                # skip apps destroyed since they were marked dirty
+                if app.id in data:
+                    _publish_databag(CM.publish_app, app, data[app.id])
+        for formation in items:
+            if isinstance(formation, Formation) and \
+                    Formation.objects.filter(pk=formation.pk).exists():
+                formation.publish()
+
+
+publish_queue = PublishQueue()
+
+
 def _publish_to_cm(**kwargs):
-    kwargs['instance'].publish()
+    instance = kwargs['instance']
+    if not publish_queue.add(instance):
+        instance.publish()
 
 
 def _log_build_created(**kwargs):
     if kwargs.get('created'):
         build = kwargs['instance']
-        log_event(build.app, "Build {} created".format(build))
+        log_event(build.app, "Build {} created".format(build), type='build',
+                  user=build.owner, build=str(build.uuid))
 
 
 def _log_release_created(**kwargs):
     if kwargs.get('created'):
         release = kwargs['instance']
-        log_event(release.app, "Release {} created".format(release))
+        log_event(release.app, "Release {} created".format(release), type='release',
+                  user=release.owner, release=release.version)
 
 
 def _log_config_updated(**kwargs):
     config = kwargs['instance']
-    log_event(config.app, "Config {} updated".format(config))
+    log_event(config.app, "Config {} updated".format(config), type='config',
+              user=config.owner, version=config.version)
 
 
 def _etcd_publish_key(**kwargs):
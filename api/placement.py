@@ -0,0 +1,78 @@
+"""
+Placement strategies for :class:`~api.models.Container`\s.
+
+A strategy is a function that picks the runtime node for one new container
+of an app. It reads the occupancy tracked by a
+:class:`~api.models.ContainerScheduler` and returns a node; the scheduler
+records the placement. A formation chooses a strategy by name, and an app
+may override its formation's choice. Register a new strategy by adding it
+to :data:`STRATEGIES`.
+"""
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+
+
+def spread(scheduler, app, container_type):
+    """
+    Spread containers of a type across layers, then across their nodes.
+
+    The runtime layer with the fewest containers of the type is chosen
+    first, then its node with the fewest, with ties going to the oldest.
+    """
+    counts = scheduler.layer_counts[container_type]
+    layer = min(scheduler.layers, key=lambda l: (counts[l], scheduler.layer_rank[l]))
+    node_counts = scheduler.counts[container_type]
+    return scheduler.best(('spread', container_type, layer), scheduler.layers[layer],
+                          lambda n: node_counts[n.pk])
+
+
+def anti_affinity(scheduler, app, container_type):
+    """
+    Keep replicas of an app's container type off the same node.
+
+    Nodes without a replica are preferred, then the least loaded node. More
+    replicas than nodes are doubled up as evenly as possible.
+    """
+    replicas = scheduler.app_counts[app.pk, container_type]
+    totals = scheduler.totals
+    return scheduler.best(('anti-affinity', container_type, app.pk), scheduler.nodes,
+                          lambda n: (replicas[n.pk], totals[n.pk]))
+
+
+def binpack(scheduler, app, container_type):
+    """
+    Pack containers densely by memory.
+
+    Each container type weighs the memory its app declares for it, and each
+    node holds the memory its flavor declares. The fullest node that still
+    fits the container is chosen, so whole nodes stay free for other work.
+    """
+    weight = scheduler.weight(app.pk, container_type)
+    fits = [n for n in scheduler.nodes
+            if scheduler.used[n.pk] + weight <= scheduler.capacity(n)]
+    if not fits:
+        raise EnvironmentError(
+            'No node has {} MB free for {} containers'.format(weight, container_type))
+    return max(fits, key=lambda n: (scheduler.used[n.pk], -scheduler.rank[n.pk]))
+
+
+STRATEGIES = {
+    'spread': spread,
+    'anti-affinity': anti_affinity,
+    'binpack': binpack,
+}
+
+# strategies that an even rebalance of container counts would undo
+PACKED = ('binpack',)
+
+
+def container_memory(memory, container_type):
+    """Return the memory in MB declared for a container type."""
+    return int(memory.get(container_type, settings.CONTAINER_MEMORY))
+
+
+def node_memory(flavor_params):
+    """Return the memory in MB a node's flavor declares."""
+    return int(flavor_params.get('memory', settings.NODE_MEMORY))
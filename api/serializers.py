@@ -7,6 +7,7 @@ from __future__ import unicode_literals
 import re
 
 from django.contrib.auth.models import User
+from django.db.models import Max
 from rest_framework import serializers
 
 from api import models
@@ -104,11 +105,12 @@ class ConfigSerializer(serializers.ModelSerializer):
     owner = serializers.Field(source='owner.username')
     app = serializers.SlugRelatedField(slug_field='id')
     values = serializers.ModelField(
-        model_field=models.Config()._meta.get_field('values'), required=False)
+        model_field=models.ConfigBlob()._meta.get_field('values'), required=False)
 
     class Meta:
         """Metadata options for a :class:`ConfigSerializer`."""
         model = models.Config
+        exclude = ('blob',)
         read_only_fields = ('uuid', 'created', 'updated')
 
 
@@ -181,12 +183,30 @@ class AppSerializer(serializers.ModelSerializer):
     owner = serializers.Field(source='owner.username')
     id = serializers.SlugField(default=utils.generate_app_name)
     formation = serializers.SlugRelatedField(slug_field='id', required=False)
+    container_count = serializers.SerializerMethodField('get_container_count')
+    release_version = serializers.SerializerMethodField('get_release_version')
 
     class Meta:
         """Metadata options for a :class:`AppSerializer`."""
         model = models.App
         read_only_fields = ('created', 'updated')
 
+    def get_container_count(self, obj):
+        """Return the number of containers, annotated by :meth:`AppManager.summarized`."""
+        if obj is None:
+            return None
+        if hasattr(obj, 'container_count'):
+            return obj.container_count
+        return obj.container_set.count()
+
+    def get_release_version(self, obj):
+        """Return the latest release version, annotated by :meth:`AppManager.summarized`."""
+        if obj is None:
+            return None
+        if hasattr(obj, 'release_version'):
+            return obj.release_version
+        return obj.release_set.aggregate(version=Max('version'))['version']
+
     def validate_id(self, attrs, source):
         """
         Check that the ID is all lowercase
@@ -210,3 +230,27 @@ class ContainerSerializer(serializers.ModelSerializer):
         """Metadata options for a :class:`ContainerSerializer`."""
         model = models.Container
         read_only_fields = ('created', 'updated')
+
+
+class OperationSerializer(serializers.ModelSerializer):
+    """Serialize a :class:`~api.models.Operation` model."""
+
+    owner = serializers.Field(source='owner.username')
+
+    class Meta:
+        """Metadata options for a :class:`OperationSerializer`."""
+        model = models.Operation
+        read_only_fields = ('created', 'updated')
+
+
+class EventSerializer(serializers.ModelSerializer):
+    """Serialize a :class:`~api.models.Event` model."""
+
+    formation = serializers.SlugRelatedField(slug_field='id')
+    app = serializers.SlugRelatedField(slug_field='id')
+    user = serializers.Field(source='user.username')
+
+    class Meta:
+        """Metadata options for a :class:`EventSerializer`."""
+        model = models.Event
+        read_only_fields = ('uuid', 'created', 'updated')
@@ -1,7 +1,11 @@
 
+from contextlib import contextmanager
 import StringIO
+import hashlib
+import os
 import select
 import socket
+import threading
 import time
 
 import paramiko
@@ -27,35 +31,187 @@ def connect_ssh(username, hostname, port, key,
     return ssh
 
 
-def exec_ssh(ssh, command, pty=False):
+class SSHPool(object):
+    """
+    A per-process pool of authenticated SSH connections.
+
+    Connections are keyed by (username, hostname, port, key fingerprint), so
+    repeated operations against a node reuse its transport instead of paying
+    for a TCP connect, SSH handshake and RSA authentication every time.
+    Connections idle for longer than idle_timeout seconds are closed, and a
+    pooled connection is health-checked before it is handed out again.
+    """
+
+    def __init__(self, idle_timeout=300, connect=connect_ssh):
+        self.idle_timeout = idle_timeout
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._keys = {}
+        self._pid = os.getpid()
+
+    @staticmethod
+    def pool_key(username, hostname, port, key):
+        fingerprint = hashlib.sha1(key).hexdigest()
+        return username, hostname, int(port), fingerprint
+
+    @staticmethod
+    def is_healthy(ssh):
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (EOFError, socket.error, paramiko.SSHException):
+            return False
+        return True
+
+    def acquire(self, username, hostname, port, key, **kwargs):
+        """
+        Check out a connection to a host, reusing an idle one if possible.
+
+        :returns: a connected :class:`paramiko.SSHClient`
+        """
+        pool_key = self.pool_key(username, hostname, port, key)
+        while True:
+            with self._lock:
+                self._check_pid()
+                self._reap()
+                idle = self._idle.get(pool_key)
+                ssh = idle.pop()[0] if idle else None
+            if ssh is None or self.is_healthy(ssh):
+                break
+            ssh.close()
+        if ssh is None:
+            ssh = self._connect(username, hostname, port, key, **kwargs)
+        with self._lock:
+            self._keys[id(ssh)] = pool_key
+        return ssh
+
+    def release(self, ssh):
+        """Return a checked-out connection to the pool."""
+        with self._lock:
+            pool_key = self._keys.pop(id(ssh), None)
+            if pool_key is None or self._pid != os.getpid():
+                ssh.close()
+                return
+            self._idle.setdefault(pool_key, []).append((ssh, time.time()))
+            self._reap()
+
+    def discard(self, ssh):
+        """Close a checked-out connection instead of returning it to the pool."""
+        with self._lock:
+            self._keys.pop(id(ssh), None)
+        ssh.close()
+
+    @contextmanager
+    def connection(self, username, hostname, port, key, **kwargs):
+        """
+        Check out a connection for the duration of a with block.
+
+        The connection is closed rather than pooled if the block raises.
+        """
+        ssh = self.acquire(username, hostname, port, key, **kwargs)
+        try:
+            yield ssh
+        except Exception:
+            self.discard(ssh)
+            raise
+        self.release(ssh)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for ssh, _ in conns:
+                ssh.close()
+
+    def _reap(self):
+        deadline = time.time() - self.idle_timeout
+        for pool_key, conns in self._idle.items():
+            for ssh, last_used in [c for c in conns if c[1] < deadline]:
+                conns.remove((ssh, last_used))
+                ssh.close()
+            if not conns:
+                del self._idle[pool_key]
+
+    def _check_pid(self):
+        # a forked child must not share its parent's sockets
+        if self._pid != os.getpid():
+            self._idle, self._keys = {}, {}
+            self._pid = os.getpid()
+
+
+ssh_pool = SSHPool()
+
+
+def exec_ssh(ssh, command, pty=False, callback=None, stdin=None):
+    """
+    Run a command over SSH and wait for it to exit.
+
+    :param callback: called with each chunk of output as it arrives
+    :param stdin: a string to send to the command's standard input
+    :returns: a tuple of the command's (output, exit_status)
+    """
     tran = ssh.get_transport()
     chan = tran.open_session()
     # NOTE: pty breaks line ordering on commands like apt-get
     if pty:
         chan.get_pty(term='vt100', width=80, height=24)
     chan.exec_command(command)
-    output = read_from_ssh(chan)
+    if stdin is not None:
+        chan.sendall(stdin)
+        chan.shutdown_write()
+    output = read_from_ssh(chan, callback=callback)
     exit_status = chan.recv_exit_status()
     return output, exit_status
 
 
-def read_from_ssh(chan):
-    output = ''
+def stream_from_ssh(chan, bufsize=32768, timeout=10):
+    """
+    Yield a channel's stdout and stderr in chunks until the command exits.
+
+    A quiet command is waited on rather than treated as finished; reading
+    stops only once the exit status has arrived and both streams are drained.
+    """
     while True:
-        r, w, e = select.select([chan], [], [], 10)  # @UnusedVariable
-        if r:
-            got_data = False
-            if chan.recv_ready():
-                data = r[0].recv(4096)
-                if data:
-                    got_data = True
-                    output += data
-                    # print("stdout => ", data)
-            if chan.recv_stderr_ready():
-                data = r[0].recv_stderr(4096)
-                if data:
-                    got_data = True
-                    output += data
-                    # print("stderr => ", data)
-            if not got_data:
-                return output
+        select.select([chan], [], [], timeout)
+        got_data = False
+        if chan.recv_ready():
+            data = chan.recv(bufsize)
+            if data:
+                got_data = True
+                yield data
+        if chan.recv_stderr_ready():
+            data = chan.recv_stderr(bufsize)
+            if data:
+                got_data = True
+                yield data
+        if got_data:
+            continue
+        if chan.exit_status_ready() or chan.closed:
+            if not (chan.recv_ready() or chan.recv_stderr_ready()):
+                return
+        elif chan.eof_received:
+            # both streams are finished, so block for the exit status
+            # rather than spin on a channel that select reports as readable
+            chan.recv_exit_status()
+
+
+def read_from_ssh(chan, callback=None):
+    """
+    Read a channel's output until the command exits.
+
+    Chunks are collected and joined once at the end rather than appended
+    to a growing string.
+
+    :param callback: called with each chunk of output as it arrives
+    :returns: the command's combined stdout and stderr
+    """
+    chunks = []
+    for data in stream_from_ssh(chan):
+        chunks.append(data)
+        if callback is not None:
+            callback(data)
+    return b''.join(chunks)
@@ -13,6 +13,7 @@ from celery import task
 
 from deis import settings
 from provider import import_provider_module
+from . import docker
 from .exceptions import BuildNodeError
 
 
@@ -46,20 +47,28 @@ def destroy_layer(layer):
 @task
 def build_node(node):
     """
-    Build a node using its cloud provider.
+    Build a node using its cloud provider, then bootstrap it.
+
+    The node's progress through the provision, wait-for-ssh, bootstrap and
+    ready phases is recorded on its status.
 
     :param node: a :class:`~api.models.Node` to build
     """
     provider = import_provider_module(node.layer.flavor.provider.type)
-    provider_id, fqdn, metadata = provider.build_node(node.flat())
-    node.provider_id = provider_id
-    node.fqdn = fqdn
-    node.metadata = metadata
-    node.save()
+    node.set_phase('provision')
     try:
-        CM.bootstrap_node(node.flat())
-    except RuntimeError as err:
-        raise BuildNodeError(str(err))
+        provider_id, fqdn, metadata = provider.build_node(node.flat())
+        node.provider_id = provider_id
+        node.fqdn = fqdn
+        node.metadata = metadata
+        node.save()
+        CM.bootstrap_node(node.flat(), progress=node.set_phase)
+    except Exception as err:
+        node.set_phase('error', error=str(err))
+        if isinstance(err, RuntimeError):
+            raise BuildNodeError(str(err))
+        raise
+    node.set_phase('ready')
 
 
 @task
@@ -99,3 +108,37 @@ def run_node(node, command):
     if rc != 0 and 'failed to setup the container' in output:
         output = '\033[35mPlease run `git push deis master` first.\033[0m\n' + output
     return output, rc
+
+
+@task
+def publish_release(repository_path, config, tag):
+    """
+    Publish a release to the registry as a new Docker image.
+
+    :param repository_path: the registry repository, e.g. 'gabrtv/myapp'
+    :param config: a dict of environment variables for the image
+    :param tag: the release tag, e.g. 'v23'
+    """
+    docker.publish_release(repository_path, config, tag)
+
+
+@task
+def run_operation(operation, obj, method, args, kwargs):
+    """
+    Run a long-running model method for an API operation.
+
+    The outcome is recorded on the operation, so it outlives the Celery
+    result.
+
+    :param operation: the :class:`~api.models.Operation` to record
+    :param obj: the model instance whose method is run
+    :param method: the name of the method to run
+    """
+    operation.record('STARTED')
+    try:
+        result = getattr(obj, method)(*args, **kwargs)
+    except Exception as err:
+        operation.record('FAILURE', getattr(err, 'detail', None) or str(err))
+        raise
+    operation.record('SUCCESS', result)
+    return result
@@ -46,12 +46,18 @@ from .test_auth import *  # noqa
 from .test_build import *  # noqa
 from .test_config import *  # noqa
 from .test_container import *  # noqa
+from .test_docker import *  # noqa
+from .test_event import *  # noqa
 from .test_flavor import *  # noqa
 from .test_formation import *  # noqa
 from .test_hooks import *  # noqa
 from .test_key import *  # noqa
 from .test_layer import *  # noqa
+from .test_logs import *  # noqa
 from .test_node import *  # noqa
+from .test_operation import *  # noqa
+from .test_pagination import *  # noqa
 from .test_perm import *  # noqa
 from .test_provider import *  # noqa
 from .test_release import *  # noqa
+from .test_ssh import *  # noqa
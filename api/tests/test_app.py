@@ -8,10 +8,15 @@ from __future__ import unicode_literals
 
 import json
 import os.path
+import shutil
+import tempfile
 
+from django.core.cache import get_cache
 from django.test import TestCase
 from django.test.utils import override_settings
 
+from api import models
+from api.middleware import PublishMiddleware
 from deis import settings
 
 
@@ -181,22 +186,53 @@ class AppTest(TestCase):
         response = self.client.post(url, json.dumps(body), content_type='application/json')
         self.assertEqual(response.status_code, 201)
         app_id = response.data['id']  # noqa
-        # test logs
-        if not os.path.exists(settings.DEIS_LOG_DIR):
-            os.mkdir(settings.DEIS_LOG_DIR)
-        path = os.path.join(settings.DEIS_LOG_DIR, app_id + '.log')
-        if os.path.exists(path):
-            os.remove(path)
-        url = '/api/apps/{app_id}/logs'.format(**locals())
-        response = self.client.post(url)
-        self.assertEqual(response.status_code, 404)
-        self.assertEqual(response.data, 'No logs for {}'.format(app_id))
-        # write out some fake log data and try again
-        with open(path, 'w') as f:
-            f.write(FAKE_LOG_DATA)
-        response = self.client.post(url)
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data, FAKE_LOG_DATA)
+        # test logs, kept out of the repository's log directory
+        log_dir = tempfile.mkdtemp(prefix='deis-logs')
+        self.addCleanup(shutil.rmtree, log_dir)
+        path = os.path.join(log_dir, app_id + '.log')
+        with override_settings(DEIS_LOG_DIR=log_dir,
+                               LOG_INDEX_DIR=os.path.join(log_dir, '.index')):
+            url = '/api/apps/{app_id}/logs'.format(**locals())
+            response = self.client.post(url)
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.data, 'No logs for {}'.format(app_id))
+            # write out some fake log data and try again
+            with open(path, 'w') as f:
+                f.write(FAKE_LOG_DATA)
+            response = self.client.post(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, FAKE_LOG_DATA)
+            # page back through the logs a line at a time
+            response = self.client.get(url, {'lines': 2})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, ''.join(FAKE_LOG_DATA.splitlines(True)[-2:]))
+            cursor = response['X-Deis-Log-Previous']
+            response = self.client.get(url, {'lines': 2, 'cursor': cursor})
+            self.assertEqual(response.data, ''.join(FAKE_LOG_DATA.splitlines(True)[-4:-2]))
+            response = self.client.get(url, {'since': '2013-08-16'})
+            self.assertEqual(response.data, '')
+            self.assertNotIn('X-Deis-Log-Previous', response)
+            for params in ({'lines': 0}, {'since': 'yesterday'}, {'cursor': 'bogus'}):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 400)
+            # follow the logs as they are written
+            with override_settings(LOG_FOLLOW_INTERVAL=0.01, LOG_FOLLOW_TIMEOUT=0.2):
+                response = self.client.get(url, {'follow': ''})
+                self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+                events = [json.loads(l) for l in response.streaming_content]
+                self.assertEqual(events[0]['data'], FAKE_LOG_DATA)
+                with open(path, 'a') as f:
+                    f.write(FAKE_LOG_DATA)
+                response = self.client.get(url, {'follow': '', 'cursor': events[-1]['cursor']})
+                events = [json.loads(l) for l in response.streaming_content]
+                self.assertEqual(''.join(e['data'] for e in events), FAKE_LOG_DATA)
+                # a page's next cursor follows the lines written after it
+                cursor = self.client.get(url)['X-Deis-Log-Next']
+                with open(path, 'a') as f:
+                    f.write(FAKE_LOG_DATA)
+                response = self.client.get(url, {'follow': '', 'cursor': cursor})
+                events = [json.loads(l) for l in response.streaming_content]
+                self.assertEqual(''.join(e['data'] for e in events), FAKE_LOG_DATA)
         # test run with mock error
         url = '/api/apps/{app_id}/run'.format(**locals())
         body = {'command': 'error'}
@@ -245,6 +281,51 @@ class AppTest(TestCase):
             response = self.client.get(url)
             self.assertEquals(response.status_code, 404)
 
+    def test_app_publish(self):
+        """
+        Test that app databags are published once per change set and only when changed
+        """
+        url = '/api/apps'
+        body = {'formation': 'autotest'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app = models.App.objects.get(id=response.data['id'])
+        published = []
+        publish_app = models.CM.publish_app
+
+        def count_publish(app, data):
+            published.append(app['id'])
+            return publish_app(app, data)
+        models.CM.publish_app = count_publish
+        try:
+            # saves inside a deferred block are coalesced into a single publish
+            models.publish_queue.start()
+            config = models.Config.objects.create(
+                owner=app.owner, app=app, version=2, values={'NEW_URL1': 'localhost'})
+            models.release_signal.send(sender=self, app=app, user=app.owner, config=config)
+            for n in range(3):
+                app.containers = {'web': n}
+                app.save()
+            self.assertEqual(published, [])
+            models.publish_queue.stop()
+            self.assertEqual(published, [app.id])
+            # republishing unchanged content skips the upload
+            app.publish()
+            app.save()
+            self.assertEqual(published, [app.id])
+            # every controller process reads the digest from the database
+            self.assertIsNotNone(get_cache('shared').get(models._databag_cache_key(app)))
+            # nothing is published for a request that raised
+            middleware = PublishMiddleware()
+            middleware.process_request(None)
+            app.containers = {'web': 5}
+            app.save()
+            middleware.process_exception(None, ValueError())
+            middleware.process_response(None, None)
+            self.assertEqual(published, [app.id])
+        finally:
+            models.CM.publish_app = publish_app
+
 
 FAKE_LOG_DATA = """
 2013-08-15 12:41:25 [33454] [INFO] Starting gunicorn 17.5
@@ -8,10 +8,12 @@ from __future__ import unicode_literals
 
 import json
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.utils import override_settings
 
-from api.models import Config
+from api.models import App, Config, ConfigBlob
 
 
 @override_settings(CELERY_ALWAYS_EAGER=True)
@@ -107,3 +109,60 @@ class ConfigTest(TestCase):
         config5 = self.test_config()
         config = Config.objects.get(uuid=config5['uuid'])
         self.assertEqual(str(config), "{}-v4".format(config5['app']))
+
+    def test_config_blobs(self):
+        """Test that configs with the same values share one copy of them."""
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        values = dict(('VAR_{}'.format(i), 'x' * 100) for i in range(300))
+        url = '/api/apps/{}/config'.format(app.id)
+        for i in range(10):
+            # set every other config back to the same values
+            body = {'values': json.dumps({'VAR_0': 'y' if i % 2 else 'x' * 100})}
+            if i == 0:
+                body = {'values': json.dumps(values)}
+            response = self.client.post(url, json.dumps(body), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(app.config_set.count(), 11)
+        self.assertEqual(ConfigBlob.objects.filter(config__app=app).distinct().count(), 3)
+        config = app.config_set.latest()
+        self.assertEqual(json.loads(response.data['values']), dict(values, VAR_0='y'))
+        self.assertEqual(config.values, dict(values, VAR_0='y'))
+        self.assertEqual(config.hash, app.config_set.get(version=3).hash)
+        # the current config is read with its blob joined in
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertFalse([q for q in context.captured_queries
+                          if q['sql'].startswith('SELECT') and
+                          'FROM "api_configblob"' in q['sql']])
+        self.assertEqual(Config.objects.get(pk=config.pk).values, config.values)
+        # values can be set on a config as before
+        config = Config(owner=app.owner, app=app, version=12, values='{"A": "1"}')
+        self.assertEqual(config.values, {'A': '1'})
+        self.assertIsNone(config.hash)
+        config.save()
+        config = Config.objects.get(pk=config.pk)
+        self.assertEqual(config.values, {'A': '1'})
+        config.values = {'A': '2'}
+        config.save()
+        self.assertEqual(Config.objects.get(pk=config.pk).values, {'A': '2'})
+
+    def test_config_blobs_in_place(self):
+        """Test that values changed in place are stored when a config is saved."""
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        first = Config.objects.create(owner=app.owner, app=app, version=2, values={'A': '1'})
+        config = Config.objects.create(owner=app.owner, app=app, version=3, values={'A': '1'})
+        self.assertEqual(config.hash, first.hash)
+        config = Config.objects.get(pk=config.pk)
+        config.values['B'] = '2'
+        config.save()
+        self.assertNotEqual(config.hash, first.hash)
+        self.assertEqual(Config.objects.get(pk=config.pk).values, {'A': '1', 'B': '2'})
+        # the blob shared with the first config is left as it was
+        self.assertEqual(Config.objects.get(pk=first.pk).values, {'A': '1'})
+        self.assertEqual(ConfigBlob.objects.get(hash=first.hash).values, {'A': '1'})
@@ -8,10 +8,16 @@ from __future__ import unicode_literals
 
 import json
 
+from django.db import connection
+from django.db import models
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.utils import override_settings
 
+from api.models import App
 from api.models import Container
+from api.models import PortAllocator
 from deis import settings
 
 
@@ -480,3 +486,195 @@ class ContainerTest(TestCase):
                          "{}.{}".format(container.type, container.num))
         self.assertEqual(str(container),
                          "{} {}".format(container.formation.id, container.short_name()))
+
+    @override_settings(EVENT_LOG_TRIM_INTERVAL=1)
+    def test_container_scale_queries(self):
+        """Scaling takes the same number of queries for N and 2N containers."""
+        url = '/api/apps'
+        body = {'formation': 'autotest'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        self.assertTrue(Container.objects.scale(app, {'web': 1}))
+        self.assertTrue(Container.objects.scale(app, {'web': 0}))
+        # sizes stay within one SQLite bulk insert batch
+        up, down = [], []
+        for n in (40, 80):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(Container.objects.scale(app, {'web': n * 4 / 5, 'worker': n / 5}))
+            up.append(len(queries))
+            self.assertEqual(app.container_set.count(), n)
+            allocations = app.container_set.order_by().values('node').annotate(
+                models.Count('uuid'))
+            self.assertEqual([a['uuid__count'] for a in allocations], [n / 4] * 4)
+            ports = app.container_set.values_list('port', flat=True)
+            self.assertEqual(sorted(ports), range(10001, 10001 + n))
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(Container.objects.scale(app, {'web': 1, 'worker': 0}))
+            down.append(len(queries))
+            self.assertEqual(app.container_set.count(), 1)
+            self.assertTrue(Container.objects.scale(app, {'web': 0}))
+        self.assertEqual(up[0], up[1])
+        self.assertEqual(down[0], down[1])
+
+    @override_settings(EVENT_LOG_TRIM_INTERVAL=1)
+    def test_container_balance_plan(self):
+        url = '/api/apps'
+        formation_id = 'autotest'
+        body = {'formation': formation_id}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/api/apps/{app_id}/scale'.format(**locals())
+        body = {'web': 8, 'worker': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        # pile every container onto the first node
+        app = App.objects.get(id=app_id)
+        node = app.formation.node_set.filter(layer__runtime=True).order_by('created')[0]
+        app.container_set.update(node=node)
+        ports = dict(app.container_set.values_list('uuid', 'port'))
+        # preview the plan
+        url = '/api/formations/{formation_id}/balance'.format(**locals())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 7)
+        self.assertTrue(all(m['from'] == node.id and m['app'] == app_id for m in response.data))
+        self.assertEqual(sorted(m['container'].split('.')[0] for m in response.data),
+                         ['web'] * 6 + ['worker'])
+        self.assertEqual(app.container_set.filter(node=node).count(), 10)
+        # apply it
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 7)
+        moves = len(queries)
+        for container_type, allocations in (('web', [2, 2, 2, 2]), ('worker', [0, 0, 1, 1])):
+            counts = [app.container_set.filter(node=n, type=container_type).count()
+                      for n in app.formation.node_set.filter(layer__runtime=True)]
+            self.assertEqual(sorted(counts), allocations)
+        self.assertEqual(dict(app.container_set.values_list('uuid', 'port')), ports)
+        # nothing left to move
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [])
+        # twice the moves take the same number of queries
+        body = {'web': 16, 'worker': 4}
+        response = self.client.post('/api/apps/{app_id}/scale'.format(**locals()),
+                                    json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        app.container_set.update(node=node)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 15)
+        self.assertEqual(len(queries), moves)
+
+    def test_container_port_reuse(self):
+        url = '/api/apps'
+        body = {'formation': 'autotest'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/api/apps/{app_id}/scale'.format(**locals())
+        for structure in ({'web': 6}, {'web': 2}, {'web': 4, 'worker': 2}):
+            response = self.client.post(url, json.dumps(structure),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        ports = Container.objects.filter(app__id=app_id).values_list('port', flat=True)
+        self.assertEqual(sorted(ports), range(10001, 10007))
+
+    def _node_counts(self, app_id, container_type):
+        counts = Container.objects.filter(app__id=app_id, type=container_type).order_by(
+            ).values('node').annotate(models.Count('uuid'))
+        return sorted(c['uuid__count'] for c in counts)
+
+    def test_container_placement(self):
+        formation_id = 'autotest'
+        url = '/api/formations/{formation_id}/layers'.format(**locals())
+        body = {'id': 'runtime2', 'flavor': 'autotest', 'runtime': True,
+                'run_list': 'recipe[deis::runtime]'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/{formation_id}/scale'.format(**locals())
+        body = {'proxy': 2, 'runtime': 4, 'runtime2': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        # spread evenly across both runtime layers
+        response = self.client.post('/api/apps', json.dumps({'formation': formation_id}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/api/apps/{app_id}/scale'.format(**locals())
+        response = self.client.post(url, json.dumps({'web': 6}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        layers = Container.objects.filter(app__id=app_id).values_list(
+            'node__layer__id', flat=True)
+        self.assertEqual(sorted(layers), ['runtime'] * 3 + ['runtime2'] * 3)
+        # keep replicas apart, preferring the emptier nodes
+        body = {'formation': formation_id, 'placement': 'anti-affinity'}
+        response = self.client.post('/api/apps', json.dumps(body),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/api/apps/{app_id}/scale'.format(**locals())
+        response = self.client.post(url, json.dumps({'web': 6}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._node_counts(app_id, 'web'), [1] * 6)
+        response = self.client.post(url, json.dumps({'web': 8}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._node_counts(app_id, 'web'), [1, 1, 1, 1, 2, 2])
+        # pack workers by memory against the node capacity
+        body = {'formation': formation_id, 'placement': 'binpack',
+                'memory': json.dumps({'worker': 1024})}
+        response = self.client.post('/api/apps', json.dumps(body),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/api/apps/{app_id}/scale'.format(**locals())
+        with self.settings(NODE_MEMORY=8192):
+            response = self.client.post(url, json.dumps({'worker': 5}),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self._node_counts(app_id, 'worker'), [5])
+            # balancing leaves packed containers alone
+            response = self.client.post('/api/formations/{}/balance'.format(formation_id))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self._node_counts(app_id, 'worker'), [5])
+            response = self.client.post(url, json.dumps({'worker': 60}),
+                                        content_type='application/json')
+            self.assertContains(response, 'No node has 1024 MB free for worker containers',
+                                status_code=400)
+            self.assertEqual(self._node_counts(app_id, 'worker'), [5])
+        # an invalid strategy is rejected
+        body = {'formation': formation_id, 'placement': 'random'}
+        response = self.client.post('/api/apps', json.dumps(body),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class PortAllocatorTest(SimpleTestCase):
+
+    """Tests allocation of free container ports"""
+
+    def test_allocate(self):
+        ports = PortAllocator([10001, 10002, 10005, 9000, 70000])
+        self.assertEqual(ports.free, [[10003, 10004], [10006, 65535]])
+        self.assertEqual(ports.allocate(3), [10003, 10004, 10006])
+        self.assertEqual(ports.allocate(), [10007])
+        ports = PortAllocator([], first=1, last=4)
+        self.assertEqual(ports.allocate(4), [1, 2, 3, 4])
+        self.assertEqual(ports.free, [])
+        self.assertRaises(EnvironmentError, ports.allocate)
+
+    def test_release(self):
+        ports = PortAllocator(range(1, 11), first=1, last=10)
+        for port in (5, 3, 4, 1, 10, 9, 4):
+            ports.release(port)
+        self.assertEqual(ports.free, [[1, 1], [3, 5], [9, 10]])
+        ports.release(2)
+        self.assertEqual(ports.free, [[1, 5], [9, 10]])
+        self.assertEqual(ports.allocate(6), [1, 2, 3, 4, 5, 9])
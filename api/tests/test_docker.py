@@ -0,0 +1,359 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+import cStringIO
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import tarfile
+import threading
+from unittest import skipUnless
+
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from api import docker
+from api import tasks
+from api.models import App
+from api.models import Formation
+from api.models import publish_queue
+from api.models import release_signal
+
+
+class FakeRegistryHandler(BaseHTTPRequestHandler):
+    """Answer the Docker registry API calls made when publishing a release."""
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def _respond(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_chunks(self):
+        if self.headers.getheader('Transfer-Encoding') != 'chunked':
+            yield self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+            return
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size:
+                yield self.rfile.read(size)
+            self.rfile.readline()
+            if not size:
+                break
+
+    def _route(self):
+        self.server.requests.append((self.command, self.path))
+        if self.path.endswith('/layer'):
+            # count layer bytes without holding them
+            self.server.layer_size = sum(len(c) for c in self._read_chunks())
+            return self._respond(200, 'true')
+        data = b''.join(self._read_chunks())
+        tags = re.match(r'^/v1/repositories/(.+)/tags$', self.path)
+        tag = re.match(r'^/v1/repositories/(.+)/tags/(\w+)$', self.path)
+        image = re.match(r'^/v1/images/(\w+)/(json|layer|checksum)$', self.path)
+        if tags:
+            return self._respond(200, {t: image_id for (r, t), image_id in self.server.tags.items()
+                                       if r == tags.group(1)})
+        if tag and self.command == 'GET':
+            if tag.groups() not in self.server.tags:
+                return self._respond(404, 'Tag not found')
+            return self._respond(200, self.server.tags[tag.groups()])
+        if tag:
+            self.server.tags[tag.groups()] = json.loads(data)
+        elif image and image.group(2) == 'json' and self.command == 'GET':
+            return self._respond(200, self.server.images[image.group(1)])
+        elif image and image.group(2) == 'json':
+            self.server.images[image.group(1)] = json.loads(data)
+        return self._respond(200, 'true')
+
+    do_GET = do_PUT = _route
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRegistry(ThreadingMixIn, HTTPServer):
+    """A local HTTP server standing in for a Docker registry."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeRegistryHandler)
+        self.connections = 0
+        self.requests = []
+        self.tags = {}
+        self.images = {}
+        self.layer_size = 0
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+
+class PublishReleaseTest(SimpleTestCase):
+
+    """Tests publishing releases to a fake Docker registry"""
+
+    def setUp(self):
+        self.server = FakeRegistry()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        # hang up the pooled keep-alive connections
+        if docker._client:
+            docker._client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_publish_release(self):
+        with override_settings(REGISTRY_URL=self.server.url):
+            docker.publish_release('autotest/app', {'A': '1'}, 'v1')
+            # the first release builds a base image without reading it back
+            self.assertEqual([path for m, path in self.server.requests[1:] if m == 'GET'],
+                             ['/v1/repositories/autotest/app/tags'])
+            base = self.server.images[self.server.tags['autotest/app', 'v0']]
+            image = self.server.images[self.server.tags['autotest/app', 'latest']]
+            self.assertEqual(self.server.tags['autotest/app', 'v1'], image['id'])
+            self.assertEqual(image['parent'], base['id'])
+            self.assertEqual(image['config']['Env'], ['A=1'])
+            # later releases only look up the latest tag
+            self.server.requests = []
+            docker.publish_release('autotest/app', {'A': '2', 'B': '3'}, 'v2')
+            self.assertEqual(
+                [path for m, path in self.server.requests if m == 'GET'],
+                ['/v1/repositories/autotest/app/tags/latest',
+                 '/v1/repositories/autotest/app/tags'])
+            latest = self.server.images[self.server.tags['autotest/app', 'latest']]
+            self.assertEqual(self.server.tags['autotest/app', 'v2'], latest['id'])
+            self.assertEqual(latest['parent'], image['id'])
+            self.assertEqual(sorted(latest['config']['Env']), ['A=2', 'B=3'])
+            # a latest image pushed by someone else is fetched again
+            other = dict(base, id=docker._new_id())
+            self.server.images[other['id']] = other
+            self.server.tags['autotest/app', 'latest'] = other['id']
+            docker.publish_release('autotest/app', {}, 'v3')
+            latest = self.server.images[self.server.tags['autotest/app', 'latest']]
+            self.assertEqual(latest['parent'], other['id'])
+            # an older release finishing last doesn't move latest back
+            docker.publish_release('autotest/app', {'A': '5'}, 'v5')
+            docker.publish_release('autotest/app', {'A': '4'}, 'v4')
+            self.assertIn(('autotest/app', 'v4'), self.server.tags)
+            self.assertEqual(self.server.tags['autotest/app', 'latest'],
+                             self.server.tags['autotest/app', 'v5'])
+        # connections are kept alive
+        self.assertLessEqual(self.server.connections, 2)
+
+
+@override_settings(CELERY_ALWAYS_EAGER=True)
+class PublishQueueTest(TestCase):
+
+    """Tests chaining a formation converge behind queued release images"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.assertTrue(
+            self.client.login(username='autotest', password='password'))
+        url = '/api/providers'
+        creds = {'secret_key': 'x' * 64, 'access_key': 1 * 20}
+        body = {'id': 'autotest', 'type': 'mock', 'creds': json.dumps(creds)}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/flavors'
+        body = {'id': 'autotest', 'provider': 'autotest',
+                'params': json.dumps({'region': 'us-west-2', 'instance_size': 'm1.medium'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post('/api/formations', json.dumps({'id': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.server = FakeRegistry()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        if docker._client:
+            docker._client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        publish_queue.abort()
+
+    def test_converge_after_images(self):
+        formation = Formation.objects.get(id='autotest')
+        with override_settings(REGISTRY_URL=self.server.url):
+            # without nodes the images are still published
+            publish_queue.start()
+            publish_queue.add_image(tasks.publish_release.si('autotest/app', {}, 'v1'))
+            self.assertEqual(list(formation.converge_nodes()), [])
+            self.assertIn(('autotest/app', 'v1'), self.server.tags)
+            url = '/api/formations/autotest/layers'
+            body = {'id': 'runtime', 'flavor': 'autotest', 'runtime': True}
+            response = self.client.post(url, json.dumps(body), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            response = self.client.post('/api/formations/autotest/scale',
+                                        json.dumps({'runtime': 2}),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            publish_queue.start()
+            publish_queue.add_image(tasks.publish_release.si('autotest/app', {}, 'v2'))
+            nodes = list(formation.converge_nodes())
+            self.assertEqual(sorted(n.id for n in nodes),
+                             ['autotest-runtime-1', 'autotest-runtime-2'])
+            self.assertIn(('autotest/app', 'v2'), self.server.tags)
+            self.assertEqual(publish_queue.images, [])
+            publish_queue.stop()
+            # images no converge picked up are published at the end of a request
+            publish_queue.start()
+            publish_queue.add_image(tasks.publish_release.si('autotest/app', {}, 'v3'))
+            publish_queue.stop()
+            self.assertIn(('autotest/app', 'v3'), self.server.tags)
+            # and dropped if the request failed
+            publish_queue.start()
+            publish_queue.add_image(tasks.publish_release.si('autotest/app', {}, 'v4'))
+            publish_queue.abort()
+            self.assertNotIn(('autotest/app', 'v4'), self.server.tags)
+
+    def test_release_outside_request(self):
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        # as in a Celery task or the shell, where no queue is started
+        with override_settings(REGISTRY_URL=self.server.url):
+            release = release_signal.send(sender=self, app=app, user=app.owner)[0][1]
+        self.assertEqual(release.version, 2)
+        self.assertIn(('autotest/{}'.format(app.id), 'v2'), self.server.tags)
+        self.assertEqual(publish_queue.images, [])
+
+
+def _tar_member(tar, name, data=b'', **attrs):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 1392854400
+    for attr, value in attrs.items():
+        setattr(info, attr, value)
+    tar.addfile(info, cStringIO.StringIO(data))
+
+
+def _slug_layer(files, size, chunk_size=64 * 1024):
+    """Yield a tar archive of large files without holding it in memory."""
+    chunk = b'\0' * chunk_size
+    for i in range(files):
+        info = tarfile.TarInfo('app/slug/part{}'.format(i))
+        info.size = size
+        yield info.tobuf()
+        for _ in range(size // chunk_size):
+            yield chunk
+        yield b'\0' * (size % chunk_size + -size % tarfile.BLOCKSIZE)
+    yield b'\0' * tarfile.BLOCKSIZE * 2
+
+
+class TarSumTest(SimpleTestCase):
+
+    """Tests the streaming tarsum against members read back from the archive"""
+
+    def archive(self, format):
+        data = cStringIO.StringIO()
+        tar = tarfile.open(mode='w', fileobj=data, format=format)
+        _tar_member(tar, 'app', type=tarfile.DIRTYPE, mode=0o755)
+        _tar_member(tar, 'app/Procfile', b'web: python app.py\n')
+        _tar_member(tar, 'app/app.py', b'print "hello"\n' * 1000, uname='deis')
+        _tar_member(tar, 'app/' + 'long' * 40, b'a long name')
+        _tar_member(tar, 'app/current', type=tarfile.SYMTYPE, linkname='app/' + 'link' * 40)
+        _tar_member(tar, 'app/empty')
+        tar.close()
+        return data.getvalue()
+
+    def test_tarsum(self):
+        for format in (tarfile.GNU_FORMAT, tarfile.PAX_FORMAT):
+            data = self.archive(format)
+            expected = docker.TarSum('{}')
+            tar = tarfile.open(mode='r', fileobj=cStringIO.StringIO(data))
+            for member in tar:
+                expected.append(member, tar)
+            self.assertEqual(len(expected.hashes), 6)
+            for chunk_size in (1, 7, 512, 1000, len(data)):
+                tarsum = docker.TarSum('{}')
+                for i in range(0, len(data), chunk_size):
+                    tarsum.update(data[i:i + chunk_size])
+                self.assertEqual(tarsum.compute(), expected.compute())
+        # chunks of any size work when read from a file
+        random.seed(0)
+        tarsum = docker.TarSum('{}')
+        layer = cStringIO.StringIO(data)
+        while True:
+            chunk = layer.read(random.randint(1, 2048))
+            if not chunk:
+                break
+            tarsum.update(chunk)
+        self.assertEqual(tarsum.compute(), expected.compute())
+
+    def test_empty_layer(self):
+        tarsum = docker.TarSum('{}')
+        tarsum.update(docker._empty_tar_archive().read())
+        self.assertEqual(tarsum.hashes, [])
+        self.assertEqual(tarsum.compute(), docker.TarSum('{}').compute())
+        self.assertEqual(tarsum.compute(),
+                         'tarsum+sha256:' + hashlib.sha256('{}').hexdigest())
+
+
+class LayerUploadTest(SimpleTestCase):
+
+    """Tests streaming a large layer to a fake Docker registry"""
+
+    def setUp(self):
+        self.server = FakeRegistry()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def upload(self, files, size):
+        """Stream a layer of files to the registry, returning the growth of peak memory."""
+        client = docker.RegistryClient(self.server.url)
+        self.addCleanup(client.session.close)
+        tarsum = docker.TarSum('{}')
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        client.put_layer(docker._new_id(), _slug_layer(files, size), tarsum)
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+        self.assertEqual(self.server.layer_size, files * (size + tarfile.BLOCKSIZE) +
+                         tarfile.BLOCKSIZE * 2)
+        self.assertEqual(len(tarsum.hashes), files)
+        self.assertEqual(len(set(tarsum.hashes)), files)
+        # ru_maxrss is in kilobytes
+        return growth
+
+    def test_upload(self):
+        self.upload(5, 1024 * 1024)
+
+    @skipUnless(os.environ.get('DEIS_BENCHMARK'), 'set DEIS_BENCHMARK to run benchmarks')
+    def test_benchmark(self):
+        """Upload a 500 MB layer in constant memory."""
+        self.assertLess(self.upload(5, 100 * 1024 * 1024), 64 * 1024)
@@ -0,0 +1,115 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import json
+import sys
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+
+from api.models import App, Event, log_event
+
+
+@override_settings(CELERY_ALWAYS_EAGER=True)
+class EventTest(TestCase):
+
+    """Tests the structured event log of apps and formations"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.assertTrue(
+            self.client.login(username='autotest', password='password'))
+        url = '/api/providers'
+        creds = {'secret_key': 'x' * 64, 'access_key': 1 * 20}
+        body = {'id': 'autotest', 'type': 'mock', 'creds': json.dumps(creds)}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/flavors'
+        body = {'id': 'autotest', 'provider': 'autotest',
+                'params': json.dumps({'region': 'us-west-2', 'instance_size': 'm1.medium'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post('/api/formations', json.dumps({'id': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/autotest/layers'
+        body = {'id': 'runtime', 'flavor': 'autotest', 'runtime': True, 'proxy': True}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/autotest/scale'
+        body = {'runtime': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_events(self):
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/api/apps/{app_id}/config'.format(**locals())
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/apps/{app_id}/scale'.format(**locals())
+        body = {'web': 4, 'worker': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        # events of the app are listed newest first
+        url = '/api/apps/{app_id}/events'.format(**locals())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        events = response.data['results']
+        self.assertEqual([e['type'] for e in events][:3], ['scale', 'release', 'config'])
+        scale, release = events[0], events[1]
+        self.assertEqual(scale['app'], app_id)
+        self.assertEqual(scale['formation'], 'autotest')
+        self.assertEqual(json.loads(scale['data']), {'containers': {'web': 4, 'worker': 2}})
+        self.assertIsNotNone(scale['duration'])
+        self.assertEqual(release['release'], 2)
+        self.assertEqual(release['user'], 'autotest')
+        response = self.client.get(url, {'type': 'release'})
+        self.assertEqual([e['release'] for e in response.data['results']], [2, 1])
+        # the formation lists its own events along with its apps'
+        response = self.client.get('/api/formations/autotest/events')
+        self.assertEqual(response.status_code, 200)
+        events = response.data['results']
+        self.assertEqual(events[0]['type'], 'scale')
+        nodes = [e for e in events if e['app'] is None]
+        self.assertEqual([e['message'] for e in nodes], ['Nodes scaled runtime=2'])
+        self.assertIsNone(nodes[0]['user'])
+        # other users can't read an app's events
+        User.objects.create_user('autotest2', password='password')
+        self.assertTrue(self.client.login(username='autotest2', password='password'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_ring_buffer(self):
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        with override_settings(EVENT_LOG_SIZE=5, EVENT_LOG_TRIM_INTERVAL=1):
+            for i in range(10):
+                log_event(app, 'Event {}'.format(i), type='test')
+                log_event(app.formation, 'Formation event {}'.format(i), type='test')
+        # each app and formation keeps its latest events
+        self.assertEqual(list(Event.objects.filter(app=app).values_list('message', flat=True)),
+                         ['Event {}'.format(i) for i in range(9, 4, -1)])
+        self.assertEqual(Event.objects.filter(formation=app.formation, app=None).count(), 5)
+        # between trims an event is recorded with a single insert
+        with override_settings(EVENT_LOG_SIZE=5, EVENT_LOG_TRIM_INTERVAL=sys.maxint):
+            with CaptureQueriesContext(connection) as queries:
+                log_event(app, 'Event 10', type='test')
+            self.assertEqual(len(queries), 1)
+            self.assertEqual(Event.objects.filter(app=app).count(), 6)
+            Event.objects.trim(app.formation_id, app.pk)
+        self.assertEqual(Event.objects.filter(app=app).count(), 5)
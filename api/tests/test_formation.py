@@ -10,9 +10,14 @@ import json
 import os.path
 import uuid
 
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.utils import override_settings
+from guardian.shortcuts import assign_perm
 
+from api.models import App, Formation
 from deis import settings
 
 
@@ -134,3 +139,50 @@ class FormationTest(TestCase):
         url = '/api/formations/{formation_id}/balance'.format(**locals())
         response = self.client.post(url)
         self.assertEqual(response.status_code, 200)
+
+    def test_formation_calculate_queries(self):
+        """
+        Test that calculating a formation databag uses a constant number of queries
+        """
+        url = '/api/formations'
+        body = {'id': 'autotest', 'domain': 'localhost.localdomain'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/autotest/layers'
+        for body in ({'id': 'proxy', 'flavor': 'autotest', 'proxy': True},
+                     {'id': 'runtime', 'flavor': 'autotest', 'runtime': True}):
+            response = self.client.post(url, json.dumps(body), content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+        collaborator = User.objects.create_user('autotest2', 'autotest2@deis.io', 'password')
+
+        def grow(nodes, apps):
+            url = '/api/formations/autotest/scale'
+            body = {'proxy': nodes, 'runtime': nodes}
+            response = self.client.post(url, json.dumps(body), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            for _ in range(apps):
+                url = '/api/apps'
+                body = {'formation': 'autotest'}
+                response = self.client.post(url, json.dumps(body),
+                                            content_type='application/json')
+                self.assertEqual(response.status_code, 201)
+                app_id = response.data['id']
+                url = '/api/apps/{app_id}/scale'.format(**locals())
+                body = {'web': 2, 'worker': 1}
+                response = self.client.post(url, json.dumps(body),
+                                            content_type='application/json')
+                self.assertEqual(response.status_code, 200)
+                assign_perm('use_app', collaborator, App.objects.get(id=app_id))
+            formation = Formation.objects.get(id='autotest')
+            with CaptureQueriesContext(connection) as queries:
+                databag = formation.calculate()
+            self.assertEqual(len(databag['nodes']), nodes * 2)
+            self.assertEqual(len(databag['apps']), App.objects.count())
+            for app in databag['apps'].values():
+                self.assertEqual(app['users'], {'autotest': 'owner', 'autotest2': 'user'})
+                self.assertEqual(len(app['proxy']['backends']), 2)
+            return len(queries)
+
+        small = grow(1, 1)
+        large = grow(3, 4)
+        self.assertEqual(small, large)
@@ -6,12 +6,18 @@ Run the tests with "./manage.py test api"
 
 from __future__ import unicode_literals
 
+import imp
 import json
+import os
+import shutil
+import tempfile
 import uuid
 
+from django.test import SimpleTestCase
 from django.test import TestCase
 from django.test.utils import override_settings
 
+from api.models import App, Formation, Operation
 from deis import settings
 
 
@@ -159,3 +165,151 @@ class HookTest(TestCase):
         self.assertIn('procfile', release['build'])
         self.assertIn('web', release['build']['procfile'])
         self.assertEqual(release['build']['procfile']['web'], 'node server.js')
+
+    def test_build_hook_progress(self):
+        """Test streaming progress events while a build is deployed"""
+        formation_id = 'autotest'
+        url = '/api/formations/{formation_id}/layers'.format(**locals())
+        body = {'id': 'runtime', 'flavor': 'autotest', 'runtime': True, 'proxy': True}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/{formation_id}/scale'.format(**locals())
+        body = {'runtime': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        url = '/api/apps'
+        body = {'formation': formation_id}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        sha = uuid.uuid4().hex
+        body = {'receive_user': 'autotest',
+                'receive_repo': app_id,
+                'sha': sha,
+                'checksum': uuid.uuid4().hex,
+                'procfile': {'web': 'node server.js'},
+                'url':
+                'http://deis-controller.local/slugs/{app_id}-{sha}.tar.gz'.format(**locals()),
+                'size': 12345}
+        response = self.client.post('/api/hooks/builds?progress', json.dumps(body),
+                                    content_type='application/json',
+                                    HTTP_X_DEIS_BUILDER_AUTH=settings.BUILDER_KEY)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        events = [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+        self.assertEqual([(e['stage'], e['state']) for e in events], [
+            ('release', 'started'), ('release', 'finished'),
+            ('publish', 'started'), ('publish', 'finished'),
+            ('converge', 'started'), ('converge', 'progress'), ('converge', 'progress'),
+            ('converge', 'finished'), ('done', 'finished')])
+        self.assertEqual(events[1]['version'], 2)
+        self.assertEqual(sorted(e['node'] for e in events if e['state'] == 'progress'),
+                         ['autotest-runtime-1', 'autotest-runtime-2'])
+        databag = events[-1]['databag']
+        self.assertEqual(databag['release']['version'], 2)
+        self.assertEqual(databag['containers']['web']['1'], 'up')
+        operation = Operation.objects.get()
+        self.assertEqual((operation.action, operation.state), ('build.deploy', 'SUCCESS'))
+        self.assertEqual([(e['stage'], e['state']) for e in operation.progress],
+                         [(e['stage'], e['state']) for e in events[:-1]])
+
+    def test_build_hook_progress_closed(self):
+        """Test a deploy finishes when the client stops reading its progress"""
+        url = '/api/formations/autotest/layers'
+        body = {'id': 'runtime', 'flavor': 'autotest', 'runtime': True, 'proxy': True}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/autotest/scale'
+        response = self.client.post(url, json.dumps({'runtime': 1}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        sha = uuid.uuid4().hex
+        body = {'receive_user': 'autotest', 'receive_repo': app_id, 'sha': sha,
+                'checksum': uuid.uuid4().hex, 'procfile': {'web': 'node server.js'},
+                'url': 'http://deis-controller.local/slugs/{app_id}-{sha}.tar.gz'.format(
+                    **locals()),
+                'size': 12345}
+        response = self.client.post('/api/hooks/builds?progress', json.dumps(body),
+                                    content_type='application/json',
+                                    HTTP_X_DEIS_BUILDER_AUTH=settings.BUILDER_KEY)
+        self.assertEqual(response.status_code, 200)
+        stream = iter(response.streaming_content)
+        self.assertEqual(json.loads(next(stream))['stage'], 'release')
+        # the client disconnects after the first event
+        response.close()
+        self.assertRaises(StopIteration, next, stream)
+        operation = Operation.objects.get()
+        self.assertEqual(operation.state, 'SUCCESS')
+        self.assertEqual(operation.progress[-1]['stage'], 'converge')
+        app = App.objects.get(id=app_id)
+        self.assertEqual(app.release_set.latest().version, 2)
+        self.assertEqual(app.container_set.filter(type='web').count(), 1)
+        self.assertTrue(app.event_set.filter(type='deploy').exists())
+
+    def test_build_hook_progress_failed(self):
+        """Test a failed deploy is reported as the last progress event"""
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        body = {'receive_user': 'autotest', 'receive_repo': app_id, 'sha': 'a' * 40,
+                'checksum': uuid.uuid4().hex, 'procfile': {'web': 'node server.js'},
+                'url': 'http://deis-controller.local/slugs/{}.tar.gz'.format(app_id),
+                'size': 12345}
+
+        def prepare_converge(formation):
+            raise RuntimeError('registry is down')
+        self.addCleanup(setattr, Formation, 'prepare_converge',
+                        Formation.__dict__['prepare_converge'])
+        Formation.prepare_converge = prepare_converge
+        response = self.client.post('/api/hooks/builds?progress', json.dumps(body),
+                                    content_type='application/json',
+                                    HTTP_X_DEIS_BUILDER_AUTH=settings.BUILDER_KEY)
+        events = [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+        self.assertEqual(events[-1], {'stage': 'publish', 'state': 'failed',
+                                      'error': 'registry is down'})
+
+
+def _load_slugbuilder_hook():
+    path = os.path.join(settings.PROJECT_ROOT, 'bin', 'slugbuilder-hook.py')
+    environ = dict(os.environ)
+    os.environ.update({'SLUG_DIR': tempfile.gettempdir(), 'CONTROLLER_DIR': ''})
+    try:
+        return imp.load_source('slugbuilder_hook', path)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+class SlugCacheTest(SimpleTestCase):
+
+    """Tests reusing slugs built from the same tree and build inputs"""
+
+    def setUp(self):
+        self.hook = _load_slugbuilder_hook()
+        self.hook.SLUG_DIR = tempfile.mkdtemp()
+        self.hook.BUILDPACKS_DIR = os.path.join(self.hook.SLUG_DIR, 'packs')
+        self.addCleanup(shutil.rmtree, self.hook.SLUG_DIR)
+
+    def test_buildpack_url(self):
+        hook, tree = self.hook, 'a' * 40
+        slug_path = os.path.join(hook.SLUG_DIR, 'autotest-1.tar.gz')
+        with open(slug_path, 'w') as f:
+            f.write('slug')
+        env = {'BUILDPACK_URL': 'https://github.com/heroku/heroku-buildpack-python'}
+        key = hook.cache_key(tree, env)
+        hook.save_cached_slug('autotest', key, slug_path, 'web: x', '{}', 'sum')
+        cached = hook.load_cached_slug(
+            'autotest', hook.cache_key(tree, dict(env)),
+            os.path.join(hook.SLUG_DIR, 'autotest-2.tar.gz'))
+        self.assertEqual(cached['checksum'], 'sum')
+        # the same tree built with another buildpack misses the cache
+        env = {'BUILDPACK_URL': 'https://github.com/heroku/heroku-buildpack-ruby'}
+        self.assertIsNone(hook.load_cached_slug(
+            'autotest', hook.cache_key(tree, env),
+            os.path.join(hook.SLUG_DIR, 'autotest-3.tar.gz')))
+        self.assertIsNone(hook.cache_key(None, env))
@@ -0,0 +1,167 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import time
+from unittest import skipUnless
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from api import logs
+
+
+def _log_line(i, process='web'):
+    return '2014-02-{:02d}T{:02d}:{:02d}:{:02d} deis-runtime-1 autotest[{}.1]: line {}\n'.format(
+        1 + i // 86400, i // 3600 % 24, i // 60 % 60, i % 60, process, i)
+
+
+class LogStoreTest(SimpleTestCase):
+
+    """Tests reading application logs through their index"""
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.settings = override_settings(
+            DEIS_LOG_DIR=self.log_dir, LOG_INDEX_DIR=os.path.join(self.log_dir, '.index'),
+            LOG_INDEX_BLOCK=1024)
+        self.settings.enable()
+        self.path = os.path.join(self.log_dir, 'autotest.log')
+        self.store = logs.LogStore('autotest')
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.log_dir)
+        logs._indexes.clear()
+
+    def write(self, lines, path=None, mode='a'):
+        with open(path or self.path, mode) as f:
+            f.write(''.join(lines))
+
+    def test_read(self):
+        self.assertRaises(EnvironmentError, self.store.read)
+        lines = [_log_line(i, 'worker' if i % 7 == 0 else 'web') for i in range(200)]
+        self.write(lines)
+        page = self.store.read(lines=10)
+        self.assertEqual(page.data, ''.join(lines[-10:]))
+        self.assertGreater(len(self.store.segments()[0]['blocks']), 10)
+        # filter by process type and time
+        workers = [l for l in lines if '[worker.' in l]
+        self.assertEqual(self.store.read(types=['worker']).data, ''.join(workers))
+        since = logs.parse_since('2014-02-01T00:02:30')
+        self.assertEqual(self.store.read(since=since).data, ''.join(lines[150:]))
+        self.assertEqual(self.store.read(since=since, types=['worker']).data,
+                         ''.join(l for l in lines[150:] if l in workers))
+        self.assertIsNone(self.store.read(since=since).previous)
+        # page back through the log with cursors
+        pages, cursor = [], None
+        while True:
+            page = self.store.read(lines=30, cursor=cursor)
+            pages.insert(0, page.data)
+            cursor = page.previous
+            if cursor is None:
+                break
+        self.assertEqual(len(pages), 7)
+        self.assertEqual(''.join(pages), ''.join(lines))
+        self.assertRaises(ValueError, self.store.read, cursor='bogus')
+        # a line is returned once it has been written completely
+        self.write(['2014-02-02T00:00:00 deis-runtime-1 autotest[web.1]: partial'])
+        self.assertEqual(self.store.read(lines=1).data, lines[-1])
+        self.write([' line\n'])
+        self.assertTrue(self.store.read(lines=1).data.endswith('partial line\n'))
+
+    def test_rotation(self):
+        lines = [_log_line(i) for i in range(100)]
+        self.write(lines[:60])
+        cursor = self.store.read(lines=10).previous
+        os.rename(self.path, self.path + '.1')
+        self.write(lines[60:])
+        # the index of the rotated segment is kept
+        segments = self.store.segments()
+        self.assertEqual([s['path'] for s in segments], [self.path + '.1', self.path])
+        self.assertEqual(self.store.read(lines=100).data, ''.join(lines))
+        self.assertEqual(self.store.read(lines=100, cursor=cursor).data, ''.join(lines[:50]))
+        page = self.store.read(lines=50)
+        self.assertEqual(self.store.read(lines=20, cursor=page.previous).data,
+                         ''.join(lines[30:50]))
+        # a new log in place of an indexed one is indexed again
+        os.remove(self.path + '.1')
+        self.write(lines[:5], mode='w')
+        self.assertEqual(self.store.read().data, ''.join(lines[:5]))
+        self.assertRaises(ValueError, self.store.read, cursor=cursor)
+        # the index is read back by a new process
+        logs._indexes.clear()
+        self.assertEqual(self.store.read().data, ''.join(lines[:5]))
+
+    def test_follow(self):
+        lines = [_log_line(i, 'worker' if i % 3 == 0 else 'web') for i in range(30)]
+
+        def read(stream, count):
+            data = ''
+            while data.count('\n') < count:
+                chunk, cursor = next(stream)
+                data += chunk
+            return data, cursor
+
+        self.write(lines[:5])
+        cursor = self.store.read().next
+        with override_settings(LOG_FOLLOW_INTERVAL=0.01, LOG_FOLLOW_HEARTBEAT=0.05,
+                               LOG_FOLLOW_CHUNK=256):
+            stream = self.store.follow(cursor, timeout=5)
+            self.write(lines[5:15])
+            data, cursor = read(stream, 10)
+            self.assertEqual(data, ''.join(lines[5:15]))
+            # a quiet log sends heartbeats
+            self.assertEqual(next(stream), ('', cursor))
+            # the rest of a rotated log is read before the new one
+            self.write(lines[15:20])
+            os.rename(self.path, self.path + '.1')
+            self.write(lines[20:25])
+            data, cursor = read(stream, 10)
+            self.assertEqual(data, ''.join(lines[15:25]))
+            # resume from a cursor, following one process type
+            stream = self.store.follow(cursor, types=['worker'], timeout=0.2)
+            self.write(lines[25:])
+            self.assertEqual(''.join(data for data, _ in stream),
+                             ''.join(l for l in lines[25:] if '[worker.' in l))
+        self.assertRaises(ValueError, self.store.follow, 'bogus')
+
+    def test_index_cache(self):
+        with override_settings(LOG_INDEX_CACHE=2):
+            for app_id in ('app-a', 'app-b', 'app-c'):
+                self.write([_log_line(0)], os.path.join(self.log_dir, app_id + '.log'))
+                logs.LogStore(app_id).read()
+            # the least recently used index is dropped
+            self.assertEqual([os.path.basename(p) for p in logs._indexes],
+                             ['app-b.json', 'app-c.json'])
+            logs.LogStore('app-b').read()
+            self.assertEqual([os.path.basename(p) for p in logs._indexes],
+                             ['app-c.json', 'app-b.json'])
+            # and read back from disk when it is needed again
+            self.assertEqual(logs.LogStore('app-a').read().data, _log_line(0))
+
+    @skipUnless(os.environ.get('DEIS_BENCHMARK'), 'set DEIS_BENCHMARK to run benchmarks')
+    def test_benchmark(self):
+        """Read a large log through its index in well under a second."""
+        total = 1000000
+        with override_settings(LOG_INDEX_BLOCK=256 * 1024):
+            with open(self.path, 'w') as f:
+                for i in range(0, total, 1000):
+                    f.write(''.join(_log_line(j, 'worker' if j % 100000 == 0 else 'web')
+                                    for j in range(i, i + 1000)))
+            self.store.segments()
+            timings = []
+            for query in ({}, {'types': ['worker']}, {'since': '2014-02-12T13:00:00'}):
+                start = time.time()
+                page = self.store.read(**query)
+                timings.append((time.time() - start) * 1000)
+                self.assertTrue(page.data)
+            self.assertEqual(self.store.read(types=['worker']).data.count('\n'), 10)
+        self.assertLess(max(timings), 500)
@@ -11,7 +11,7 @@ import json
 from django.test import TestCase
 from django.test.utils import override_settings
 
-from api.models import Node
+from api.models import Container, Event, Node
 
 
 @override_settings(CELERY_ALWAYS_EAGER=True)
@@ -279,3 +279,73 @@ class NodeTest(TestCase):
         node_id = response.data['results'][0]['id']
         node = Node.objects.get(id=node_id)
         self.assertEqual(str(node), 'autotest-runtime-1')
+
+    def test_node_status(self):
+        url = '/api/formations'
+        body = {'id': 'autotest'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        formation_id = response.data['id']
+        url = '/api/formations/{formation_id}/layers'.format(**locals())
+        body = {'id': 'runtime', 'flavor': 'autotest', 'runtime': True}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/{formation_id}/scale'.format(**locals())
+        body = {'runtime': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        url = '/api/formations/{formation_id}/nodes'.format(**locals())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        for node in response.data['results']:
+            status = json.loads(node['status'])
+            self.assertEqual(status['phase'], 'ready')
+            self.assertEqual(set(status['timings']),
+                             set(['pending', 'provision', 'wait-for-ssh', 'bootstrap']))
+        # a node that fails to bootstrap is left in the error phase
+        url = '/api/formations/{formation_id}/nodes'.format(**locals())
+        body = {'fqdn': 'error.localhost.localdomain', 'layer': 'runtime'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertContains(response, 'Node Bootstrap Error', status_code=401)
+        node = Node.objects.get(fqdn='error.localhost.localdomain')
+        self.assertEqual(node.status['phase'], 'error')
+        self.assertFalse(node.ready)
+        self.assertIn('Node Bootstrap Error', node.status['error'])
+
+    def test_node_scale_schedules_affected_apps(self):
+        url = '/api/formations'
+        body = {'id': 'autotest', 'domain': 'deisapp.local'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/autotest/layers'
+        body = {'id': 'runtime', 'flavor': 'autotest', 'runtime': True}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post('/api/formations/autotest/scale',
+                                    json.dumps({'runtime': 1}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        for app_id in ('app-1', 'app-2'):
+            body = {'id': app_id, 'formation': 'autotest'}
+            response = self.client.post('/api/apps', json.dumps(body),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            response = self.client.post('/api/apps/{}/scale'.format(app_id),
+                                        json.dumps({'web': 4}), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        # new nodes only rebalance apps that already have all their containers
+        scales = Event.objects.filter(type='scale', app__isnull=False).count()
+        response = self.client.post('/api/formations/autotest/scale',
+                                    json.dumps({'runtime': 3}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Event.objects.filter(type='scale', app__isnull=False).count(), scales)
+        self.assertEqual(Event.objects.filter(type='balance').count(), 2)
+        for node in Node.objects.all():
+            self.assertGreaterEqual(node.container_set.count(), 2)
+        # apps that lose containers with a node are scaled back up once
+        lost = Container.objects.filter(node__num=1).values('app').distinct().count()
+        response = self.client.post('/api/formations/autotest/scale',
+                                    json.dumps({'runtime': 2}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Event.objects.filter(type='scale', app__isnull=False).count(),
+                         scales + lost)
+        self.assertEqual(Container.objects.count(), 8)
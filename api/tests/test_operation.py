@@ -0,0 +1,123 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import json
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from api.models import Formation, Operation
+
+
+@override_settings(CELERY_ALWAYS_EAGER=True)
+class OperationTest(TestCase):
+
+    """Tests long-running actions run as background operations"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.assertTrue(
+            self.client.login(username='autotest', password='password'))
+        url = '/api/providers'
+        creds = {'secret_key': 'x' * 64, 'access_key': 1 * 20}
+        body = {'id': 'autotest', 'type': 'mock', 'creds': json.dumps(creds)}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/flavors'
+        body = {'id': 'autotest', 'provider': 'autotest',
+                'params': json.dumps({'region': 'us-west-2', 'instance_size': 'm1.medium'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations'
+        body = {'id': 'autotest', 'domain': 'localhost.localdomain'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/autotest/layers'
+        body = {'id': 'runtime', 'flavor': 'autotest', 'runtime': True, 'proxy': True}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+    def poll(self, response):
+        """Follow a 202 response to its finished operation."""
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('/api/operations/', response['Location'])
+        response = self.client.get('/api/operations/{uuid}'.format(**response.data))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_operation(self):
+        # scale nodes in the background
+        url = '/api/formations/autotest/scale'
+        body = {'runtime': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_PREFER='respond-async')
+        operation = self.poll(response)
+        self.assertEqual(operation['action'], 'formation.scale')
+        self.assertEqual(operation['target'], 'autotest')
+        self.assertEqual(operation['state'], 'SUCCESS')
+        self.assertEqual(len(json.loads(operation['result'])['nodes']), 2)
+        # validation errors are still returned immediately
+        body = {'proxy': 1}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_PREFER='respond-async')
+        self.assertContains(response, 'Layer matching query does not exist', status_code=400)
+        # converge the formation
+        url = '/api/formations/autotest/converge'
+        response = self.client.post(url, HTTP_PREFER='respond-async')
+        operation = self.poll(response)
+        self.assertEqual(operation['state'], 'SUCCESS')
+        self.assertEqual(json.loads(operation['result'])['id'], 'autotest')
+        # scale and destroy an app
+        url = '/api/apps'
+        body = {'formation': 'autotest'}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/api/apps/{app_id}/scale'.format(**locals())
+        body = {'web': 4}
+        response = self.client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_PREFER='respond-async')
+        operation = self.poll(response)
+        self.assertEqual(operation['action'], 'app.converge')
+        self.assertEqual(operation['state'], 'SUCCESS')
+        self.assertEqual(len(json.loads(operation['result'])['containers']['web']), 4)
+        url = '/api/apps/{app_id}'.format(**locals())
+        response = self.client.delete(url, HTTP_PREFER='respond-async')
+        operation = self.poll(response)
+        self.assertEqual(operation['action'], 'formation.converge')
+        self.assertEqual(operation['state'], 'SUCCESS')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+        # clients list their own operations, newest first
+        response = self.client.get('/api/operations')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(response.data['results'][0]['action'], 'formation.converge')
+        # without the Prefer header, actions still finish before responding
+        url = '/api/formations/autotest/converge'
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Operation.objects.count(), 4)
+
+    def test_operation_failure(self):
+        user = User.objects.get(username='autotest')
+        formation = Formation.objects.get(id='autotest')
+        operation = Operation.objects.start(user, formation, 'scale', {'missing': 1})
+        url = '/api/operations/{}'.format(operation.uuid)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['state'], 'FAILURE')
+        self.assertIn('Layer matching query does not exist', response.data['result'])
+        # operations are private to their owner
+        User.objects.create_user('autotest2', password='password')
+        self.assertTrue(
+            self.client.login(username='autotest2', password='password'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
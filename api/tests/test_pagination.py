@@ -0,0 +1,156 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import json
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from guardian.shortcuts import assign_perm
+
+from api.models import App, Build, Formation, Release
+
+
+@override_settings(CELERY_ALWAYS_EAGER=True)
+class PaginationTest(TestCase):
+
+    """Tests listing objects a page at a time"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.assertTrue(
+            self.client.login(username='autotest', password='password'))
+        url = '/api/providers'
+        creds = {'secret_key': 'x' * 64, 'access_key': 1 * 20}
+        body = {'id': 'autotest', 'type': 'mock', 'creds': json.dumps(creds)}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/flavors'
+        body = {'id': 'autotest', 'provider': 'autotest',
+                'params': json.dumps({'region': 'us-west-2', 'instance_size': 'm1.medium'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post('/api/formations', json.dumps({'id': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/autotest/layers'
+        body = {'id': 'runtime', 'flavor': 'autotest', 'runtime': True, 'proxy': True}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/formations/autotest/scale'
+        body = {'runtime': 2}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def list(self, url):
+        """Page through a list, returning its items and the queries of each page."""
+        items, queries = [], []
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            items.extend(response.data['results'])
+            queries.append(len(context))
+            url = response.data['next']
+        return items, queries
+
+    def test_apps(self):
+        response = self.client.post('/api/apps', json.dumps({'id': 'app-0000'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/apps/app-0000/config'
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        url = '/api/apps/app-0000/scale'
+        response = self.client.post(url, json.dumps({'web': 3}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        user, formation = User.objects.get(username='autotest'), Formation.objects.get()
+        App.objects.bulk_create(App(owner=user, id='app-{:04d}'.format(i), formation=formation)
+                                for i in range(4999, 0, -1))
+        # every page of 5000 apps takes the same few queries
+        apps, queries = self.list('/api/apps')
+        self.assertEqual([a['id'] for a in apps], ['app-{:04d}'.format(i) for i in range(5000)])
+        self.assertEqual(len(queries), 50)
+        self.assertEqual(len(set(queries)), 1)
+        self.assertLessEqual(queries[0], 5)
+        first = self.client.get('/api/apps')
+        self.assertEqual(first.data['count'], 5000)
+        self.assertIsNone(first.data['previous'])
+        app = first.data['results'][0]
+        self.assertEqual((app['id'], app['formation'], app['owner']),
+                         ('app-0000', 'autotest', 'autotest'))
+        self.assertEqual(app['container_count'], 3)
+        self.assertEqual(app['release_version'], 2)
+        self.assertEqual(first.data['results'][1]['container_count'], 0)
+        self.assertIsNone(first.data['results'][1]['release_version'])
+        response = self.client.get('/api/apps/app-0000')
+        self.assertEqual(response.data['container_count'], 3)
+        # page back from the second page
+        second = self.client.get(first.data['next'])
+        response = self.client.get(second.data['previous'])
+        self.assertEqual(response.data['results'], first.data['results'])
+        self.assertIsNone(response.data['previous'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.data['results'], second.data['results'])
+        self.assertEqual(self.client.get('/api/apps', {'cursor': 'bogus'}).status_code, 400)
+        # users list the apps they own and those shared with them
+        user2 = User.objects.create_user('autotest2', password='password')
+        App.objects.bulk_create(App(owner=user2, id='other-{}'.format(i), formation=formation)
+                                for i in range(3))
+        assign_perm('use_app', user2, App.objects.get(id='app-0042'))
+        self.assertTrue(self.client.login(username='autotest2', password='password'))
+        apps, _ = self.list('/api/apps')
+        self.assertEqual([a['id'] for a in apps], ['app-0042', 'other-0', 'other-1', 'other-2'])
+
+    def test_nodes_and_containers(self):
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app_id = response.data['id']
+        url = '/api/apps/{app_id}/scale'.format(**locals())
+        body = {'web': 150}
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        url = '/api/apps/{app_id}/containers'.format(**locals())
+        containers, queries = self.list(url)
+        self.assertEqual(sorted(c['num'] for c in containers), list(range(1, 151)))
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(queries[0], queries[1])
+        nodes, _ = self.list('/api/formations/autotest/nodes')
+        self.assertEqual([n['id'] for n in nodes], ['autotest-runtime-1', 'autotest-runtime-2'])
+        formations, _ = self.list('/api/formations')
+        self.assertEqual([f['id'] for f in formations], ['autotest'])
+
+    def test_history(self):
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        config = app.config_set.get()
+        Release.objects.bulk_create(Release(owner=app.owner, app=app, version=v, config=config)
+                                    for v in range(2, 251))
+        Build.objects.bulk_create(Build(owner=app.owner, app=app) for _ in range(149))
+        # releases created at the same moment are still listed newest first
+        created = app.release_set.get(version=100).created
+        app.release_set.filter(version__gt=100, version__lte=200).update(created=created)
+        url = '/api/apps/{}/releases'.format(app.id)
+        releases, queries = self.list(url)
+        self.assertEqual([r['version'] for r in releases], list(range(250, 0, -1)))
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(len(set(queries)), 1)
+        # page back to the newest releases
+        second = self.client.get(self.client.get(url).data['next'])
+        response = self.client.get(second.data['previous'])
+        self.assertEqual(response.data['results'], releases[:100])
+        builds, _ = self.list('/api/apps/{}/builds'.format(app.id))
+        self.assertEqual(len(builds), 150)
+        self.assertEqual(len(set(b['uuid'] for b in builds)), 150)
@@ -2,8 +2,14 @@
 from __future__ import unicode_literals
 import json
 
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.utils import override_settings
+from guardian.shortcuts import assign_perm
+
+from api.models import App
 
 
 @override_settings(CELERY_ALWAYS_EAGER=True)
@@ -246,3 +252,57 @@ class TestAppPerms(TestCase):
         response = self.client.get(
             "/api/apps/{}/perms".format(app_id), content_type='application/json')
         self.assertEqual(response.status_code, 403)
+
+    def test_permission_queries(self):
+        app = App.objects.get(id='autotest-1-app')
+        url = "/api/apps/{}/perms".format(app.id)
+        response = self.client.post(url, json.dumps({'username': 'autotest-2'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(
+            self.client.login(username='autotest-2', password='password'))
+        urls = ['/api/apps/{}'.format(app.id), '/api/apps/{}/events'.format(app.id)]
+
+        def count_queries():
+            counts = []
+            for url in urls:
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                # each check finds a direct share with one query keyed on the user
+                checks = [q['sql'] for q in queries if 'guardian_' in q['sql']]
+                self.assertTrue(checks)
+                for sql in checks:
+                    self.assertIn('guardian_userobjectpermission', sql)
+                    self.assertIn('"user_id" = ', sql)
+                counts.append(len(queries))
+            return counts
+
+        self.client.get(urls[0])
+        counts = count_queries()
+        # checks cost the same however many users the app is shared with
+        for i in range(20):
+            assign_perm('use_app', User.objects.create_user('shared-{}'.format(i)), app)
+        self.assertEqual(count_queries(), counts)
+
+    def test_revoke_from_another_process(self):
+        app = App.objects.get(id='autotest-1-app')
+        url = "/api/apps/{}/perms".format(app.id)
+        response = self.client.post(url, json.dumps({'username': 'autotest-2'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(
+            self.client.login(username='autotest-2', password='password'))
+        url = '/api/apps/{}'.format(app.id)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        # another process revokes access without signalling this one
+        connection.cursor().execute('DELETE FROM guardian_userobjectpermission')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertNotIn('autotest-2', app.shared_users())
+        # sharing follows the user, not a reused username
+        user = User.objects.get(username='autotest-2')
+        assign_perm('use_app', user, app)
+        self.assertTrue(app.has_user(user))
+        user.delete()
+        user = User.objects.create_user('autotest-2', password='password')
+        self.assertFalse(app.has_user(user))
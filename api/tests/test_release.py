@@ -9,10 +9,13 @@ from __future__ import unicode_literals
 import json
 import uuid
 
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test.utils import override_settings
 
-from api.models import Release
+from api.models import App, Config, Release, release_signal
 
 
 @override_settings(CELERY_ALWAYS_EAGER=True)
@@ -244,3 +247,28 @@ class ReleaseTest(TestCase):
         # check that the release has push and env change messages
         self.assertIn('autotest deployed ', release.summary)
         self.assertIn('autotest added PATH', release.summary)
+
+    def test_release_queries(self):
+        """Test that creating a release takes a fixed number of queries."""
+        response = self.client.post('/api/apps', json.dumps({'formation': 'autotest'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        app = App.objects.get(id=response.data['id'])
+        user = User.objects.get(username='autotest')
+        values = dict(('VAR_{}'.format(i), str(i)) for i in range(200))
+        for version in range(2, 5):
+            values['VAR_0'] = str(version)
+            config = Config.objects.create(owner=user, app=app, version=version, values=values)
+            with CaptureQueriesContext(connection) as context:
+                release_signal.send(sender=self, config=config, app=app, user=user)
+            # read the previous release with its build and config, save and log it
+            self.assertLessEqual(len(context), 4)
+        release = app.release_set.latest()
+        self.assertEqual(release.version, 4)
+        self.assertEqual(release.summary, 'autotest changed VAR_0')
+        self.assertEqual(release.config.hash, config.hash)
+        # a config with the same values is found unchanged by its hash
+        config = Config.objects.create(owner=user, app=app, version=5, values=dict(values))
+        self.assertEqual(config.hash, release.config.hash)
+        release_signal.send(sender=self, config=config, app=app, user=user)
+        self.assertEqual(app.release_set.latest().summary, 'autotest changed nothing')
@@ -0,0 +1,165 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+
+from __future__ import unicode_literals
+
+import os
+
+from django.test import SimpleTestCase
+
+from api.ssh import SSHPool
+from api.ssh import read_from_ssh
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        pass
+
+
+class FakeSSHClient(object):
+
+    def __init__(self, *args):
+        self.args = args
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+
+
+class FakeChannel(object):
+    """
+    Replays a script of (stream, data) chunks, where None is a quiet poll.
+    """
+
+    def __init__(self, script, exit_status=0):
+        self.script = list(script)
+        self.exit_status = exit_status
+        self.closed = False
+        self.eof_received = False
+        # an always-readable descriptor so select returns immediately
+        self._r, self._w = os.pipe()
+        os.write(self._w, b'x')
+
+    def fileno(self):
+        return self._r
+
+    def _ready(self, stream):
+        return bool(self.script) and self.script[0] is not None and self.script[0][0] == stream
+
+    def recv_ready(self):
+        return self._ready('stdout')
+
+    def recv_stderr_ready(self):
+        return self._ready('stderr')
+
+    def recv(self, nbytes):
+        return self.script.pop(0)[1]
+
+    recv_stderr = recv
+
+    def exit_status_ready(self):
+        if self.script and self.script[0] is None:
+            self.script.pop(0)
+            return False
+        return not self.script
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        os.close(self._r)
+        os.close(self._w)
+
+
+class ReadFromSSHTest(SimpleTestCase):
+
+    """Tests streaming output from an SSH channel"""
+
+    def test_read_from_ssh(self):
+        script = [('stdout', b'converging'), None, None, ('stderr', b'warning'),
+                  None, ('stdout', b'done')]
+        chan = FakeChannel(script)
+        chunks = []
+        output = read_from_ssh(chan, callback=chunks.append)
+        chan.close()
+        # quiet polls do not end the stream early
+        self.assertEqual(output, b'convergingwarningdone')
+        self.assertEqual(chunks, [b'converging', b'warning', b'done'])
+
+    def test_read_from_ssh_large(self):
+        chunk = b'x' * 32768
+        chan = FakeChannel([('stdout', chunk)] * 320)
+        output = read_from_ssh(chan)
+        chan.close()
+        self.assertEqual(len(output), 320 * 32768)
+
+
+class SSHPoolTest(SimpleTestCase):
+
+    """Tests reuse of SSH connections"""
+
+    def setUp(self):
+        self.connections = []
+        self.pool = SSHPool(idle_timeout=300, connect=self.connect)
+
+    def connect(self, *args, **kwargs):
+        ssh = FakeSSHClient(*args)
+        self.connections.append(ssh)
+        return ssh
+
+    def test_ssh_pool_reuse(self):
+        for _ in range(50):
+            with self.pool.connection('ubuntu', 'node1', 22, 'key1') as ssh:
+                self.assertFalse(ssh.closed)
+        self.assertEqual(len(self.connections), 1)
+        # a different port, user or key gets its own connection
+        for args in (('ubuntu', 'node1', 2222, 'key1'),
+                     ('root', 'node1', 22, 'key1'),
+                     ('ubuntu', 'node1', 22, 'key2')):
+            with self.pool.connection(*args):
+                pass
+        self.assertEqual(len(self.connections), 4)
+        # concurrent checkouts never share a connection
+        first = self.pool.acquire('ubuntu', 'node1', 22, 'key1')
+        second = self.pool.acquire('ubuntu', 'node1', 22, 'key1')
+        self.assertIsNot(first, second)
+        self.pool.release(first)
+        self.pool.release(second)
+        self.pool.close()
+        self.assertTrue(all(ssh.closed for ssh in self.connections))
+
+    def test_ssh_pool_health(self):
+        with self.pool.connection('ubuntu', 'node1', 22, 'key1') as ssh:
+            pass
+        ssh.transport.active = False
+        with self.pool.connection('ubuntu', 'node1', 22, 'key1') as ssh2:
+            self.assertIsNot(ssh, ssh2)
+        self.assertTrue(ssh.closed)
+        # a connection that raised is closed rather than reused
+        with self.assertRaises(RuntimeError):
+            with self.pool.connection('ubuntu', 'node1', 22, 'key1') as ssh3:
+                raise RuntimeError
+        self.assertTrue(ssh3.closed)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_ssh_pool_idle_timeout(self):
+        with self.pool.connection('ubuntu', 'node1', 22, 'key1') as ssh:
+            pass
+        self.pool.idle_timeout = -1
+        with self.pool.connection('ubuntu', 'node1', 22, 'key1') as ssh2:
+            self.assertIsNot(ssh, ssh2)
+        self.assertTrue(ssh.closed)
@@ -141,6 +141,11 @@ Formation Infrastructure
 
   List all :class:`~api.models.Node`\s.
 
+.. http:get:: /api/formations/(string:id)/events/
+
+  List recent :class:`~api.models.Event`\s of a formation and its apps,
+  optionally of one `type`.
+
 
 Formation Actions
 -----------------
@@ -150,6 +155,10 @@ Formation Actions
   See also
   :meth:`FormationViewSet.scale() <api.views.FormationViewSet.scale>`
 
+.. http:get:: /api/formations/(string:id)/balance/
+
+  Preview the container moves a balance would make.
+
 .. http:post:: /api/formations/(string:id)/balance/
 
   See also
@@ -237,6 +246,10 @@ Application Infrastructure
 
   List all :class:`~api.models.Container`\s.
 
+.. http:get:: /api/apps/(string:id)/events/
+
+  List recent :class:`~api.models.Event`\s of an app, optionally of one `type`.
+
 
 Application Actions
 -------------------
@@ -246,6 +259,10 @@ Application Actions
   See also
   :meth:`AppViewSet.scale() <api.views.AppViewSet.scale>`
 
+.. http:get:: /api/apps/(string:id)/logs/
+
+  Retrieve log lines, filtered by `since`, `type` and `lines`, a page at a time.
+
 .. http:post:: /api/apps/(string:id)/logs/
 
   See also
@@ -314,6 +331,22 @@ Nodes
   Create a new :class:`~api.models.Node`.
 
 
+Operations
+==========
+
+Scaling and converging a formation, and scaling or destroying an app, run in
+the background when the request carries a ``Prefer: respond-async`` header.
+The response is then ``202 Accepted`` with an operation to poll.
+
+.. http:get:: /api/operations/(string:uuid)/
+
+  Retrieve an :class:`~api.models.Operation` by its `uuid`.
+
+.. http:get:: /api/operations/
+
+  List all :class:`~api.models.Operation`\s.
+
+
 Auth
 ====
 
@@ -401,11 +434,13 @@ urlpatterns = patterns(
             'get': 'retrieve', 'delete': 'destroy'})),
     url(r'^formations/(?P<id>[-_\w]+)/nodes/?',
         views.FormationNodeViewSet.as_view({'get': 'list', 'post': 'add'})),
+    url(r'^formations/(?P<id>[-_\w]+)/events/?',
+        views.FormationEventViewSet.as_view({'get': 'list'})),
     # formation actions
     url(r'^formations/(?P<id>[-_\w]+)/scale/?',
         views.FormationViewSet.as_view({'post': 'scale'})),
     url(r'^formations/(?P<id>[-_\w]+)/balance/?',
-        views.FormationViewSet.as_view({'post': 'balance'})),
+        views.FormationViewSet.as_view({'get': 'balance', 'post': 'balance'})),
     url(r'^formations/(?P<id>[-_\w]+)/calculate/?',
         views.FormationViewSet.as_view({'post': 'calculate'})),
     url(r'^formations/(?P<id>[-_\w]+)/converge/?',
@@ -436,11 +471,13 @@ urlpatterns = patterns(
         views.AppContainerViewSet.as_view({'get': 'list'})),
     url(r'^apps/(?P<id>[-_\w]+)/containers/?',
         views.AppContainerViewSet.as_view({'get': 'list'})),
+    url(r'^apps/(?P<id>[-_\w]+)/events/?',
+        views.AppEventViewSet.as_view({'get': 'list'})),
     # application actions
     url(r'^apps/(?P<id>[-_\w]+)/scale/?',
         views.AppViewSet.as_view({'post': 'scale'})),
     url(r'^apps/(?P<id>[-_\w]+)/logs/?',
-        views.AppViewSet.as_view({'post': 'logs'})),
+        views.AppViewSet.as_view({'get': 'logs', 'post': 'logs'})),
     url(r'^apps/(?P<id>[-_\w]+)/run/?',
         views.AppViewSet.as_view({'post': 'run'})),
     url(r'^apps/(?P<id>[-_\w]+)/calculate/?',
@@ -460,6 +497,11 @@ urlpatterns = patterns(
         views.PushHookViewSet.as_view({'post': 'create'})),
     url(r'^hooks/build/?',
         views.BuildHookViewSet.as_view({'post': 'create'})),
+    # operations
+    url(r'^operations/(?P<uuid>[-_\w]+)/?',
+        views.OperationViewSet.as_view({'get': 'retrieve'})),
+    url(r'^operations/?',
+        views.OperationViewSet.as_view({'get': 'list'})),
     # nodes
     url(r'^nodes/(?P<node>[-_\w]+)/converge/?',
         views.NodeViewSet.as_view({'post': 'converge'})),
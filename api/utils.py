@@ -3,6 +3,7 @@ Helper functions used by the Deis server.
 """
 import base64
 import hashlib
+import json
 import random
 
 
@@ -99,6 +100,19 @@ def dict_diff(dict1, dict2):
     return {k: diff[k] for k in diff if diff[k]}
 
 
+def config_hash(values):
+    """
+    Return a hash of config values that is equal only for equal values.
+
+    >>> config_hash({'a': '1', 'b': '2'}) == config_hash({'b': '2', 'a': '1'})
+    True
+    >>> config_hash({'a': '1'}) == config_hash({'a': 1})
+    False
+    """
+    data = json.dumps(values, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
 def fingerprint(key):
     """
     Return the fingerprint for an SSH Public Key
@@ -4,16 +4,21 @@ RESTful view classes for presenting Deis API objects.
 
 from __future__ import absolute_import
 from __future__ import unicode_literals
+import base64
 import json
+import operator
+import time
 
 from Crypto.PublicKey import RSA
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.db import transaction
+from django.db.models import Q
+from django.http import Http404
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 from guardian.shortcuts import assign_perm
-from guardian.shortcuts import get_objects_for_user
-from guardian.shortcuts import get_users_with_perms
 from guardian.shortcuts import remove_perm
 from rest_framework import permissions
 from rest_framework import status
@@ -22,8 +27,9 @@ from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
+from rest_framework.templatetags.rest_framework import replace_query_param
 
-from api import docker, models, serializers
+from api import logs, models, serializers
 from .exceptions import BuildFormationError
 
 from deis import settings
@@ -72,13 +78,12 @@ class IsAppUser(permissions.BasePermission):
     an app-related model.
     """
     def has_object_permission(self, request, view, obj):
-        if isinstance(obj, models.App) and obj.owner == request.user:
-            return True
-        elif hasattr(obj, 'app') and obj.app.owner == request.user:
+        app = obj if isinstance(obj, models.App) else getattr(obj, 'app', None)
+        if app is None:
+            return False
+        if app.owner_id == request.user.pk:
             return True
-        elif request.user.has_perm('use_app', obj):
-            return request.method != 'DELETE'
-        elif hasattr(obj, 'app') and request.user.has_perm('use_app', obj.app):
+        elif request.user.is_superuser or app.has_user(request.user):
             return request.method != 'DELETE'
         else:
             return False
@@ -180,6 +185,100 @@ class OwnerViewSet(viewsets.ModelViewSet):
         return self.model.objects.filter(owner=self.request.user)
 
 
+class OperationMixin(object):
+    """
+    Let clients run slow actions in the background.
+
+    A client that sends ``Prefer: respond-async`` gets 202 Accepted and an
+    :class:`~api.models.Operation` to poll, instead of holding a web worker
+    until the action finishes.
+    """
+
+    def defer(self, request, obj, method, *args, **kwargs):
+        """
+        Start an operation running obj.method if the client asked for one.
+
+        :returns: a 202 response, or None if the client will wait for the result
+        """
+        if 'respond-async' not in request.META.get('HTTP_PREFER', ''):
+            return None
+        operation = models.Operation.objects.start(
+            request.user, obj, method, *args, **kwargs)
+        data = serializers.OperationSerializer(operation).data
+        location = '/api/operations/{}'.format(operation.uuid)
+        return Response(data, status=status.HTTP_202_ACCEPTED,
+                        headers={'Location': request.build_absolute_uri(location)})
+
+
+class KeysetPaginationMixin(object):
+    """
+    Page through a list by the position of the last object seen.
+
+    Lists are ordered by ``cursor_ordering``, a unique ordering of field
+    names, and a page is selected by comparing those fields against the
+    ``cursor`` query parameter instead of counting an ``OFFSET`` of rows,
+    so every page costs the same however deep it is. Responses keep the
+    ``count``, ``next``, ``previous`` and ``results`` of offset pagination.
+    """
+
+    cursor_ordering = ('created', 'uuid')
+
+    def list(self, request, *args, **kwargs):
+        size = self.get_paginate_by()
+        if not size:
+            return super(KeysetPaginationMixin, self).list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        count = queryset.count()
+        cursor = request.QUERY_PARAMS.get('cursor')
+        forward = True
+        if cursor:
+            try:
+                forward, values = self._decode_cursor(cursor)
+                queryset = queryset.filter(self._after(values, forward))
+            except (IndexError, TypeError, ValueError, ValidationError):
+                return Response('Invalid cursor', status=status.HTTP_400_BAD_REQUEST)
+        ordering = self.cursor_ordering
+        if not forward:
+            ordering = [f[1:] if f.startswith('-') else '-' + f for f in ordering]
+        objects = list(queryset.order_by(*ordering)[:size + 1])
+        more = len(objects) > size
+        objects = objects[:size]
+        if not forward:
+            objects.reverse()
+        data = {'count': count, 'next': None, 'previous': None,
+                'results': self.get_serializer(objects, many=True).data}
+        has_next, has_previous = (more, bool(cursor)) if forward else (True, more)
+        if objects and has_next:
+            data['next'] = self._link(request, objects[-1], True)
+        if objects and has_previous:
+            data['previous'] = self._link(request, objects[0], False)
+        return Response(data)
+
+    def _after(self, values, forward):
+        """Return a filter for the objects after values in the list's direction."""
+        if len(values) != len(self.cursor_ordering):
+            raise ValueError('Invalid cursor')
+        filters = []
+        for i, name in enumerate(self.cursor_ordering):
+            field = name.lstrip('-')
+            ascending = (name == field) == forward
+            lookup = dict((f.lstrip('-'), v) for f, v in zip(self.cursor_ordering, values[:i]))
+            lookup[field + ('__gt' if ascending else '__lt')] = values[i]
+            filters.append(Q(**lookup))
+        return reduce(operator.or_, filters)
+
+    def _link(self, request, obj, forward):
+        values = [self.model._meta.get_field(f.lstrip('-')).value_to_string(obj)
+                  for f in self.cursor_ordering]
+        cursor = base64.urlsafe_b64encode(json.dumps([forward] + values))
+        return replace_query_param(request.build_absolute_uri(), 'cursor', cursor)
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return bool(data[0]), data[1:]
+
+
 class KeyViewSet(OwnerViewSet):
     """RESTful views for :class:`~api.models.Key`."""
 
@@ -217,13 +316,17 @@ class FlavorViewSet(OwnerViewSet):
         return super(FlavorViewSet, self).update(request, *args, **kwargs)
 
 
-class FormationViewSet(viewsets.ModelViewSet):
+class FormationViewSet(KeysetPaginationMixin, OperationMixin, viewsets.ModelViewSet):
     """RESTful views for :class:`~api.models.Formation`."""
 
     model = models.Formation
     serializer_class = serializers.FormationSerializer
     permission_classes = (permissions.IsAuthenticated, IsAdminOrSafeMethod)
     lookup_field = 'id'
+    cursor_ordering = ('id',)
+
+    def get_queryset(self, **kwargs):
+        return self.model.objects.select_related('owner')
 
     def pre_save(self, obj):
         if not hasattr(obj, 'owner'):
@@ -250,7 +353,12 @@ class FormationViewSet(viewsets.ModelViewSet):
                             status=status.HTTP_400_BAD_REQUEST)
         formation = self.get_object()
         try:
-            databag = models.Node.objects.scale(formation, new_structure)
+            for layer_id in new_structure:
+                formation.layer_set.get(id=layer_id)
+            response = self.defer(request, formation, 'scale', new_structure)
+            if response:
+                return response
+            databag = formation.scale(new_structure)
         except (models.Layer.DoesNotExist, EnvironmentError) as err:
             return Response(str(err),
                             status=status.HTTP_400_BAD_REQUEST)
@@ -258,9 +366,14 @@ class FormationViewSet(viewsets.ModelViewSet):
                         content_type='application/json')
 
     def balance(self, request, **kwargs):
+        """
+        Balance containers across the formation's runtime nodes.
+
+        A GET previews the container moves without applying them.
+        """
         formation = self.get_object()
-        databag = models.Container.objects.balance(formation)
-        return Response(databag, status=status.HTTP_200_OK,
+        plan = models.Container.objects.balance(formation, dry_run=request.method == 'GET')
+        return Response(plan, status=status.HTTP_200_OK,
                         content_type='application/json')
 
     def calculate(self, request, **kwargs):
@@ -271,6 +384,9 @@ class FormationViewSet(viewsets.ModelViewSet):
 
     def converge(self, request, **kwargs):
         formation = self.get_object()
+        response = self.defer(request, formation, 'converge')
+        if response:
+            return response
         databag = formation.converge()
         return Response(databag, status=status.HTTP_200_OK,
                         content_type='application/json')
@@ -333,12 +449,16 @@ class FormationLayerViewSet(FormationScopedViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class FormationNodeViewSet(FormationScopedViewSet):
+class FormationNodeViewSet(KeysetPaginationMixin, FormationScopedViewSet):
     """RESTful views for :class:`~api.models.Node`."""
 
     model = models.Node
     serializer_class = serializers.NodeSerializer
 
+    def get_queryset(self, **kwargs):
+        qs = super(FormationNodeViewSet, self).get_queryset(**kwargs)
+        return qs.select_related('owner', 'formation', 'layer')
+
     def get_object(self, *args, **kwargs):
         qs = self.get_queryset(**kwargs)
         obj = get_object_or_404(qs, id=self.kwargs['node'])
@@ -361,6 +481,20 @@ class FormationNodeViewSet(FormationScopedViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class FormationEventViewSet(FormationScopedViewSet):
+    """RESTful views for the :class:`~api.models.Event`\s of a formation and its apps."""
+
+    model = models.Event
+    serializer_class = serializers.EventSerializer
+
+    def get_queryset(self, **kwargs):
+        qs = super(FormationEventViewSet, self).get_queryset(**kwargs)
+        event_type = self.request.QUERY_PARAMS.get('type')
+        if event_type:
+            qs = qs.filter(type=event_type)
+        return qs.select_related('formation', 'app', 'user')
+
+
 class AppPermsViewSet(viewsets.ViewSet):
     """RESTful views for sharing apps with collaborators."""
 
@@ -369,12 +503,9 @@ class AppPermsViewSet(viewsets.ViewSet):
 
     def list(self, request, **kwargs):
         app = get_object_or_404(self.model, id=kwargs['id'])
-        perm_name = "api.{}".format(self.perm)
-        if request.user != app.owner and not request.user.has_perm(perm_name, app):
+        if not (request.user.is_superuser or app.has_user(request.user)):
             return Response(status=status.HTTP_403_FORBIDDEN)
-        usernames = [u.username for u in get_users_with_perms(app)
-                     if u.has_perm(perm_name, app)]
-        return Response({'users': usernames})
+        return Response({'users': sorted(app.shared_users())})
 
     def create(self, request, **kwargs):
         app = get_object_or_404(self.model, id=kwargs['id'])
@@ -383,7 +514,8 @@ class AppPermsViewSet(viewsets.ViewSet):
         user = get_object_or_404(User, username=request.DATA['username'])
         assign_perm(self.perm, user, app)
         app.publish()
-        models.log_event(app, "User {} was granted access to {}".format(user, app))
+        models.log_event(app, "User {} was granted access to {}".format(user, app),
+                         type='perm', user=request.user, username=user.username)
         return Response(status=status.HTTP_201_CREATED)
 
     def destroy(self, request, **kwargs):
@@ -391,10 +523,11 @@ class AppPermsViewSet(viewsets.ViewSet):
         if request.user != app.owner:
             return Response(status=status.HTTP_403_FORBIDDEN)
         user = get_object_or_404(User, username=kwargs['username'])
-        if user.has_perm(self.perm, app):
+        if models.App.objects.is_shared(app.pk, user):
             remove_perm(self.perm, user, app)
             app.publish()
-            models.log_event(app, "User {} was revoked access to {}".format(user, app))
+            models.log_event(app, "User {} was revoked access to {}".format(user, app),
+                             type='perm', user=request.user, username=user.username)
             return Response(status=status.HTTP_204_NO_CONTENT)
         else:
             return Response(status=status.HTTP_404_NOT_FOUND)
@@ -427,7 +560,7 @@ class NodeViewSet(FormationNodeViewSet):
     """RESTful views for :class:`~api.models.Node`."""
 
     def get_queryset(self, **kwargs):
-        return self.model.objects.all()
+        return self.model.objects.select_related('owner', 'formation', 'layer')
 
     def converge(self, request, **kwargs):
         node = self.get_object()
@@ -439,21 +572,34 @@ class NodeViewSet(FormationNodeViewSet):
         return Response(output, status=status.HTTP_200_OK, content_type='text/plain')
 
 
-class AppViewSet(OwnerViewSet):
+class AppViewSet(KeysetPaginationMixin, OperationMixin, OwnerViewSet):
     """RESTful views for :class:`~api.models.App`."""
 
     model = models.App
     serializer_class = serializers.AppSerializer
     lookup_field = 'id'
     permission_classes = (permissions.IsAuthenticated, IsAppUser)
+    cursor_ordering = ('id',)
 
     def get_queryset(self, **kwargs):
         """
         Filter Apps by `owner` attribute or the
-        `api.use_formation` permission.
+        `api.use_app` permission.
+        """
+        apps = self.model.objects.for_user(self.request.user)
+        return self.model.objects.summarized(apps)
+
+    def get_object(self, *args, **kwargs):
         """
-        return super(AppViewSet, self).get_queryset(**kwargs) | \
-            get_objects_for_user(self.request.user, 'api.use_app')
+        Return the app if the user may see it, checking whether this app is
+        shared with the user rather than querying every app shared with them.
+        """
+        app = get_object_or_404(self.model.objects.summarized(), id=self.kwargs['id'])
+        user = self.request.user
+        if not (user.is_superuser or app.has_user(user)):
+            raise Http404
+        self.check_object_permissions(self.request, app)
+        return app
 
     def post_save(self, app, created=False, **kwargs):
         if created:
@@ -497,6 +643,9 @@ class AppViewSet(OwnerViewSet):
         # save new structure now that scaling was successful
         app.containers.update(new_structure)
         app.save()
+        response = self.defer(request, app, 'converge')
+        if response:
+            return response
         databag = app.converge()
         return Response(databag, status=status.HTTP_200_OK,
                         content_type='application/json')
@@ -508,15 +657,59 @@ class AppViewSet(OwnerViewSet):
                         content_type='application/json')
 
     def logs(self, request, **kwargs):
+        """
+        Return the most recent log lines of an application.
+
+        The lines can be filtered by ``?since=`` time and ``?type=`` of
+        process, and limited in number by ``?lines=``. Older pages are read
+        by passing the cursor in the ``X-Deis-Log-Previous`` header back
+        as ``?cursor=``.
+
+        With ``?follow``, the lines are streamed as JSON lines instead, and
+        lines written later follow them until ``LOG_FOLLOW_TIMEOUT``. Each
+        line holds ``data`` and the ``cursor`` to resume following from, by
+        passing it back as ``?cursor=`` with ``?follow``. The cursor in the
+        ``X-Deis-Log-Next`` header of a page follows the lines written after
+        the page in the same way; without ``?follow`` a cursor only pages
+        back to older lines.
+        """
         app = self.get_object()
+        params = request.QUERY_PARAMS
+        follow = 'follow' in params
         try:
-            logs = app.logs()
+            since = params.get('since')
+            if since:
+                since = logs.parse_since(since)
+            types = [t for t in params.get('type', '').split(',') if t]
+            lines = int(params.get('lines', settings.LOG_LINES))
+            if not 0 < lines <= settings.LOG_LINES_MAX:
+                raise ValueError('lines must be between 1 and {}'.format(settings.LOG_LINES_MAX))
+            cursor = params.get('cursor')
+            page = None if follow and cursor else app.logs(since, types, lines, cursor)
+            if follow:
+                stream = app.follow_logs(cursor or page.next, types)
         except EnvironmentError:
             return Response("No logs for {}".format(app.id),
                             status=status.HTTP_404_NOT_FOUND,
                             content_type='text/plain')
-        return Response(logs, status=status.HTTP_200_OK,
-                        content_type='text/plain')
+        except ValueError as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+        if follow:
+            return StreamingHttpResponse(self.stream_logs(page, stream),
+                                         content_type='application/x-ndjson')
+        headers = {'X-Deis-Log-Next': page.next}
+        if page.previous:
+            headers['X-Deis-Log-Previous'] = page.previous
+        return Response(page.data, status=status.HTTP_200_OK,
+                        content_type='text/plain', headers=headers)
+
+    @staticmethod
+    def stream_logs(page, stream):
+        """Serialize a page of log lines and the lines that follow it as JSON lines."""
+        if page:
+            yield json.dumps({'data': page.data, 'cursor': page.next}) + '\n'
+        for data, cursor in stream:
+            yield json.dumps({'data': data, 'cursor': cursor}) + '\n'
 
     def run(self, request, **kwargs):
         app = self.get_object()
@@ -531,6 +724,9 @@ class AppViewSet(OwnerViewSet):
     def destroy(self, request, **kwargs):
         app = self.get_object()
         app.destroy()
+        response = self.defer(request, app.formation, 'converge', controller=True)
+        if response:
+            return response
         app.formation.converge(controller=True)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -549,7 +745,7 @@ class BaseAppViewSet(viewsets.ModelViewSet):
     def get_object(self, *args, **kwargs):
         obj = self.get_queryset().latest('created')
         user = self.request.user
-        if user == obj.app.owner or user in get_users_with_perms(obj.app):
+        if obj.app.has_user(user):
             return obj
         raise PermissionDenied()
 
@@ -564,8 +760,8 @@ class AppConfigViewSet(BaseAppViewSet):
         """Return the Config associated with the App's latest Release."""
         app = get_object_or_404(models.App, id=self.kwargs['id'])
         user = self.request.user
-        if user == app.owner or user in get_users_with_perms(app):
-            return app.release_set.latest().config
+        if app.has_user(user):
+            return app.release_set.select_related('config__blob').latest().config
         raise PermissionDenied()
 
     def post_save(self, obj, created=False):
@@ -593,11 +789,16 @@ class AppConfigViewSet(BaseAppViewSet):
         return super(AppConfigViewSet, self).create(request, *args, **kwargs)
 
 
-class AppBuildViewSet(BaseAppViewSet):
+class AppBuildViewSet(KeysetPaginationMixin, BaseAppViewSet):
     """RESTful views for :class:`~api.models.Build`."""
 
     model = models.Build
     serializer_class = serializers.BuildSerializer
+    cursor_ordering = ('-created', '-uuid')
+
+    def get_queryset(self, **kwargs):
+        qs = super(AppBuildViewSet, self).get_queryset(**kwargs)
+        return qs.select_related('owner', 'app')
 
     def post_save(self, obj, created=False):
         if created:
@@ -612,11 +813,17 @@ class AppBuildViewSet(BaseAppViewSet):
         return super(AppBuildViewSet, self).create(request, *args, **kwargs)
 
 
-class AppReleaseViewSet(BaseAppViewSet):
+class AppReleaseViewSet(KeysetPaginationMixin, BaseAppViewSet):
     """RESTful views for :class:`~api.models.Release`."""
 
     model = models.Release
     serializer_class = serializers.ReleaseSerializer
+    # versions always grow, while releases can share a created time
+    cursor_ordering = ('-version',)
+
+    def get_queryset(self, **kwargs):
+        qs = super(AppReleaseViewSet, self).get_queryset(**kwargs)
+        return qs.select_related('owner', 'app', 'config', 'build')
 
     def get_object(self, *args, **kwargs):
         """Get Release by version always."""
@@ -642,13 +849,31 @@ class AppReleaseViewSet(BaseAppViewSet):
         if settings.REGISTRY_URL:
             repository_path = "{}/{}".format(app.owner.username, app.id)
             tag = 'v{}'.format(last_version + 1)
-            docker.publish_release(repository_path, prev.config.values, tag)
+            models.publish_image(repository_path, prev.config.values, tag)
             app.converge()
         msg = "Rolled back to v{}".format(version)
         return Response(msg, status=status.HTTP_201_CREATED)
 
 
-class AppContainerViewSet(OwnerViewSet):
+class AppEventViewSet(BaseAppViewSet):
+    """RESTful views for the :class:`~api.models.Event`\s of an app."""
+
+    model = models.Event
+    serializer_class = serializers.EventSerializer
+
+    def get_queryset(self, **kwargs):
+        app = get_object_or_404(models.App, id=self.kwargs['id'])
+        user = self.request.user
+        if not app.has_user(user):
+            raise PermissionDenied()
+        qs = self.model.objects.filter(app=app)
+        event_type = self.request.QUERY_PARAMS.get('type')
+        if event_type:
+            qs = qs.filter(type=event_type)
+        return qs.select_related('formation', 'app', 'user')
+
+
+class AppContainerViewSet(KeysetPaginationMixin, OwnerViewSet):
     """RESTful views for :class:`~api.models.Container`."""
 
     model = models.Container
@@ -656,7 +881,8 @@ class AppContainerViewSet(OwnerViewSet):
 
     def get_queryset(self, **kwargs):
         app = get_object_or_404(models.App, id=self.kwargs['id'])
-        qs = self.model.objects.filter(app=app)
+        qs = self.model.objects.filter(app=app).select_related(
+            'owner', 'formation', 'node', 'app')
         container_type = self.kwargs.get('type')
         if container_type:
             qs = qs.filter(type=container_type)
@@ -688,7 +914,7 @@ class PushHookViewSet(BaseHookViewSet):
         user = get_object_or_404(
             User, username=request.DATA['receive_user'])
         # check the user is authorized for this app
-        if user == app.owner or user in get_users_with_perms(app):
+        if app.has_user(user):
             request._data = request.DATA.copy()
             request.DATA['app'] = app
             request.DATA['owner'] = user
@@ -697,34 +923,78 @@ class PushHookViewSet(BaseHookViewSet):
 
 
 class BuildHookViewSet(BaseHookViewSet):
-    """API hook to create new :class:`~api.models.Build`"""
+    """
+    API hook to create new :class:`~api.models.Build`
+
+    With a ``?progress`` query parameter, the build is released, published
+    and converged by an :class:`~api.models.Operation` while the response
+    streams its progress events as JSON lines, ending with the application
+    databag.
+    """
 
     model = models.Build
     serializer_class = serializers.BuildSerializer
+    progress = False
 
     def create(self, request, *args, **kwargs):
         app = get_object_or_404(models.App, id=request.DATA['receive_repo'])
         user = get_object_or_404(
             User, username=request.DATA['receive_user'])
         # check the user is authorized for this app
-        if user == app.owner or user in get_users_with_perms(app):
+        if app.has_user(user):
             request._data = request.DATA.copy()
             request.DATA['app'] = app
             request.DATA['owner'] = user
-            super(BuildHookViewSet, self).create(request, *args, **kwargs)
+            self.progress = 'progress' in request.QUERY_PARAMS
+            response = super(BuildHookViewSet, self).create(request, *args, **kwargs)
+            if self.progress and response.status_code == status.HTTP_201_CREATED:
+                return StreamingHttpResponse(self.stream(self.operation),
+                                             content_type='application/x-ndjson')
             # return the application databag
             return Response(app.calculate(), status=status.HTTP_200_OK)
         raise PermissionDenied()
 
     def post_save(self, obj, created=False):
         if created:
-            # create a new release
-            models.release_signal.send(sender=self, build=obj, app=obj.app, user=obj.owner)
-            # see if we need to scale an initial web container
-            app = obj.app
-            if len(app.formation.node_set.filter(layer__runtime=True)) > 0 and \
-               len(app.container_set.filter(type='web')) < 1:
-                # scale an initial web containers
-                models.Container.objects.scale(app, {'web': 1})
-            # publish and converge the application
-            app.converge()
+            if self.progress:
+                # deploy apart from the response, which may not be read to the end
+                self.operation = models.Operation.objects.start(
+                    obj.owner, obj, 'deploy', track=True)
+            else:
+                obj.deploy()
+
+    def stream(self, operation):
+        """
+        Relay the progress events of a deploy as JSON lines until it finishes.
+
+        The deploy runs as an :class:`~api.models.Operation`, so it carries
+        on if the client stops reading; this only polls its progress.
+        """
+        stage, relayed = 'release', 0
+        while True:
+            operation = models.Operation.objects.get(pk=operation.pk).refresh()
+            for event in operation.progress[relayed:]:
+                stage = event['stage']
+                # the JSON field reads back times as decimals
+                yield json.dumps(event, default=float) + '\n'
+            relayed = len(operation.progress)
+            if operation.ready:
+                break
+            time.sleep(settings.BUILD_PROGRESS_INTERVAL)
+        if operation.state == 'SUCCESS':
+            yield json.dumps({'stage': 'done', 'state': 'finished',
+                              'databag': operation.result}, default=float) + '\n'
+        else:
+            yield json.dumps({'stage': stage, 'state': 'failed',
+                              'error': operation.result}) + '\n'
+
+
+class OperationViewSet(OwnerViewSet):
+    """RESTful views for :class:`~api.models.Operation`."""
+
+    model = models.Operation
+    serializer_class = serializers.OperationSerializer
+    lookup_field = 'uuid'
+
+    def get_object(self, *args, **kwargs):
+        return super(OperationViewSet, self).get_object(*args, **kwargs).refresh()
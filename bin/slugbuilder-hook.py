@@ -1,16 +1,30 @@
 #!/opt/deis/controller/venv/bin/python
+from collections import OrderedDict
 from yaml.error import YAMLError
 import argparse
 import getpass
+import hashlib
 import json
 import os
+import pipes
+import shutil
 import subprocess
 import sys
+import tarfile
+import time
 import yaml
 
 SLUG_DIR = os.environ['SLUG_DIR']
 CONTROLLER_DIR = os.environ['CONTROLLER_DIR']
 
+# buildpacks available to the slugbuilder
+BUILDPACKS_DIR = '/opt/deis/build/packs'
+# variables with this prefix, such as BUILDPACK_URL, are passed to the build
+BUILD_ENV_PREFIX = 'BUILDPACK_'
+
+# how deploy stages reported by the controller are shown
+STAGES = {'release': 'Releasing', 'publish': 'Publishing', 'converge': 'Converging'}
+
 
 def parse_args():
     desc = """
@@ -59,24 +73,205 @@ def exit_on_error(error_code, msg):
     sys.exit(error_code)
 
 
-if __name__ == '__main__':
-    args = parse_args()
-    # get sha of master
+class Timings(OrderedDict):
+    """Wall-clock seconds spent in each build phase."""
+
+    def start(self, phase):
+        self[phase] = time.time()
+
+    def stop(self, phase):
+        self[phase] = time.time() - self[phase]
+
+    def __str__(self):
+        return ', '.join('{} {:.1f}s'.format(k, v) for k, v in self.items())
+
+
+class HashingReader(object):
+    """Read a file while computing the sha256 of every byte read."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha.update(data)
+        return data
+
+    def hexdigest(self):
+        # hash whatever the reader has not consumed yet
+        while self.read(65536):
+            pass
+        return self.sha.hexdigest()
+
+
+def inspect_slug(slug_path):
+    """
+    Return the Procfile, .release and sha256 checksum of a slug.
+
+    The compressed slug is read once: the checksum is computed over the
+    raw bytes while the tar stream is scanned for the two files.
+    """
+    wanted = {'./Procfile': None, './.release': None}
+    with open(slug_path, 'rb') as f:
+        reader = HashingReader(f)
+        tar = tarfile.open(fileobj=reader, mode='r|gz')
+        for member in tar:
+            if member.name in wanted and member.isreg():
+                wanted[member.name] = tar.extractfile(member).read()
+        tar.close()
+        checksum = reader.hexdigest()
+    return wanted['./Procfile'], wanted['./.release'], checksum
+
+
+def load_yaml(text, name):
     try:
-        with open(os.path.join(args.src, 'refs/heads/master')) as f:
-            sha = f.read().strip('\n')
-    except IOError:
-        exit_on_error(2, 'Could not read the repository SHA--is the refspec correct?')
-    # prepare for buildpack run
-    slug_path = os.path.join(SLUG_DIR, '{0}-{1}.tar.gz'.format(args.app, sha))
+        return yaml.safe_load(text)
+    except YAMLError as e:
+        exit_on_error(1, 'Invalid {0} format: {1}'.format(name, e))
+
+
+def tree_sha(src):
+    """Return the SHA of the tree at master, which names a build's inputs."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'master^{tree}'], cwd=src).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_env():
+    """Return the environment variables the buildpack process is run with."""
+    return dict((k, v) for k, v in os.environ.items() if k.startswith(BUILD_ENV_PREFIX))
+
+
+def _check_output(cmd, cwd=None):
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(cmd, cwd=cwd, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cache_key(tree, env):
+    """
+    Return the key of a slug built from a tree, or None if it can't be cached.
+
+    Besides the tree, a slug depends on the build environment, the
+    revision of each buildpack and the slugbuilder image, so a digest of
+    them is part of the key.
+    """
+    if not tree:
+        return None
+    try:
+        packs = sorted(os.listdir(BUILDPACKS_DIR))
+    except OSError:
+        packs = []
+    inputs = {
+        'env': env,
+        'buildpacks': dict((name, _check_output(['git', 'rev-parse', 'HEAD'],
+                                                cwd=os.path.join(BUILDPACKS_DIR, name)))
+                           for name in packs),
+        'image': _check_output(['docker', 'inspect', '--format', '{{.Id}}',
+                                'deis/slugbuilder']),
+    }
+    digest = hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+    return '{0}-{1}'.format(tree, digest[:12])
+
+
+def cache_path(app, key):
+    return os.path.join(SLUG_DIR, '{0}-tree-{1}.json'.format(app, key))
+
+
+def load_cached_slug(app, key, slug_path):
+    """
+    Reuse the slug built earlier from the same tree and build inputs, if any.
+
+    :returns: the cached build metadata, or None
+    """
+    if not key:
+        return None
+    try:
+        with open(cache_path(app, key)) as f:
+            cached = json.load(f)
+        if cached['slug'] != slug_path:
+            # serve the existing slug under this commit's name
+            if os.path.exists(slug_path):
+                os.unlink(slug_path)
+            try:
+                os.link(cached['slug'], slug_path)
+            except OSError:
+                shutil.copyfile(cached['slug'], slug_path)
+        return cached
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def save_cached_slug(app, key, slug_path, procfile, release, checksum):
+    if not key:
+        return
+    path = cache_path(app, key)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'slug': slug_path, 'procfile': procfile, 'release': release,
+                   'checksum': checksum}, f)
+    os.rename(path + '.tmp', path)
+
+
+def deploy(ip, push, timings):
+    """
+    Create the build on the controller and relay its progress events.
+
+    The build is posted by push-hook, run as the deis user so that the
+    builder key stays on the controller side.
+
+    :returns: the application databag
+    """
+    p = subprocess.Popen(['sudo', '-u', 'deis', "{}/bin/push-hook".format(CONTROLLER_DIR), ip],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    p.stdin.write(json.dumps(push))
+    p.stdin.close()
+    try:
+        for line in iter(p.stdout.readline, ''):
+            event = json.loads(line)
+            stage, state = event['stage'], event['state']
+            if state == 'failed':
+                puts_line()
+                exit_on_error(1, 'Build error during {0}: {1}'.format(stage, event['error']))
+            elif stage == 'done':
+                return event['databag']
+            elif state == 'started':
+                sys.stdout.write("       {}... ".format(STAGES.get(stage, stage)))
+            elif state == 'progress':
+                sys.stdout.write("\n         {node} converged ({elapsed:.1f}s)".format(**event))
+            elif state == 'finished':
+                timings[stage] = event['elapsed']
+                if stage == 'converge':
+                    sys.stdout.write("\n       ")
+                sys.stdout.write("done")
+                if 'version' in event:
+                    sys.stdout.write(", v{}".format(event['version']))
+                sys.stdout.write(" ({:.1f}s)\n".format(event['elapsed']))
+            sys.stdout.flush()
+    finally:
+        p.stdout.close()
+        p.wait()
+    raise ValueError('The controller ended the build without a result')
+
+
+def build_slug(args, slug_path, env, timings):
+    """Run the buildpack process over master and store the resulting slug."""
     # create cache dir
     cache_dir = os.path.join(args.src, 'cache')
     if not os.path.exists(cache_dir):
         os.mkdir(cache_dir)
     # build/compile
-    cmd = "git archive master | docker run -i -a stdin" \
+    timings.start('compile')
+    packs_dir = BUILDPACKS_DIR
+    env_args = ''.join(' -e {}'.format(pipes.quote('{}={}'.format(k, v)))
+                       for k, v in sorted(env.items()))
+    cmd = "git archive master | docker run -i -a stdin{env_args}" \
           " -v {cache_dir}:/tmp/cache:rw " \
-          " -v /opt/deis/build/packs:/tmp/buildpacks:rw " \
+          " -v {packs_dir}:/tmp/buildpacks:rw " \
           " deis/slugbuilder"
     cmd = cmd.format(**locals())
     p = subprocess.Popen(cmd, cwd=args.src, shell=True, stdout=subprocess.PIPE)
@@ -90,48 +285,62 @@ if __name__ == '__main__':
     rc = p.wait()
     if rc != 0:
         exit_on_error(rc, 'Build failed, leaving current release in place')
+    timings.stop('compile')
     # extract slug
+    timings.start('copy')
     cmd = 'docker cp {container}:/tmp/slug.tgz .'.format(**locals())
     p = subprocess.Popen(cmd, cwd=args.src, shell=True)
     rc = p.wait()
     if rc != 0:
         exit_on_error(rc, 'Could not extract slug from container')
     os.rename(os.path.join(args.src, 'slug.tgz'), slug_path)
-    # extract procfile
-    cmd = 'tar xfO {slug_path} ./Procfile'.format(**locals())
-    p = subprocess.Popen(cmd, cwd=args.src, shell=True, stdout=subprocess.PIPE)
-    rc = p.wait()
-    if rc != 0:
-        exit_on_error(rc, 'Could not extract Procfile from container')
-    try:
-        procfile = yaml.safe_load(p.stdout.read())
-    except YAMLError as e:
-        exit_on_error(1, 'Invalid Procfile format: {0}'.format(e))
-    # extract release
-    cmd = 'tar xfO {slug_path} ./.release'.format(**locals())
-    p = subprocess.Popen(cmd, cwd=args.src, shell=True, stdout=subprocess.PIPE)
-    rc = p.wait()
-    if rc != 0:
-        exit_on_error(rc, 'Could not extract Release from container')
-    try:
-        release = yaml.safe_load(p.stdout.read())
-    except YAMLError as e:
-        exit_on_error(1, 'Invalid Release format: {0}'.format(e))
     # remove the container
     cmd = 'docker rm {container}'.format(**locals())
     p = subprocess.Popen(cmd, cwd=args.src, shell=True, stdout=subprocess.PIPE)
     rc = p.wait()
     if rc != 0:
         exit_on_error(rc, 'Could not remove build container')
-    # calculate checksum
-    p = subprocess.Popen(['sha256sum', slug_path], stdout=subprocess.PIPE)
-    rc = p.wait()
-    if rc != 0:
-        exit_on_error(rc, 'Could not calculate SHA of slug')
-    checksum = p.stdout.read().split(' ')[0]
-    # prepare the push-hook
-    push = {'username': args.user, 'app': args.app, 'sha': sha, 'checksum': checksum,
-            'config': release.get('config_vars', {})}
+    timings.stop('copy')
+    # extract procfile and release, and calculate checksum
+    timings.start('inspect')
+    try:
+        procfile, release, checksum = inspect_slug(slug_path)
+    except (IOError, tarfile.TarError) as e:
+        exit_on_error(1, 'Could not read slug: {0}'.format(e))
+    if procfile is None:
+        exit_on_error(1, 'Could not extract Procfile from container')
+    if release is None:
+        exit_on_error(1, 'Could not extract Release from container')
+    timings.stop('inspect')
+    return procfile, release, checksum
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # get sha of master
+    try:
+        with open(os.path.join(args.src, 'refs/heads/master')) as f:
+            sha = f.read().strip('\n')
+    except IOError:
+        exit_on_error(2, 'Could not read the repository SHA--is the refspec correct?')
+    # prepare for buildpack run
+    slug_path = os.path.join(SLUG_DIR, '{0}-{1}.tar.gz'.format(args.app, sha))
+    timings = Timings()
+    # a tree that was built before with the same buildpacks maps to the same slug
+    tree, env = tree_sha(args.src), build_env()
+    key = cache_key(tree, env)
+    cached = load_cached_slug(args.app, key, slug_path)
+    if cached:
+        puts_step('Reusing slug already built from tree {}'.format(tree[:10]))
+        procfile, release, checksum = cached['procfile'], cached['release'], cached['checksum']
+    else:
+        procfile, release, checksum = build_slug(args, slug_path, env, timings)
+        save_cached_slug(args.app, key, slug_path, procfile, release, checksum)
+    procfile = load_yaml(procfile, 'Procfile')
+    release = load_yaml(release, 'Release')
+    # prepare the build hook
+    push = {'receive_user': args.user, 'receive_repo': args.app, 'sha': sha,
+            'checksum': checksum, 'config': release.get('config_vars', {})}
     # TODO: why can't we run this with `sudo -u deis`?
     output = subprocess.check_output(
         ['sudo', '-u', 'deis', "{}/bin/pre-push-hook".format(CONTROLLER_DIR)])
@@ -142,18 +351,12 @@ if __name__ == '__main__':
     # calculate slug size
     push['size'] = os.stat(slug_path).st_size
     puts_line()
-    # run stage
-    sys.stdout.write("       " + "Launching... ")
-    sys.stdout.flush()
-    p = subprocess.Popen(['sudo', '-u', 'deis', "{}/bin/push-hook".format(CONTROLLER_DIR)],
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = p.communicate(json.dumps(push))
-    rc = p.wait()
-    if rc != 0:
-        raise RuntimeError('Build error {0}'.format(stderr))
-    databag = json.loads(stdout)
-    sys.stdout.write("done, v{}\n".format(databag['release']['version']))
-    sys.stdout.flush()
+    # release, publish and converge, relaying the controller's progress as it happens
+    try:
+        databag = deploy(ip, push, timings)
+    except ValueError as e:
+        exit_on_error(1, 'Build error {0}'.format(e))
+    puts("Build timings: {}\n".format(timings))
     puts_line()
     puts_step("{args.app} deployed to Deis".format(**locals()))
     domains = databag.get('domains', [])
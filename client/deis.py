@@ -60,6 +60,7 @@ import subprocess
 import sys
 import tempfile
 import time
+import urllib
 import urlparse
 import webbrowser
 
@@ -376,6 +377,42 @@ class ResponseError(Exception):
     pass
 
 
+def _operation_result(response):
+    """
+    Return the decoded result of a response from _dispatch_operation.
+
+    Controllers that run the request in the foreground return the result as
+    the response body, while a finished operation carries it in its result.
+    """
+    data = response.json()
+    if isinstance(data, dict) and 'state' in data and 'uuid' in data:
+        return json.loads(data['result'])
+    return data
+
+
+# the most of a streamed log the client holds before printing it
+LOG_BUFFER = 1024 * 1024
+
+
+def _stream_lines(response, limit=LOG_BUFFER):
+    """
+    Yield the lines of a streamed response as they arrive.
+
+    At most limit bytes of a line are buffered. Nothing more is read until
+    a line has been consumed, so a slow consumer slows the stream down.
+    """
+    pending = b''
+    # without a chunk size each chunk is yielded as soon as it arrives
+    for chunk in response.iter_content(chunk_size=None):
+        pending += chunk
+        lines = pending.split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+        if len(pending) > limit:
+            raise EnvironmentError('Streamed line exceeds {} bytes'.format(limit))
+
+
 class DeisClient(object):
     """
     A client which interacts with a Deis controller.
@@ -395,10 +432,59 @@ class DeisClient(object):
         if not controller:
             raise EnvironmentError(
                 'No active controller. Use `deis login` or `deis register` to get started.')
-        url = urlparse.urljoin(controller, path, **kwargs)
-        response = func(url, data=body, headers=headers)
+        url = urlparse.urljoin(controller, path)
+        response = func(url, data=body, headers=headers, **kwargs)
+        return response
+
+    def _dispatch_operation(self, method, path, body=None):
+        """
+        Dispatch a long-running API request and wait for it to finish
+
+        The controller is asked to run the request in the background. If it
+        answers 202 Accepted, the operation it returns is polled until it
+        finishes, and the final operation response is returned instead.
+        """
+        headers = {'content-type': 'application/json', 'prefer': 'respond-async'}
+        response = self._dispatch(method, path, body, headers=headers)
+        if response.status_code != requests.codes.accepted:  # @UndefinedVariable
+            return response
+        interval = 0.5
+        operation = response.json()
+        while operation['state'] not in ('SUCCESS', 'FAILURE'):
+            time.sleep(interval)
+            interval = min(interval * 2, 5)
+            response = self._dispatch('get', "/api/operations/{}".format(operation['uuid']))
+            if response.status_code != requests.codes.ok:  # @UndefinedVariable
+                raise ResponseError(response)
+            operation = response.json()
+        if operation['state'] == 'FAILURE':
+            raise ResponseError(response)
         return response
 
+    def _dispatch_list(self, path):
+        """
+        Dispatch a request for an API list and iterate over all its pages
+
+        The first page is requested right away, so a failed request raises
+        before anything is printed. Later pages are requested lazily, as
+        iteration reaches them, by following each page's next link.
+        """
+        response = self._dispatch('get', path)
+        if response.status_code != requests.codes.ok:  # @UndefinedVariable
+            raise ResponseError(response)
+        return self._list_pages(response.json())
+
+    def _list_pages(self, data):
+        while True:
+            for item in data['results']:
+                yield item
+            if not data['next']:
+                return
+            response = self._dispatch('get', data['next'])
+            if response.status_code != requests.codes.ok:  # @UndefinedVariable
+                raise ResponseError(response)
+            data = response.json()
+
     def apps(self, args):
         """
         Valid commands for apps:
@@ -408,6 +494,7 @@ class DeisClient(object):
         apps:info          view info about an application
         apps:open          open the application in a browser
         apps:logs          view aggregated application logs
+        apps:events        view recent application events
         apps:run           run a command in an ephemeral app container
         apps:destroy       destroy an application
 
@@ -440,8 +527,10 @@ class DeisClient(object):
 
         If no ID is provided, one will be generated automatically.
         If no formation is provided, the first available will be used.
+        The placement strategy (spread, anti-affinity or binpack) defaults
+        to the formation's.
 
-        Usage: deis apps:create [--id=<id> --formation=<formation>]
+        Usage: deis apps:create [--id=<id> --formation=<formation> --placement=<strategy>]
         """
         body = {}
         try:
@@ -455,7 +544,7 @@ class DeisClient(object):
             sys.exit(1)
         except EnvironmentError:
             pass
-        for opt in ('--id', '--formation'):
+        for opt in ('--id', '--formation', '--placement'):
             o = args.get(opt)
             if o:
                 body.update({opt.strip('-'): o})
@@ -514,11 +603,12 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             before = time.time()
-            response = self._dispatch('delete', "/api/apps/{}".format(app))
+            response = self._dispatch_operation('delete', "/api/apps/{}".format(app))
         finally:
             progress.cancel()
             progress.join()
-        if response.status_code in (requests.codes.no_content,  # @UndefinedVariable
+        if response.status_code in (requests.codes.ok,  # @UndefinedVariable
+                                    requests.codes.no_content,  # @UndefinedVariable
                                     requests.codes.not_found):  # @UndefinedVariable
             print('done in {}s'.format(int(time.time() - before)))
             # If the requested app is in the current dir, delete the git remote
@@ -539,14 +629,10 @@ class DeisClient(object):
 
         Usage: deis apps:list
         """
-        response = self._dispatch('get', '/api/apps')
-        if response.status_code == requests.codes.ok:  # @UndefinedVariable
-            data = response.json()
-            print('=== Apps')
-            for item in data['results']:
-                print('{id} {containers}'.format(**item))
-        else:
-            raise ResponseError(response)
+        apps = self._dispatch_list('/api/apps')
+        print('=== Apps')
+        for item in apps:
+            print('{id} {containers}'.format(**item))
 
     def apps_info(self, args):
         """
@@ -597,18 +683,75 @@ class DeisClient(object):
         """
         Retrieve the most recent log events
 
-        Usage: deis apps:logs [--app=<app>]
+        Events can be limited to a process type, such as web, and to those
+        since a date or time, such as 2014-02-20T12:00:00. With -f, new
+        events are printed as they arrive until interrupted.
+
+        Usage: deis apps:logs [-f] [--app=<app> --type=<type> --since=<time> --lines=<lines>]
         """
         app = args.get('--app')
         if not app:
             app = self._session.app
-        response = self._dispatch('post',
-                                  "/api/apps/{}/logs".format(app))
+        params = dict((opt.strip('-'), args[opt]) for opt in ('--type', '--since', '--lines')
+                      if args.get(opt))
+        path = "/api/apps/{}/logs".format(app)
+        if args.get('-f'):
+            try:
+                return self._follow_logs(path, params)
+            except KeyboardInterrupt:
+                return
+        if params:
+            path += '?' + urllib.urlencode(params)
+        response = self._dispatch('post', path)
         if response.status_code == requests.codes.ok:  # @UndefinedVariable
             print(response.json())
         else:
             raise ResponseError(response)
 
+    def _follow_logs(self, path, params):
+        """
+        Print log events as the controller streams them
+
+        The controller ends a stream after a while, so it is followed again
+        from the cursor of the last event received.
+        """
+        params['follow'] = ''
+        while True:
+            response = self._dispatch('get', path + '?' + urllib.urlencode(params),
+                                      stream=True)
+            if response.status_code != requests.codes.ok:  # @UndefinedVariable
+                raise ResponseError(response)
+            try:
+                for line in _stream_lines(response):
+                    event = json.loads(line)
+                    sys.stdout.write(event['data'].encode('utf-8'))
+                    sys.stdout.flush()
+                    params['cursor'] = event['cursor']
+            finally:
+                response.close()
+
+    def apps_events(self, args):
+        """
+        View recent events of an application, such as scales and releases
+
+        Usage: deis apps:events [--app=<app> --type=<type>]
+        """
+        app = args.get('--app')
+        if not app:
+            app = self._session.app
+        path = "/api/apps/{}/events".format(app)
+        if args.get('--type'):
+            path += '?' + urllib.urlencode({'type': args['--type']})
+        response = self._dispatch('get', path)
+        if response.status_code == requests.codes.ok:  # @UndefinedVariable
+            print("=== {} Events".format(app))
+            for item in response.json()['results']:
+                item['created'] = readable_datetime(item['created'])
+                item['user'] = item['user'] or ''
+                print("{created:<33} {type:<8} {user:<12} {message}".format(**item))
+        else:
+            raise ResponseError(response)
+
     def apps_run(self, args):
         """
         Run a command inside an ephemeral app container
@@ -767,14 +910,10 @@ class DeisClient(object):
         app = args.get('--app')
         if not app:
             app = self._session.app
-        response = self._dispatch('get', "/api/apps/{}/builds".format(app))
-        if response.status_code == requests.codes.ok:  # @UndefinedVariable
-            print("=== {} Builds".format(app))
-            data = response.json()
-            for item in data['results']:
-                print("{0[uuid]:<23} {0[created]}".format(item))
-        else:
-            raise ResponseError(response)
+        builds = self._dispatch_list("/api/apps/{}/builds".format(app))
+        print("=== {} Builds".format(app))
+        for item in builds:
+            print("{0[uuid]:<23} {0[created]}".format(item))
 
     def config(self, args):
         """
@@ -904,11 +1043,7 @@ class DeisClient(object):
             app = args.get('--app')
             if not app:
                 app = self._session.get_app()
-        response = self._dispatch('get',
-                                  "/api/apps/{}/containers".format(app))
-        if response.status_code != requests.codes.ok:  # @UndefinedVariable
-            raise ResponseError(response)
-        containers = response.json()
+        containers = self._dispatch_list("/api/apps/{}/containers".format(app))
         response = self._dispatch('get', "/api/apps/{}/builds".format(app))
         if response.status_code != requests.codes.ok:  # @UndefinedVariable
             raise ResponseError(response)
@@ -916,7 +1051,7 @@ class DeisClient(object):
         procfile = json.loads(txt) if txt else {}
         print("=== {} Containers".format(app))
         c_map = {}
-        for item in containers['results']:
+        for item in containers:
             c_map.setdefault(item['type'], []).append(item)
         print()
         for c_type in c_map.keys():
@@ -946,9 +1081,8 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             before = time.time()
-            response = self._dispatch('post',
-                                      "/api/apps/{}/scale".format(app),
-                                      json.dumps(body))
+            response = self._dispatch_operation(
+                'post', "/api/apps/{}/scale".format(app), json.dumps(body))
         finally:
             progress.cancel()
             progress.join()
@@ -1103,14 +1237,14 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             before = time.time()
-            response = self._dispatch('post',
-                                      "/api/formations/{}/converge".format(formation))
+            response = self._dispatch_operation(
+                'post', "/api/formations/{}/converge".format(formation))
         finally:
             progress.cancel()
             progress.join()
         if response.status_code == requests.codes.ok:  # @UndefinedVariable
             print('done in {}s'.format(int(time.time() - before)))
-            databag = json.loads(response.content)
+            databag = _operation_result(response)
             print(json.dumps(databag, indent=2))
         else:
             raise ResponseError(response)
@@ -1197,14 +1331,10 @@ class DeisClient(object):
 
         Usage: deis formations:list
         """
-        response = self._dispatch('get', '/api/formations')
-        if response.status_code == requests.codes.ok:  # @UndefinedVariable
-            data = response.json()
-            print("=== Formations")
-            for item in data['results']:
-                print("{id} {nodes}".format(**item))
-        else:
-            raise ResponseError(response)
+        formations = self._dispatch_list('/api/formations')
+        print("=== Formations")
+        for item in formations:
+            print("{id} {nodes}".format(**item))
 
     def formations_destroy(self, args):
         """
@@ -1603,16 +1733,11 @@ class DeisClient(object):
         Usage: deis nodes:list <formation>
         """
         formation = args.get('<formation>')
-        response = self._dispatch('get',
-                                  "/api/formations/{}/nodes".format(formation))
-        if response.status_code == requests.codes.ok:  # @UndefinedVariable
-            print("=== {} Nodes".format(formation))
-            data = response.json()
-            format_str = "{id} {provider_id} {fqdn}"
-            for item in data['results']:
-                print(format_str.format(**item))
-        else:
-            raise ResponseError(response)
+        nodes = self._dispatch_list("/api/formations/{}/nodes".format(formation))
+        print("=== {} Nodes".format(formation))
+        format_str = "{id} {provider_id} {fqdn}"
+        for item in nodes:
+            print(format_str.format(**item))
 
     def nodes_destroy(self, args):
         """
@@ -1662,9 +1787,8 @@ class DeisClient(object):
             progress = TextProgress()
             progress.start()
             before = time.time()
-            response = self._dispatch('post',
-                                      "/api/formations/{}/scale".format(formation),
-                                      json.dumps(body))
+            response = self._dispatch_operation(
+                'post', "/api/formations/{}/scale".format(formation), json.dumps(body))
         finally:
             progress.cancel()
             progress.join()
@@ -2002,15 +2126,11 @@ class DeisClient(object):
         app = args.get('--app')
         if not app:
             app = self._session.app
-        response = self._dispatch('get', "/api/apps/{app}/releases".format(**locals()))
-        if response.status_code == requests.codes.ok:  # @UndefinedVariable
-            print("=== {} Releases".format(app))
-            data = response.json()
-            for item in data['results']:
-                item['created'] = readable_datetime(item['created'])
-                print("v{version:<6} {created:<33} {summary}".format(**item))
-        else:
-            raise ResponseError(response)
+        releases = self._dispatch_list("/api/apps/{app}/releases".format(**locals()))
+        print("=== {} Releases".format(app))
+        for item in releases:
+            item['created'] = readable_datetime(item['created'])
+            print("v{version:<6} {created:<33} {summary}".format(**item))
 
     def releases_rollback(self, args):
         """
@@ -2097,6 +2217,9 @@ correct and the server is running.")
             msg = resp.json()
             if 'detail' in msg:
                 msg = "Detail:\n{}".format(msg['detail'])
+            elif msg.get('state') == 'FAILURE':
+                msg = "Operation {} failed:\n{}".format(
+                    msg['action'], json.loads(msg['result']))
         except:
             msg = resp.text
         print(msg)
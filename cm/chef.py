@@ -4,16 +4,19 @@ Deis configuration management implementation for Opscode Chef.
 
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+import json
 import os
 import re
 import subprocess
-import tempfile
+import sys
+import threading
 import time
 import socket
 
 from celery.canvas import group
 
-from api.ssh import exec_ssh, connect_ssh
+from api.ssh import exec_ssh, ssh_pool
 from cm.chef_api import ChefAPI
 
 
@@ -22,6 +25,39 @@ CHEF_INSTALL_TYPE = 'gems'
 CHEF_RUBY_VERSION = '1.9.1'
 CHEF_ENVIRONMENT = '_default'
 CHEF_CLIENT_VERSION = '11.8.2'
+# maximum number of keep-alive connections to the Chef server per process
+CHEF_API_CONCURRENCY = 8
+# seconds to wait for cloud-init to finish on a new node
+CLOUD_INIT_TIMEOUT = 600
+# waits on the node itself, using `cloud-init status --wait` where available
+# and otherwise the boot-finished marker; nodes without cloud-init pass at once
+CLOUD_INIT_WAIT = (
+    "timeout {timeout} sh -c '"
+    "command -v cloud-init >/dev/null || exit 0; "
+    "cloud-init status --wait >/dev/null 2>&1 || "
+    "while [ ! -f /var/lib/cloud/instance/boot-finished ]; do sleep 1; done'")
+# the steps of knife's chef-full bootstrap template, run over an open SSH session
+CHEF_BOOTSTRAP_SCRIPT = """\
+set -e
+if ! chef-client --version 2>/dev/null | grep -q '{version}'; then
+  curl -sL https://www.opscode.com/chef/install.sh | bash -s -- -v {version}
+fi
+mkdir -p /etc/chef
+cat > /etc/chef/validation.pem <<'EOP'
+{validation_key}
+EOP
+chmod 0600 /etc/chef/validation.pem
+cat > /etc/chef/client.rb <<'EOP'
+log_location STDOUT
+chef_server_url '{server_url}'
+validation_client_name '{validation_name}'
+node_name '{node_name}'
+EOP
+cat > /etc/chef/first-boot.json <<'EOP'
+{first_boot}
+EOP
+chef-client -j /etc/chef/first-boot.json -E {environment}
+"""
 
 # load chef config using CHEF_CONFIG_PATH
 try:
@@ -58,65 +94,77 @@ except Exception as err:
         raise EnvironmentError(msg)
 
 
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
 def _get_client():
     """
-    Return a new instance of a Chef API Client
+    Return the process-wide Chef API Client
+
+    The client keeps a pool of keep-alive connections to the Chef server,
+    so it is shared by every caller in this process. A forked process
+    gets a client of its own rather than sharing its parent's sockets.
 
     :rtype: a :class:`~cm.chef_api.ChefAPI` object
     """
-    return ChefAPI(CHEF_SERVER_URL, CHEF_CLIENT_NAME, CHEF_CLIENT_KEY)
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = ChefAPI(CHEF_SERVER_URL, CHEF_CLIENT_NAME, CHEF_CLIENT_KEY,
+                              pool_size=CHEF_API_CONCURRENCY)
+            _client_pid = os.getpid()
+        return _client
 
 
-def bootstrap_node(node):
+def bootstrap_node(node, progress=None):
     """
     Bootstrap the Chef configuration management tools onto a node.
 
+    Waits for cloud-init to finish, then installs and registers chef-client
+    over the same SSH session.
+
     :param node: a dict containing the node's fully-qualified domain name and SSH info
+    :param progress: called with the name of each bootstrap phase as it begins
+    :returns: an ordered dict of seconds spent in each bootstrap phase
     :raises: RuntimeError
     """
+    progress = progress or (lambda phase: None)
+    timings = OrderedDict()
+    started = time.time()
     # block until we can connect over ssh
-    ssh = connect_ssh(node['ssh_username'], node['fqdn'], node.get('ssh_port', 22),
-                      node['ssh_private_key'], timeout=120)
-    # block until ubuntu cloud-init is finished
-    initializing = True
-    while initializing:
-        time.sleep(10)
-        initializing, _rc = exec_ssh(ssh, 'ps auxw | egrep "cloud-init" | grep -v egrep')
-    # write out private key and prepare to `knife bootstrap`
-    try:
-        _, pk_path = tempfile.mkstemp()
-        _, output_path = tempfile.mkstemp()
-        with open(pk_path, 'w') as f:
-            f.write(node['ssh_private_key'])
-        # build knife bootstrap command
-        args = ['knife', 'bootstrap', node['fqdn']]
-        args.extend(['--config', '/etc/chef/client.rb'])
-        args.extend(['--identity-file', pk_path])
-        args.extend(['--node-name', node['id']])
-        args.extend(['--sudo', '--ssh-user', node['ssh_username']])
-        args.extend(['--ssh-port', str(node.get('ssh_port', 22))])
-        args.extend(['--bootstrap-version', CHEF_CLIENT_VERSION])
-        args.extend(['--no-host-key-verify'])
-        args.extend(['--run-list', _construct_run_list(node)])
-        print(' '.join(args))
-        # tee the command's output to a tempfile
-        args.extend(['|', 'tee', output_path])
-        # TODO: figure out why home isn't being set correctly for knife exec
-        env = os.environ.copy()
-        env['HOME'] = '/var/lib/deis'
-        # execute knife bootstrap
-        p = subprocess.Popen(' '.join(args), env=env, shell=True)
-        rc = p.wait()
-        # always print knife output
-        with open(output_path) as f:
-            output = str(f.read())
-        # raise an exception if bootstrap failed
-        if rc != 0 or 'incorrect password' in output:
+    progress('wait-for-ssh')
+    with ssh_pool.connection(node['ssh_username'], node['fqdn'], node.get('ssh_port', 22),
+                             node['ssh_private_key'], timeout=120) as ssh:
+        timings['connect'] = time.time() - started
+        progress('bootstrap')
+        # block on the node until ubuntu cloud-init is finished
+        started = time.time()
+        output, rc = exec_ssh(ssh, CLOUD_INIT_WAIT.format(timeout=CLOUD_INIT_TIMEOUT))
+        timings['cloud-init'] = time.time() - started
+        if rc != 0:
+            raise RuntimeError('Node Bootstrap Error:\ncloud-init did not finish within '
+                               '{} seconds\n{}'.format(CLOUD_INIT_TIMEOUT, output))
+        # install chef-client and register the node with the chef server
+        started = time.time()
+        output, rc = exec_ssh(ssh, 'sudo bash -s', stdin=_bootstrap_script(node),
+                              callback=_relay_output)
+        timings['install'] = time.time() - started
+        if rc != 0:
             raise RuntimeError('Node Bootstrap Error:\n' + output)
-    # remove temp files from filesystem
-    finally:
-        os.remove(pk_path)
-        os.remove(output_path)
+    print('Bootstrapped {}: {}'.format(node['id'], ', '.join(
+        '{} {:.1f}s'.format(phase, seconds) for phase, seconds in timings.items())))
+    return timings
+
+
+def _bootstrap_script(node):
+    run_list = [r for r in _construct_run_list(node).split(',') if r]
+    return CHEF_BOOTSTRAP_SCRIPT.format(
+        version=CHEF_CLIENT_VERSION, validation_key=CHEF_VALIDATION_KEY,
+        server_url=CHEF_SERVER_URL, validation_name=CHEF_VALIDATION_NAME,
+        node_name=node['id'], environment=CHEF_ENVIRONMENT,
+        first_boot=json.dumps({'run_list': run_list})).encode('utf-8')
 
 
 def _construct_run_list(node):
@@ -149,6 +197,11 @@ def purge_node(node):
         raise RuntimeError("Could not purge node client {node_id}: {body}".format(**locals()))
 
 
+def _relay_output(data):
+    sys.stdout.write(data)
+    sys.stdout.flush()
+
+
 def converge_node(node):
     """
     Converge a node.
@@ -159,11 +212,10 @@ def converge_node(node):
     :param node: a dict containing the node's fully-qualified domain name and SSH info
     :returns: a tuple of the convergence command's (output, return_code)
     """
-    ssh = connect_ssh(node['ssh_username'],
-                      node['fqdn'], 22,
-                      node['ssh_private_key'])
-    output, rc = exec_ssh(ssh, 'sudo chef-client')
-    print(output)
+    with ssh_pool.connection(node['ssh_username'], node['fqdn'],
+                             node.get('ssh_port', 22), node['ssh_private_key']) as ssh:
+        # relay chef-client output as it runs rather than after it exits
+        output, rc = exec_ssh(ssh, 'sudo chef-client', callback=_relay_output)
     if rc != 0:
         e = RuntimeError('Node converge error')
         e.output = output
@@ -179,9 +231,9 @@ def run_node(node, command):
     :param command: the command-line to execute on the node
     :returns: a tuple of the command's (output, return_code)
     """
-    ssh = connect_ssh(node['ssh_username'], node['fqdn'],
-                      node['ssh_port'], node['ssh_private_key'])
-    output, rc = exec_ssh(ssh, command, pty=True)
+    with ssh_pool.connection(node['ssh_username'], node['fqdn'],
+                             node['ssh_port'], node['ssh_private_key']) as ssh:
+        output, rc = exec_ssh(ssh, command, pty=True)
     return output, rc
 
 
@@ -9,7 +9,10 @@ import datetime
 import hashlib
 import httplib
 import json
+import Queue
+import random
 import re
+import socket
 import time
 import urlparse
 
@@ -79,11 +82,21 @@ def sha1_base64(value):
     return '\n'.join(ruby_b64encode(hashlib.sha1(value).digest()))
 
 
+EMPTY_BODY_HASH = sha1_base64('')
+
+
 def create_authorization(blank_headers, verb, url, priv_key, user, body=''):
+    """
+    Return a copy of blank_headers with the Chef request signature added.
+
+    priv_key may be a PEM string, a path to a PEM file or a parsed
+    :class:`~cm.chef_rsa.Key`; pass the parsed key to avoid loading it
+    again for every request.
+    """
     headers = blank_headers.copy()
-    rsa_key = Key(fp=priv_key)
+    rsa_key = priv_key if isinstance(priv_key, Key) else Key(fp=priv_key)
     timestamp = canonical_time(datetime.datetime.utcnow())
-    hashed_body = sha1_base64(body)
+    hashed_body = sha1_base64(body) if body else EMPTY_BODY_HASH
 
     canon = canonical_request(verb, url, hashed_body, timestamp, user)
     b64_priv = ruby_b64encode(rsa_key.private_encrypt(canon))
@@ -118,31 +131,83 @@ class ChefAPI(object):
         'Content-Type': 'application/json'
     }
 
-    def __init__(self, server_url, client_name, client_key):
+    def __init__(self, server_url, client_name, client_key, pool_size=8):
         self.server_url = server_url
         self.client_name = client_name
         self.client_key = client_key
-        self.hostname = urlparse.urlsplit(self.server_url).netloc
-        self.path = urlparse.urlsplit(self.server_url).path
-        self.headers.update({'Host': self.hostname})
-        self.conn = httplib.HTTPSConnection(self.hostname)
-        self.conn.connect()
+        url = urlparse.urlsplit(self.server_url)
+        self.hostname = url.netloc
+        self.path = url.path
+        self.headers = dict(self.headers, Host=self.hostname)
+        self.headers['X-Ops-UserId'] = client_name
+        # parse the PEM key once rather than for every signed request
+        self.key = Key(fp=client_key)
+        if url.scheme == 'http':
+            self.connection_class = httplib.HTTPConnection
+        else:
+            self.connection_class = httplib.HTTPSConnection
+        # idle keep-alive connections, most recently used first
+        self.pool = Queue.LifoQueue(pool_size)
 
-    def request(self, verb, path, body='', attempts=5, interval=5):
+    def request(self, verb, path, body='', attempts=5, interval=1, max_interval=30):
         url = self.path + path
+        # sign once; retries resend the same headers
         headers = create_authorization(
-            self.headers, verb, url, self.client_key, self.client_name, body)
-        # retry all chef api requests
-        for _ in range(attempts):
-            self.conn.request(verb, url, body=body, headers=headers)
-            resp = self.conn.getresponse()
-            if resp.status != 500:
+            self.headers, verb, url, self.key, self.client_name, body)
+        # retry all chef api requests, backing off exponentially with jitter
+        for attempt in range(attempts):
+            data, status = self._send(verb, url, body, headers)
+            if status != 500:
                 break
-            time.sleep(interval)
+            if attempt < attempts - 1:
+                time.sleep(random.uniform(0, min(max_interval, interval * 2 ** attempt)))
         else:
             errmsg = 'Chef API requests failed: {}'.format(path)
             raise RuntimeError(errmsg)
-        return resp.read(), resp.status
+        return data, status
+
+    def close(self):
+        """Close all idle connections to the Chef server."""
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except Queue.Empty:
+                break
+
+    def _send(self, verb, url, body, headers):
+        """
+        Send a single request over a pooled keep-alive connection.
+
+        If a reused connection was closed by the server while idle, it is
+        reopened and the request is sent once more.
+        """
+        try:
+            conn, reused = self.pool.get_nowait(), True
+        except Queue.Empty:
+            conn, reused = self.connection_class(self.hostname), False
+        try:
+            try:
+                conn.request(verb, url, body=body, headers=headers)
+                resp = conn.getresponse()
+            except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+                if not reused:
+                    raise
+                # httplib reconnects on the next request after close()
+                conn.close()
+                conn.request(verb, url, body=body, headers=headers)
+                resp = conn.getresponse()
+            data = resp.read()
+        except Exception:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            try:
+                self.pool.put_nowait(conn)
+            except Queue.Full:
+                conn.close()
+        return data, resp.status
 
     def create_databag(self, name):
         body = json.dumps({'name': name, 'id': name})
@@ -10,14 +10,18 @@ import os
 from deis import settings
 
 
-def bootstrap_node(node):
+def bootstrap_node(node, progress=None):
     """
     Bootstrap configuration management tools onto a node.
 
     This is a no-op for the mock provider.
 
     :param node: a dict containing the node's fully-qualified domain name and SSH info
+    :param progress: called with the name of each bootstrap phase as it begins
     """
+    if progress is not None:
+        progress('wait-for-ssh')
+        progress('bootstrap')
     if 'error' in node.get('fqdn'):
         raise RuntimeError('Node Bootstrap Error:\nmock testing')
 
@@ -0,0 +1,206 @@
+"""
+Unit tests for the Deis cm app.
+
+Run the tests with "./manage.py test cm"
+"""
+
+from __future__ import unicode_literals
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+import base64
+import json
+import os
+import threading
+import time
+from unittest import skipUnless
+
+from django.test import SimpleTestCase
+
+from cm.chef_api import ChefAPI
+from cm.chef_api import canonical_request
+from cm.chef_api import create_authorization
+from cm.chef_api import sha1_base64
+from cm.chef_rsa import Key
+
+
+class FakeChefHandler(BaseHTTPRequestHandler):
+    """Answer every Chef API request with an empty JSON document."""
+
+    protocol_version = 'HTTP/1.1'
+    # buffer responses so headers and body leave in a single segment
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def handle_one_request(self):
+        BaseHTTPRequestHandler.handle_one_request(self)
+        # simulate a server that drops idle keep-alive connections
+        if self.server.drop_connections:
+            self.close_connection = 1
+
+    def _respond(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.rfile.read(length)
+        self.server.requests += 1
+        status = 200
+        if self.server.failures:
+            self.server.failures -= 1
+            status = 500
+        body = json.dumps({})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeChefServer(ThreadingMixIn, HTTPServer):
+    """A local HTTP server standing in for a Chef server."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeChefHandler)
+        self.connections = 0
+        self.requests = 0
+        self.failures = 0
+        self.drop_connections = False
+
+    @property
+    def url(self):
+        return 'http://{}:{}/organizations/deis'.format(*self.server_address)
+
+
+class ChefAPITest(SimpleTestCase):
+
+    """Tests the pooled Chef API client against a fake Chef server"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = Key.generate(2048).private_export()
+
+    def setUp(self):
+        self.server = FakeChefServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def chef_client(self):
+        # settings parsed from client.rb are native strings, not unicode
+        return ChefAPI(str(self.server.url), str('deis'), self.key)
+
+    def test_keep_alive(self):
+        client = self.chef_client()
+        for _ in range(10):
+            _, status = client.get_databag_item('deis-apps', 'autotest')
+            self.assertEqual(status, 200)
+        self.assertEqual(self.server.requests, 10)
+        self.assertEqual(self.server.connections, 1)
+        client.close()
+
+    def test_stale_connection(self):
+        self.server.drop_connections = True
+        client = self.chef_client()
+        for _ in range(3):
+            _, status = client.update_databag_item('deis-apps', 'autotest', {})
+            self.assertEqual(status, 200)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.server.connections, 3)
+
+    def test_retry(self):
+        self.server.failures = 2
+        client = self.chef_client()
+        _, status = client.request('GET', '/data/deis-apps', interval=0.01)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.server.requests, 3)
+        self.server.failures = 3
+        self.assertRaises(RuntimeError, client.request, 'GET', '/data/deis-apps',
+                          attempts=3, interval=0.01)
+
+    def test_headers(self):
+        client = self.chef_client()
+        self.assertEqual(client.headers['Host'], client.hostname)
+        self.assertNotIn('Host', ChefAPI.headers)
+
+    @skipUnless(os.environ.get('DEIS_BENCHMARK'), 'set DEIS_BENCHMARK to run benchmarks')
+    def test_benchmark(self):
+        """A pooled client serves requests faster than a client per call."""
+        requests = 200
+
+        def run(get_client):
+            start = time.time()
+            for _ in range(requests):
+                client = get_client()
+                client.update_databag_item('deis-apps', 'autotest', {'id': 'autotest'})
+                if client is not pooled:
+                    client.close()
+            return requests / (time.time() - start)
+
+        pooled = self.chef_client()
+        self.addCleanup(pooled.close)
+        before = run(self.chef_client)
+        after = run(lambda: pooled)
+        self.assertEqual(self.server.connections, requests + 1)
+        self.assertGreater(after, before)
+
+
+class ChefSigningTest(SimpleTestCase):
+
+    """Tests Chef request signing with a cached RSA key"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = Key.generate(2048).private_export()
+
+    def verify(self, headers, verb, url, body):
+        """Decrypt the signature and compare it to the canonical request."""
+        lines = sorted((int(k.rsplit('-', 1)[1]), v) for k, v in headers.items()
+                       if k.startswith('X-Ops-Authorization-'))
+        signature = ''.join(v for _, v in lines)
+        hashed_body = sha1_base64(body)
+        self.assertEqual(headers['X-Ops-Content-Hash'], hashed_body)
+        canon = canonical_request(verb, url, hashed_body, headers['X-Ops-Timestamp'],
+                                  headers['X-Ops-UserId'])
+        self.assertEqual(Key(fp=self.key).public_decrypt(base64.b64decode(signature)), canon)
+
+    def test_signature(self):
+        client = ChefAPI(str('http://127.0.0.1/organizations/deis'), str('deis'), self.key)
+        self.assertIsInstance(client.key, Key)
+        self.assertEqual(client.headers['X-Ops-UserId'], 'deis')
+        for body in ('', json.dumps({'id': 'autotest'})):
+            headers = create_authorization(
+                client.headers, 'PUT', '/data/deis-apps/autotest', client.key, 'deis', body)
+            self.verify(headers, 'PUT', '/data/deis-apps/autotest', body)
+        # a PEM string is still accepted
+        headers = create_authorization({}, 'GET', '/nodes', self.key, 'deis')
+        self.verify(headers, 'GET', '/nodes', '')
+
+    @skipUnless(os.environ.get('DEIS_BENCHMARK'), 'set DEIS_BENCHMARK to run benchmarks')
+    def test_benchmark(self):
+        """Signing with a parsed key is faster than parsing it per request."""
+        requests = 500
+        body = json.dumps({'id': 'autotest', 'containers': {'web': range(100)}})
+
+        def run(key):
+            start = time.time()
+            for _ in range(requests):
+                create_authorization(
+                    ChefAPI.headers, 'PUT', '/data/deis-apps/autotest', key, 'deis', body)
+            return requests / (time.time() - start)
+
+        before = run(self.key)
+        after = run(Key(fp=self.key))
+        self.assertGreater(after, before)
@@ -119,6 +119,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'api.middleware.PublishMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -279,9 +280,36 @@ CELERYD_CONCURRENCY = 8
 # etcd settings
 ETCD_HOST, ETCD_PORT = os.environ.get('ETCD', '127.0.0.1:4001').split(',')[0].split(':')
 
+# the shared cache holds state every controller process must agree on, such
+# as the digests of databags published to configuration management, and is
+# kept in the database so that it is shared without another service
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'deis_cache',
+    },
+}
+
 # default deis settings
 DEIS_LOG_DIR = os.path.abspath(os.path.join(__file__, '..', '..', 'logs'))
 LOG_LINES = 1000
+LOG_LINES_MAX = 10000
+LOG_INDEX_DIR = os.path.join(DEIS_LOG_DIR, '.index')
+LOG_INDEX_BLOCK = 256 * 1024
+LOG_INDEX_CACHE = 100
+LOG_FOLLOW_INTERVAL = 0.5
+LOG_FOLLOW_HEARTBEAT = 15
+# a followed stream holds a sync gunicorn worker, so it ends well before the
+# worker timeout (30 seconds by default) and the client follows it again
+LOG_FOLLOW_TIMEOUT = 20
+LOG_FOLLOW_CHUNK = 64 * 1024
+EVENT_LOG_SIZE = 1000
+# seconds between polls of a deploy's progress while it is streamed
+BUILD_PROGRESS_INTERVAL = 0.5
+EVENT_LOG_TRIM_INTERVAL = 50
 TEMPDIR = tempfile.mkdtemp(prefix='deis')
 
 # security keys and auth tokens
@@ -294,6 +322,11 @@ REGISTRY_URL = os.environ.get('DEIS_REGISTRY_URL', None)
 # the config management module to use in api.models
 CM_MODULE = os.environ.get('DEIS_CM_MODULE', 'cm.mock')
 
+# memory in MB assumed for container types and node flavors that declare none,
+# used by the binpack placement strategy
+CONTAINER_MEMORY = 256
+NODE_MEMORY = 4096
+
 # default providers, typically overriden in local_settings to include ec2, etc.
 PROVIDER_MODULES = ('mock',)
 
@@ -21,12 +21,10 @@ def account(request):
 @login_required
 def dashboard(request):
     """Return the user's dashboard web page."""
-    apps = App.objects.filter(owner=request.user)
-    formations = Formation.objects.filter(owner=request.user)
     return render(request, 'web/dashboard.html', {
         'page': 'dashboard',
-        'apps': apps,
-        'formations': formations,
+        'app_count': App.objects.filter(owner=request.user).count(),
+        'formation_count': Formation.objects.filter(owner=request.user).count(),
         'version': __version__,
     })
 
@@ -34,7 +32,7 @@ def dashboard(request):
 @login_required
 def formations(request):
     """Return the user's formations web page."""
-    formations = Formation.objects.filter(owner=request.user)
+    formations = Formation.objects.filter(owner=request.user).select_related('owner')
     return render(request, 'web/formations.html', {
         'page': 'formations',
         'formations': formations,
@@ -44,7 +42,7 @@ def formations(request):
 @login_required
 def apps(request):
     """Return the user's apps web page."""
-    apps = App.objects.filter(owner=request.user)
+    apps = App.objects.filter(owner=request.user).select_related('owner', 'formation')
     return render(request, 'web/apps.html', {
         'page': 'apps',
         'apps': apps,